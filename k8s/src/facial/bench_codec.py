@@ -0,0 +1,72 @@
+import argparse
+import os
+import random
+import struct
+import tempfile
+import time
+import facial_codec
+from claim_check import FileClaimStore
+
+#Bytes and CPU per message for the facial codec - version 1 (gzip + base64 in JSON) against
+#version 2 bodies with each encoding. CPU is process time per message for the three places the
+#image is handled: facial-svc encoding it, flight-svc/satellite-interface forwarding it and a
+#satellite turning it into the stored version 1 string. Version 3 puts the image in a claim check
+#store in a temp directory, its encode and store columns include the file write and read.
+#Usage: python bench_codec.py --image face.jpg
+#       python bench_codec.py   (synthetic JPEG-like and uncompressed images)
+
+def synthetic_jpeg(size, seed=42):
+    #High entropy bytes behind a JPEG signature, compresses about as badly as a real photo
+    rnd = random.Random(seed)
+    return b"\xff\xd8\xff\xe0" + rnd.randbytes(size - 4)
+
+def synthetic_bitmap(width=256, height=256):
+    #Uncompressed BMP of a smooth gradient, the kind of image that does shrink
+    pixels = b"".join(bytes((x + y) % 256 for x in range(width) for _ in range(3)) for y in range(height))
+    header = b"BM" + struct.pack("<IHHI", 54 + len(pixels), 0, 0, 54)
+    info = struct.pack("<IiiHHIIiiII", 40, width, height, 1, 24, 0, len(pixels), 2835, 2835, 0, 0)
+    return header + info + pixels
+
+def cpu_per_message(fn, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        result = fn()
+    return (time.process_time() - start) / repeat * 1e6, result
+
+def bench(name, content, repeat, claims):
+    message = {"passenger_key": "p" * 64, "trace_id": "t" * 36}
+    print(f"{name}: {len(content)} bytes, compressible: {facial_codec.is_compressible(content)}")
+    print(f"{'codec':>16} {'body B':>10} {'vs image':>9} {'encode us':>10} {'forward us':>11} {'store us':>10}")
+    variants = [("v1 gzip+base64", facial_codec.LEGACY_VERSION, "gzip", None)]
+    for encoding in facial_codec.available():
+        levels = (None,) if encoding == "identity" else sorted({facial_codec.DEFAULT_LEVELS[encoding], 1})
+        for level in levels:
+            label = f"v2 {encoding}" + ("" if level is None else f" -{level}")
+            variants.append((label, facial_codec.VERSION, encoding, level))
+    variants.append(("v3 claim check", facial_codec.CLAIM_CHECK_VERSION, None, None))
+    for label, version, encoding, level in variants:
+        encode_us, body = cpu_per_message(lambda: facial_codec.pack({**message, **facial_codec.encode(content, version, encoding, level, claims)}), repeat)
+        forward_us, _ = cpu_per_message(lambda: facial_codec.pack(facial_codec.unpack(body)), repeat)
+        store_us, _ = cpu_per_message(lambda: facial_codec.legacy_image(facial_codec.unpack(body), claims), repeat)
+        print(f"{label:>16} {len(body):>10} {len(body) / len(content):>8.2f}x {encode_us:>10.0f} {forward_us:>11.0f} {store_us:>10.0f}")
+    print()
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare facial codec versions and encodings")
+    parser.add_argument("--image", help="image file to encode, synthetic images are used if omitted")
+    parser.add_argument("--size", type=int, default=200_000, help="bytes of the synthetic JPEG-like image")
+    parser.add_argument("--repeat", type=int, default=50, help="messages per measurement")
+    args = parser.parse_args()
+
+    print(f"encodings available here: {', '.join(facial_codec.available())}")
+    with tempfile.TemporaryDirectory() as root:
+        claims = FileClaimStore(root)
+        if args.image:
+            with open(args.image, "rb") as f:
+                bench(os.path.basename(args.image), f.read(), args.repeat, claims)
+        else:
+            bench("synthetic JPEG", synthetic_jpeg(args.size), args.repeat, claims)
+            bench("uncompressed BMP", synthetic_bitmap(), args.repeat, claims)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+import os
+import re
+import mmap
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+import contextlib
+import collections
+from opentelemetry import metrics
+
+#Content-addressed store for facial images under FACIAL_DIR
+#  blobs/<sha[:2]>/<sha>  image bytes as the API returned them, named by their sha256 - an image
+#                         shared by several passengers is stored once
+#  index/<passenger_key>  sha256 of that passenger's image
+#Files are written under a temp name and renamed into place, readers never see half a file.
+#Reads go through mmap. Blobs are capped at max_bytes in total and the least recently used go
+#first - a blob's mtime is bumped on every use so the order survives restarts. An index entry
+#whose blob was evicted reads as a miss and the image is fetched again. Worker processes sharing
+#the directory each keep the cap on the blobs they know about and re-scan the disk at most
+#every rescan_interval seconds when over it.
+
+logger = logging.getLogger(__name__)
+
+KEY_PATTERN = re.compile(r"[A-Za-z0-9_.-]+")
+
+class BlobStore:
+    def __init__(self, root, max_bytes=1024 * 1024 * 1024, rescan_interval=60):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.rescan_interval = rescan_interval
+        self._blob_dir = os.path.join(root, "blobs")
+        self._index_dir = os.path.join(root, "index")
+        os.makedirs(self._blob_dir, exist_ok=True)
+        os.makedirs(self._index_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._lru = collections.OrderedDict()
+        self._scanned_at = 0.0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.deduplicated = 0
+        self.evicted = 0
+        self.scan()
+        logger.info(f"Blob store at {root} holds {len(self._lru)} image(s), {self.size / 1024 / 1024:.1f}MB of {max_bytes / 1024 / 1024:.0f}MB")
+
+    def _blob_path(self, sha):
+        return os.path.join(self._blob_dir, sha[:2], sha)
+
+    def _index_path(self, key):
+        if not KEY_PATTERN.fullmatch(key):
+            raise ValueError(f"Invalid blob store key: {key!r}")
+        return os.path.join(self._index_dir, key)
+
+    def scan(self):
+        #Rebuilds the LRU order from the blobs on disk, oldest mtime first
+        found = []
+        for prefix in os.listdir(self._blob_dir):
+            subdir = os.path.join(self._blob_dir, prefix)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                if name.startswith("."):
+                    continue
+                try:
+                    st = os.stat(os.path.join(subdir, name))
+                except FileNotFoundError:
+                    continue
+                found.append((st.st_mtime, name, st.st_size))
+        found.sort()
+        with self._lock:
+            self._lru = collections.OrderedDict((sha, size) for _, sha, size in found)
+            self.size = sum(size for _, _, size in found)
+            self._scanned_at = time.monotonic()
+
+    def _write(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+            raise
+
+    def _touch(self, sha, size):
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(self._blob_path(sha))
+        with self._lock:
+            if sha not in self._lru:
+                self.size += size
+            self._lru[sha] = size
+            self._lru.move_to_end(sha)
+
+    def put(self, content):
+        #Returns the sha256 the content is stored under, writes nothing when it is already there
+        if not content:
+            raise ValueError("Refusing to store an empty image")
+        sha = hashlib.sha256(content).hexdigest()
+        path = self._blob_path(sha)
+        if os.path.exists(path):
+            with self._lock:
+                self.deduplicated += 1
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._write(path, content)
+            with self._lock:
+                self.writes += 1
+        self._touch(sha, len(content))
+        self._evict()
+        return sha
+
+    def link(self, key, sha):
+        self._write(self._index_path(key), sha.encode("ascii"))
+
+    def lookup(self, key):
+        try:
+            with open(self._index_path(key), "rb") as f:
+                return f.read().decode("ascii")
+        except FileNotFoundError:
+            return None
+
+    @contextlib.contextmanager
+    def read(self, key):
+        #Yields (sha, mmap) for the key's image, or (None, None) - the mmap is only valid inside the with
+        sha = self.lookup(key)
+        f = None
+        if sha is not None:
+            try:
+                f = open(self._blob_path(sha), "rb")
+            except FileNotFoundError:
+                #Evicted, drop the dangling index entry
+                self.unlink(key)
+        if f is None:
+            with self._lock:
+                self.misses += 1
+            yield None, None
+            return
+        with f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            self._touch(sha, len(view))
+            with self._lock:
+                self.hits += 1
+            yield sha, view
+
+    def unlink(self, key):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._index_path(key))
+
+    def keys(self):
+        return [name for name in os.listdir(self._index_dir) if not name.startswith(".")]
+
+    def prune(self, older_than):
+        #Removes blobs no index entry points to and unused for older_than seconds - images waiting
+        #in a warm pool are not linked to a passenger yet and stay for a while
+        self.scan()
+        referenced = {self.lookup(key) for key in self.keys()}
+        cutoff = time.time() - older_than
+        removed = 0
+        for sha in list(self._lru):
+            if sha in referenced:
+                continue
+            path = self._blob_path(sha)
+            try:
+                if os.stat(path).st_mtime > cutoff:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            with self._lock:
+                size = self._lru.pop(sha, None)
+                if size is not None:
+                    self.size -= size
+            removed += 1
+        return removed
+
+    def _evict(self):
+        if self.size > self.max_bytes and time.monotonic() - self._scanned_at > self.rescan_interval:
+            #Other workers may have written or evicted since the last look
+            self.scan()
+        while True:
+            with self._lock:
+                if self.size <= self.max_bytes or len(self._lru) <= 1:
+                    return
+                sha, size = self._lru.popitem(last=False)
+                self.size -= size
+                self.evicted += 1
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._blob_path(sha))
+            logger.debug(f"Evicted blob {sha} ({size} bytes)")
+
+def register_blob_store_metrics(meter, store):
+    def size_callback(options):
+        return [metrics.Observation(store.size)]
+
+    def blobs_callback(options):
+        return [metrics.Observation(len(store._lru))]
+
+    def reads_callback(options):
+        return [metrics.Observation(store.hits, attributes={"result": "hit"}), metrics.Observation(store.misses, attributes={"result": "miss"})]
+
+    def writes_callback(options):
+        return [metrics.Observation(store.writes, attributes={"result": "written"}), metrics.Observation(store.deduplicated, attributes={"result": "deduplicated"})]
+
+    def evicted_callback(options):
+        return [metrics.Observation(store.evicted)]
+
+    meter.create_observable_gauge(
+        "application.facial.store.size",
+        unit="By",
+        description="Bytes of image blobs in the on-disk store",
+        callbacks=[size_callback]
+    )
+    meter.create_observable_gauge(
+        "application.facial.store.blobs",
+        unit="{image}",
+        description="Distinct images in the on-disk store",
+        callbacks=[blobs_callback]
+    )
+    meter.create_observable_counter(
+        "application.facial.store.reads",
+        unit="{image}",
+        description="Passenger lookups in the on-disk store, by hit or miss",
+        callbacks=[reads_callback]
+    )
+    meter.create_observable_counter(
+        "application.facial.store.writes",
+        unit="{image}",
+        description="Images put in the on-disk store, written or already there",
+        callbacks=[writes_callback]
+    )
+    meter.create_observable_counter(
+        "application.facial.store.evicted",
+        unit="{image}",
+        description="Least recently used blobs removed to stay under the size cap",
+        callbacks=[evicted_callback]
+    )
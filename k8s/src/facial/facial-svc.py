@@ -2,16 +2,27 @@ import json
 import sys
 import ssl
 import pika
+import aio_pika
+import asyncio
 import os
+import socket
 from dotenv import load_dotenv
 import hmac
 import hashlib
-import base64
 import mysql.connector
+from mysql_pool import MySQLPool, register_pool_metrics
+from queue_topology import QueueTopology, register_topology_metrics
+from threaded_consumer import ThreadSafeChannel, register_consumer_metrics
+from async_consumer import AsyncConsumer
+from worker_supervisor import WorkerSupervisor, register_supervisor_metrics
+from image_fetcher import ImageFetcher, register_fetcher_metrics
+from image_pool import ImagePool, register_image_pool_metrics
+from blob_store import BlobStore, register_blob_store_metrics
+import facial_codec
+from claim_check import open_store, register_claim_check_metrics
 import uuid
 import logging
-import requests
-import gzip
+import aiohttp
 import time
 from opentelemetry import metrics
 from opentelemetry.sdk.metrics import MeterProvider
@@ -20,9 +31,9 @@ from opentelemetry.sdk.resources import Resource
 from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
 from opentelemetry.semconv.resource import ResourceAttributes
 
-def bootstrap():
+def bootstrap(worker=None):
     #Environment variables
-    global facial_dir, facial_api, rmq_url, rmq_port, rmq_username, rmq_password, ca_cert, secret_key, mysql_url, mysql_port, mysql_user, mysql_password, mysql_db, CONSUME_QUEUE_NAME, PRODUCE_QUEUE_NAME, logdir, loglvl, logger, facial_api_latency, publish_exec_time, last_exec_time_ms
+    global facial_dir, facial_api, rmq_url, rmq_port, rmq_username, rmq_password, ca_cert, secret_key, mysql_url, mysql_port, mysql_user, mysql_password, mysql_db, CONSUME_QUEUE_NAME, PRODUCE_QUEUE_NAME, logdir, loglvl, logger, facial_api_latency, publish_exec_time, last_exec_time_ms, mysql_pool, topology, meter, consumer_runtime, async_max_in_flight, worker_processes, worker_restart_backoff, worker_restart_backoff_max, facial_fetch_concurrency, facial_max_in_flight, facial_fetch_timeout, facial_fetch_deadline, facial_pool_target, facial_pool_low, facial_pool_high, facial_pool_workers, blob_store, facial_codec_version, facial_encoding, facial_compression_level, claim_store
     facial_dir = os.environ.get("FACIAL_DIR")
     facial_api = os.environ.get("image_gen_api")
     rmq_url = os.environ.get("RMQ_HOST")
@@ -36,11 +47,41 @@ def bootstrap():
     mysql_user = os.environ.get("MYSQL_USER")
     mysql_password = os.environ.get("MYSQL_PW")
     mysql_db = os.environ.get("MYSQL_DB")
+    consumer_runtime = os.environ.get("consumer_runtime", "blocking").lower()
+    #Messages are acked when their image is in, prefetch is how many passengers wait on images at once
+    facial_fetch_concurrency = int(os.environ.get("facial_fetch_concurrency", "8"))
+    facial_max_in_flight = int(os.environ.get("facial_max_in_flight", "64"))
+    facial_fetch_timeout = float(os.environ.get("facial_fetch_timeout_s", "10"))
+    #Warm pool of ready images, refilled from low back up to high - facial_pool_target=0 turns it off
+    facial_pool_target = int(os.environ.get("facial_pool_target", "32"))
+    facial_pool_low = int(os.environ.get("facial_pool_low", str(facial_pool_target // 2)))
+    facial_pool_high = int(os.environ.get("facial_pool_high", str(facial_pool_target * 2)))
+    facial_pool_workers = int(os.environ.get("facial_pool_workers", str(facial_fetch_concurrency)))
+    async_max_in_flight = int(os.environ.get("async_max_in_flight", "200"))
+    worker_processes = int(os.environ.get("worker_processes", "1"))
+    worker_restart_backoff = float(os.environ.get("worker_restart_backoff_s", "1"))
+    worker_restart_backoff_max = float(os.environ.get("worker_restart_backoff_max_s", "60"))
+    #Version 2 sends image bytes in a binary body, 1 the base64 JSON field older consumers expect,
+    #3 only a reference to the image in the claim check store, the default when one is configured
+    claim_check_url = os.environ.get("claim_check_url")
+    facial_codec_version = int(os.environ.get("facial_codec_version", str(facial_codec.CLAIM_CHECK_VERSION if claim_check_url else facial_codec.VERSION)))
+    if facial_codec_version == facial_codec.CLAIM_CHECK_VERSION and not claim_check_url:
+        raise ValueError("facial_codec_version 3 needs claim_check_url")
+    facial_encoding = facial_codec.resolve(os.environ.get("facial_compression", "zstd").lower())
+    facial_compression_level = int(os.environ["facial_compression_level"]) if os.environ.get("facial_compression_level") else None
+    #Images already fetched are kept under FACIAL_DIR, least recently used go past this size
+    facial_store_max_bytes = int(os.environ.get("facial_store_max_bytes", str(1024 * 1024 * 1024)))
+    mysql_pool_size = int(os.environ.get("mysql_pool_size", str(max(4, facial_fetch_concurrency + facial_pool_workers))))
+    mysql_pool_warm = int(os.environ.get("mysql_pool_warm", "2"))
+    mysql_pool_max_lifetime = int(os.environ.get("mysql_pool_max_lifetime_s", "1800"))
+    mysql_pool_ping_after = int(os.environ.get("mysql_pool_ping_after_s", "30"))
     CONSUME_QUEUE_NAME = "source_data_flight"
     PRODUCE_QUEUE_NAME = "source_data_facial"
     logdir = os.environ.get("log_directory", ".")
     loglvl = os.environ.get("log_level", "INFO").upper()
     facial_api_latency= int(os.environ.get("facial_api_latency", "5"))
+    #Latency plus the request timeout plus some room to wait for a fetch thread
+    facial_fetch_deadline = float(os.environ.get("facial_fetch_deadline_s", str(facial_api_latency + facial_fetch_timeout + 15)))
     otel_service_name = "facial-svc"
     otel_exporter_endpoint = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
     otel_exporter_interval = int(os.environ.get("OTEL_EXPORT_INTERVAL"))
@@ -67,10 +108,14 @@ def bootstrap():
     logger.addHandler(file_handler)
 
     #OTEL setup
-    resource = Resource.create({
+    resource_attributes = {
         "service.name": otel_service_name,
         "service.version": release_version,
-    })
+    }
+    if worker_processes > 1:
+        #The supervisor and every worker process export on their own, tell them apart by instance
+        resource_attributes["service.instance.id"] = f"{socket.gethostname()}-{'supervisor' if worker is None else f'w{worker}'}"
+    resource = Resource.create(resource_attributes)
 
     metric_reader = PeriodicExportingMetricReader(
     OTLPMetricExporter(endpoint=otel_exporter_endpoint, insecure=True),
@@ -97,6 +142,26 @@ def bootstrap():
         callbacks=[exec_time_callback]
     )
 
+    #MySQL connection pool
+    mysql_pool = MySQLPool("hq", lambda: connect_mysql(mysql_db), size=mysql_pool_size, warm=mysql_pool_warm, max_lifetime=mysql_pool_max_lifetime, ping_after=mysql_pool_ping_after)
+    register_pool_metrics(meter, [mysql_pool])
+
+    #On-disk image store, a passenger processed again reuses its image instead of calling the API
+    blob_store = None
+    if facial_dir:
+        blob_store = BlobStore(facial_dir, max_bytes=facial_store_max_bytes)
+        register_blob_store_metrics(meter, blob_store)
+
+    #Claim check store the satellites read the images back from
+    claim_store = None
+    if claim_check_url:
+        claim_store = open_store(claim_check_url)
+        register_claim_check_metrics(meter, claim_store)
+
+    #Queues this service consumes from and publishes to, declared once per channel
+    topology = QueueTopology([CONSUME_QUEUE_NAME, PRODUCE_QUEUE_NAME])
+    register_topology_metrics(meter, topology)
+
 def get_rmq_connection():
     credentials = pika.PlainCredentials(
         rmq_username,
@@ -123,13 +188,29 @@ def get_rmq_connection():
 
     return pika.BlockingConnection(params)
 
-def get_mysql_connection():
+async def get_rmq_connection_async():
+    ssl_context = ssl.create_default_context(cafile=ca_cert)
+    ssl_context.check_hostname = True
+    ssl_context.verify_mode = ssl.CERT_REQUIRED
+
+    return await aio_pika.connect_robust(
+        host=rmq_url,
+        port=rmq_port,
+        login=rmq_username,
+        password=rmq_password,
+        ssl=True,
+        ssl_context=ssl_context,
+        heartbeat=60
+    )
+
+def connect_mysql(database):
+    #Opens a new connection, everything else goes through the pool
     return mysql.connector.connect(
         host=mysql_url,
         port=mysql_port,
         user=mysql_user,
         password=mysql_password,
-        database=mysql_db,
+        database=database,
 
         ssl_ca=ca_cert,
         ssl_verify_cert=True,
@@ -138,37 +219,48 @@ def get_mysql_connection():
         autocommit=False
     )
 
+def get_mysql_connection():
+    return mysql_pool.get()
+
 def process_message(channel, method, properties, body):
-    global conn, last_exec_time_ms
-    conn = get_mysql_connection()
+    #Runs on the connection thread and only hands the passenger to the image pool, on_facial_image
+    #writes, publishes and acks once the image is in - at once from the pool, after a fetch otherwise
     try:
         start = time.perf_counter()
         message = json.loads(body)
         logger.info(f"Received message: {message}")
-
         p_key = message["passenger_key"]
-        trace_id = message["trace_id"]
-        if passenger_exists(conn, p_key):
-            logger.warning(f"[{trace_id}] Passenger exists : {p_key} - Skipping facial insertion.")
-            if facial_exists(conn, p_key):
-                logger.warning(f"[{trace_id}] Facial data exists for passenger : {p_key} - Skipping facial insertion.")
-            else:
-                logger.info(f"[{trace_id}] Feature not implemented yet - next deployment.")
-                #generate pic - next deployment
-        else:
-            facial_b64 = get_facial_image(p_key)
-            logger.info(f"[{trace_id}] Inserting facial data for passenger: {p_key} with trace ID: {trace_id}")
-            insert_facial(conn, message["passenger_key"], trace_id)
-            conn.commit()
+        image_pool.acquire(p_key, lambda image, error: on_facial_image(channel, method, message, image, error, start))
+    except Exception as e:
+        logger.error(f"Error processing message: {e}")
+        channel.basic_nack(
+            delivery_tag=method.delivery_tag,
+            requeue=True
+        )
 
+def on_facial_image(channel, method, message, image, error, start):
+    #Runs on a pool or fetch thread, channel is a ThreadSafeChannel. The image is in before the row
+    #is written so no transaction stays open across the API latency. The row is committed after
+    #the publish - a failed publish rolls it back and the redelivered message tries again.
+    global last_exec_time_ms
+    p_key = message["passenger_key"]
+    trace_id = message["trace_id"]
+    if error is not None:
+        logger.error(f"[{trace_id}] Could not fetch facial image for passenger {p_key}: {error}")
+        channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        return
+    digest, facial = image
+    conn = None
+    try:
+        conn = get_mysql_connection()
+        logger.info(f"[{trace_id}] Inserting facial data for passenger: {p_key} with trace ID: {trace_id}")
+        if not insert_facial(conn, p_key, trace_id):
+            conn.rollback()
+            logger.warning(f"[{trace_id}] Facial data exists for passenger : {p_key} - Skipping facial insertion.")
+        else:
             logger.info(f"[{trace_id}] Publishing facial details to {PRODUCE_QUEUE_NAME}")
-            channel.queue_declare(queue=PRODUCE_QUEUE_NAME, durable=True)
-            message_push = {
-                "passenger_key": message["passenger_key"],
-                "facial_image": facial_b64,
-                "trace_id": trace_id
-            }
-            body = json.dumps(message_push)
+            topology.ensure(channel, PRODUCE_QUEUE_NAME)
+            body = facial_codec.pack(facial_message(message, facial))
             channel.basic_publish(
                 exchange="",
                 routing_key=PRODUCE_QUEUE_NAME,
@@ -177,8 +269,10 @@ def process_message(channel, method, properties, body):
                     delivery_mode=2
                 )
             )
+            conn.commit()
             logger.info("Facial details written and message published.")
-        channel.basic_ack(delivery_tag=method.delivery_tag)    
+        link_facial_image(p_key, digest, trace_id)
+        channel.basic_ack(delivery_tag=method.delivery_tag)
         duration_ms = (time.perf_counter() - start) * 1000
         last_exec_time_ms = duration_ms
     except Exception as e:
@@ -187,46 +281,93 @@ def process_message(channel, method, properties, body):
             delivery_tag=method.delivery_tag,
             requeue=True
         )
-    conn.close()
+    finally:
+        if conn is not None:
+            conn.close()
+
+async def process_message_async(consumer, message):
+    #consumer_runtime=asyncio counterpart of process_message - same fetch, insert, publish, commit
+    #order, so it publishes itself and waits for the confirm before committing instead of returning
+    #the message to AsyncConsumer. The stored image, else one from the pool, else the fetch and its
+    #latency wait on the event loop.
+    global last_exec_time_ms
+    start = time.perf_counter()
+    logger.info(f"Received message: {message}")
+
+    p_key = message["passenger_key"]
+    trace_id = message["trace_id"]
+    image = await consumer.run(stored_facial_image, p_key) if blob_store else None
+    if image is None:
+        image = image_pool.take()
+    if image is None:
+        content = await get_facial_image_async(p_key)
+        image = await consumer.run(prepare_facial_image, content)
+    digest, facial = image
+    async with consumer.mysql_connection(get_mysql_connection) as conn:
+        logger.info(f"[{trace_id}] Inserting facial data for passenger: {p_key} with trace ID: {trace_id}")
+        if not await consumer.run(insert_facial, conn, p_key, trace_id):
+            await consumer.run(conn.rollback)
+            logger.warning(f"[{trace_id}] Facial data exists for passenger : {p_key} - Skipping facial insertion.")
+            await consumer.run(link_facial_image, p_key, digest, trace_id)
+            return []
+        logger.info(f"[{trace_id}] Publishing facial details to {PRODUCE_QUEUE_NAME}")
+        #A failed publish raises here, the row is rolled back and the redelivered message tries again
+        await consumer.publish(PRODUCE_QUEUE_NAME, facial_message(message, facial))
+        await consumer.run(conn.commit)
+    await consumer.run(link_facial_image, p_key, digest, trace_id)
+    last_exec_time_ms = (time.perf_counter() - start) * 1000
+    return []
+
+def link_facial_image(passenger_key, digest, trace_id):
+    #Only once the passenger's facial row is committed - housekeep removes index entries without one.
+    #The message is done by then, a failed link only means the image is fetched again next time.
+    if digest is None:
+        return
+    try:
+        blob_store.link(passenger_key, digest)
+    except Exception as e:
+        logger.warning(f"[{trace_id}] Could not link facial image {digest} to passenger {passenger_key}: {e}")
+
+def facial_message(message, facial):
+    return {
+        "passenger_key": message["passenger_key"],
+        **facial,
+        "trace_id": message["trace_id"]
+    }
 
-def get_facial_image(passenger_key):
+async def get_facial_image_async(passenger_key):
     logger.debug(f"Generating facial image for passenger: {passenger_key}")
-    time.sleep(facial_api_latency)
-    resp = requests.get(
-        facial_api,
-        timeout=10
-    )
-    resp.raise_for_status()
+    async with asyncio.timeout(facial_fetch_deadline):
+        await asyncio.sleep(facial_api_latency)
+        async with fetch_slots:
+            async with http_session.get(facial_api) as resp:
+                resp.raise_for_status()
+                content = await resp.read()
     logger.debug(f"Facial image retrieved for passenger: {passenger_key}")
-    gzipped = gzip.compress(resp.content)
-    facial_b64 = base64.b64encode(gzipped).decode("utf-8")
-    # with open(f"{facial_dir}/{passenger_key}.b64", "w") as f:
-    #     f.write(facial_b64)
-    return facial_b64
-
-def passenger_exists(conn, passenger_key):
-    logger.debug(f"Checking if passenger exists: {passenger_key}")
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT 1 FROM facial WHERE passenger_key = %s LIMIT 1",
-        (passenger_key,)
-    )
-    return cursor.fetchone() is not None
+    return content
 
-def facial_exists(conn, passenger_key):
-    logger.debug(f"Checking if facial data exists: {passenger_key}")
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT has_image FROM facial WHERE passenger_key = %s LIMIT 1",
-        (passenger_key,)
-    )
-    return cursor.fetchone() is not None
+def prepare_facial_image(content):
+    #What the image pool hands out - the blob store digest (None without FACIAL_DIR) and the encoded image
+    digest = blob_store.put(content) if blob_store else None
+    return digest, encode_facial_image(content, digest)
+
+def stored_facial_image(passenger_key):
+    #The passenger's image from an earlier run, read from the blob store, or None
+    with blob_store.read(passenger_key) as (digest, view):
+        if view is None:
+            return None
+        logger.debug(f"Facial image for passenger {passenger_key} served from the blob store")
+        return digest, encode_facial_image(view, digest)
+
+def encode_facial_image(content, digest=None):
+    #The facial fields of the outgoing message, see facial_codec for the versions
+    return facial_codec.encode(content, version=facial_codec_version, encoding=facial_encoding, level=facial_compression_level, claims=claim_store, digest=digest)
 
 def insert_facial(conn, passenger_key, trace_id):
     cursor = conn.cursor()
     cursor.execute(
         """
-        INSERT INTO facial (
+        INSERT IGNORE INTO facial (
             passenger_key,
             trace_id
         )
@@ -237,24 +378,62 @@ def insert_facial(conn, passenger_key, trace_id):
             trace_id
         )
     )
+    return cursor.rowcount == 1
 
 def main():
     bootstrap()
+    if worker_processes > 1:
+        logger.info(f"**********Starting facial-svc supervisor with {worker_processes} worker processes**********")
+        supervisor = WorkerSupervisor(run_worker, worker_processes, name="facial-svc", backoff=worker_restart_backoff, backoff_max=worker_restart_backoff_max)
+        register_supervisor_metrics(meter, supervisor)
+        supervisor.run()
+    else:
+        run_service()
+
+def run_worker(worker, stats):
+    #Entry point of a spawned worker process, sets everything up again with its own connections
+    bootstrap(worker)
+    run_service(stats)
+
+def run_service(stats=None):
+    global image_fetcher, image_pool
+    mysql_pool.warm_up()
     logger.info("**********Starting facial service**********")
 
+    logger.info(f"Fetching images on {facial_fetch_concurrency} connection(s), up to {facial_max_in_flight} passengers in flight")
+    image_fetcher = ImageFetcher(facial_api, concurrency=facial_fetch_concurrency, latency=facial_api_latency, timeout=facial_fetch_timeout, deadline=facial_fetch_deadline)
+    register_fetcher_metrics(meter, image_fetcher)
+    image_pool = ImagePool(image_fetcher, prepare_facial_image, target=facial_pool_target, low=facial_pool_low, high=facial_pool_high, workers=facial_pool_workers, lookup=stored_facial_image if blob_store else None)
+    register_image_pool_metrics(meter, image_pool)
+    if facial_pool_high > 0:
+        logger.info(f"Warming image pool to {image_pool.target} image(s), refilling from {image_pool.low} up to {image_pool.high}")
+        image_pool.warm_up(timeout=facial_fetch_deadline)
+
+    if consumer_runtime == "asyncio":
+        try:
+            asyncio.run(main_async(stats))
+        except KeyboardInterrupt:
+            logger.info("Stopping consumer...")
+        finally:
+            image_pool.close()
+            image_fetcher.close()
+        return
+
     logger.info("Starting SSL RabbitMQ consumer...")
-    global connection, channel 
+    global connection, channel
     connection = get_rmq_connection()
     channel = connection.channel()
 
-    logger.info(f"Declaring queue {CONSUME_QUEUE_NAME}")
-    channel.queue_declare(queue=CONSUME_QUEUE_NAME, durable=True)
-    channel.basic_qos(prefetch_count=1)
+    if stats:
+        stats.track_consumers([image_pool])
+    safe_channel = ThreadSafeChannel(connection, channel)
+    topology.declare_all(safe_channel)
+    channel.basic_qos(prefetch_count=facial_max_in_flight)
 
     logger.info(f"Consuming messages from {CONSUME_QUEUE_NAME}")
     channel.basic_consume(
         queue=CONSUME_QUEUE_NAME,
-        on_message_callback=process_message,
+        on_message_callback=lambda ch, method, properties, body: process_message(safe_channel, method, properties, body),
         auto_ack=False
     )
 
@@ -264,10 +443,35 @@ def main():
 
     except KeyboardInterrupt:
         logger.info("Stopping consumer...")
+        logger.info(f"Skipped {topology.saved} queue declares, sent {topology.declares}")
     finally:
         channel.stop_consuming()
+        #Completions ack through the connection thread, keep it running until they are done
+        deadline = time.perf_counter() + facial_fetch_deadline
+        while image_pool.in_flight and time.perf_counter() < deadline:
+            connection.process_data_events(time_limit=0.1)
+        if image_pool.in_flight:
+            logger.warning(f"Stopping with {image_pool.in_flight} image(s) still in flight, they will be redelivered")
+        image_pool.close()
+        image_fetcher.close()
         connection.close()
 
+async def main_async(stats=None):
+    global http_session, fetch_slots
+    logger.info(f"Starting asyncio RabbitMQ consumer - up to {async_max_in_flight} messages in flight")
+    #One keep-alive session for every image fetch, at most facial_fetch_concurrency requests open at once
+    http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=facial_fetch_timeout), connector=aiohttp.TCPConnector(limit=facial_fetch_concurrency))
+    fetch_slots = asyncio.Semaphore(facial_fetch_concurrency)
+    consumer = AsyncConsumer(get_rmq_connection_async, topology.queues, max_in_flight=async_max_in_flight, db_threads=mysql_pool.size, pack=facial_codec.pack)
+    register_consumer_metrics(meter, [consumer])
+    if stats:
+        stats.track_consumers([consumer])
+    consumer.consume(CONSUME_QUEUE_NAME, process_message_async)
+    try:
+        await consumer.serve()
+    finally:
+        await http_session.close()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,153 @@
+import time
+import heapq
+import logging
+import threading
+import concurrent.futures
+import requests
+from opentelemetry import metrics
+
+#Fetches facial images for many passengers at once without tying up a thread per passenger.
+#  latency      simulated image API latency (facial_api_latency), waited out on one scheduler
+#               thread instead of a time.sleep per message
+#  concurrency  fetch threads, also the size of the keep-alive connection pool of the session
+#  timeout      socket timeout of one request
+#  deadline     seconds from fetch() until the result must be in, counted across the latency,
+#               the wait for a fetch thread and the request itself
+#fetch(key, on_done) returns at once, on_done(content, error) runs later on a fetch thread -
+#the caller acks or nacks the message from there.
+
+logger = logging.getLogger(__name__)
+
+class DeadlineExceeded(Exception):
+    pass
+
+class ImageFetcher:
+    def __init__(self, url, concurrency=8, latency=0, timeout=10, deadline=30, name="image-fetcher"):
+        self.url = url
+        self.concurrency = concurrency
+        self.latency = latency
+        self.timeout = timeout
+        self.deadline = deadline
+        self.name = name
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="fetch")
+        self._lock = threading.Lock()
+        self._timers = []
+        self._seq = 0
+        self._wake = threading.Condition(self._lock)
+        self._closed = False
+        self.in_flight = 0
+        self.active = 0
+        self.processed = 0
+        self.failed = 0
+        self.deadline_exceeded = 0
+        self.last_fetch_ms = 0.0
+        self.last_queue_wait_ms = 0.0
+        threading.Thread(target=self._timer_loop, name=f"{name}-timer", daemon=True).start()
+
+    def fetch(self, key, on_done):
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight += 1
+            self._seq += 1
+            heapq.heappush(self._timers, (now + self.latency, self._seq, key, now + self.deadline, on_done))
+            self._wake.notify()
+
+    def _timer_loop(self):
+        with self._lock:
+            while not self._closed:
+                if not self._timers:
+                    self._wake.wait()
+                    continue
+                due = self._timers[0][0] - time.monotonic()
+                if due > 0:
+                    self._wake.wait(due)
+                    continue
+                ready_at, _, key, deadline, on_done = heapq.heappop(self._timers)
+                self._executor.submit(self._fetch, key, ready_at, deadline, on_done)
+
+    def _fetch(self, key, ready_at, deadline, on_done):
+        start = time.monotonic()
+        self.last_queue_wait_ms = (start - ready_at) * 1000
+        content, error = None, None
+        try:
+            remaining = deadline - start
+            if remaining <= 0:
+                raise DeadlineExceeded(f"Deadline passed before the fetch for {key} could start")
+            with self._lock:
+                self.active += 1
+            try:
+                resp = self.session.get(self.url, timeout=min(self.timeout, remaining))
+                resp.raise_for_status()
+                content = resp.content
+            finally:
+                with self._lock:
+                    self.active -= 1
+            self.last_fetch_ms = (time.monotonic() - start) * 1000
+            if time.monotonic() > deadline:
+                raise DeadlineExceeded(f"Fetch for {key} finished after its deadline")
+        except DeadlineExceeded as e:
+            with self._lock:
+                self.deadline_exceeded += 1
+            error = e
+        except Exception as e:
+            #Anything else is handed to on_done too, every fetch must end in an ack or a nack
+            with self._lock:
+                self.failed += 1
+            error = e
+        try:
+            on_done(content, error)
+        except Exception as e:
+            logger.error(f"Completion callback for {key} failed: {e}")
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.processed += 1
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._wake.notify()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+def register_fetcher_metrics(meter, fetcher):
+    def in_flight_callback(options):
+        return [metrics.Observation(fetcher.in_flight)]
+
+    def active_callback(options):
+        return [metrics.Observation(fetcher.active)]
+
+    def fetch_time_callback(options):
+        return [metrics.Observation(fetcher.last_fetch_ms)]
+
+    def deadline_callback(options):
+        return [metrics.Observation(fetcher.deadline_exceeded)]
+
+    meter.create_observable_gauge(
+        "application.facial.fetch.in_flight",
+        unit="{image}",
+        description="Images requested and not completed yet, including the simulated API latency",
+        callbacks=[in_flight_callback]
+    )
+    meter.create_observable_gauge(
+        "application.facial.fetch.active",
+        unit="{request}",
+        description="HTTP requests to the image API currently open",
+        callbacks=[active_callback]
+    )
+    meter.create_observable_gauge(
+        "application.facial.fetch.time",
+        unit="ms",
+        description="Duration of the last HTTP request to the image API",
+        callbacks=[fetch_time_callback]
+    )
+    meter.create_observable_counter(
+        "application.facial.fetch.deadline_exceeded",
+        unit="{image}",
+        description="Image fetches abandoned because their deadline passed, the message is requeued",
+        callbacks=[deadline_callback]
+    )
@@ -0,0 +1,173 @@
+import time
+import logging
+import threading
+import collections
+import concurrent.futures
+from opentelemetry import metrics
+
+#Warm pool of encoded facial images in front of an ImageFetcher. The image API ignores the
+#passenger, so any image will do - they are fetched ahead of time and a message takes one from
+#the pool instead of waiting out facial_api_latency. Refills go through the same fetcher, as many
+#at once as the pool is short of high - a refill spends most of its time waiting out the latency on
+#the fetcher's timer thread and holds a fetch thread only for the request itself.
+#  target  depth warm_up() waits for before the service starts consuming
+#  low     refill starts when the depth falls to this
+#  high    refill stops once the depth is back up to this
+#An empty pool is not an error, acquire() falls back to fetching the image for that message.
+#prepare(content) turns fetched bytes into whatever the pool hands out. lookup(key), if given,
+#returns an image already prepared for that key or None and is tried first, on a completion thread.
+
+logger = logging.getLogger(__name__)
+
+class ImagePool:
+    def __init__(self, fetcher, prepare, target=32, low=16, high=64, workers=4, lookup=None):
+        self.fetcher = fetcher
+        self.prepare = prepare
+        self.lookup = lookup
+        self.high = high
+        self.low = min(low, high)
+        self.target = min(target, high)
+        self._images = collections.deque()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._refilling = False
+        self._completions = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="facial")
+        self.hits = 0
+        self.misses = 0
+        self.refilled = 0
+        self.in_flight = 0
+        self.processed = 0
+
+    def depth(self):
+        return len(self._images)
+
+    def warm_up(self, timeout=60):
+        start = time.perf_counter()
+        self._refill(force=True)
+        while len(self._images) < self.target and time.perf_counter() - start < timeout:
+            time.sleep(0.05)
+        logger.info(f"Image pool warmed up to {len(self._images)} image(s) in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    def take(self):
+        #Returns a prepared image or None, the caller fetches its own on None
+        try:
+            image = self._images.popleft()
+        except IndexError:
+            image = None
+        with self._lock:
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self._refill()
+        return image
+
+    def acquire(self, key, on_done):
+        #on_done(image, error) runs on a completion thread on a hit, on a fetch thread on a miss
+        with self._lock:
+            self.in_flight += 1
+        if self.lookup is not None:
+            self._completions.submit(self._lookup, key, on_done)
+        else:
+            self._take_or_fetch(key, on_done)
+
+    def _lookup(self, key, on_done):
+        try:
+            image = self.lookup(key)
+        except Exception as e:
+            logger.warning(f"Lookup for {key} failed, taking a new image: {e}")
+            image = None
+        if image is not None:
+            self._done(key, on_done, image, None)
+        else:
+            self._take_or_fetch(key, on_done)
+
+    def _take_or_fetch(self, key, on_done):
+        image = self.take()
+        if image is not None:
+            self._completions.submit(self._done, key, on_done, image, None)
+        else:
+            self.fetcher.fetch(key, lambda content, error: self._fetched(key, on_done, content, error))
+
+    def _fetched(self, key, on_done, content, error):
+        image = None
+        if error is None:
+            try:
+                image = self.prepare(content)
+            except Exception as e:
+                error = e
+        self._done(key, on_done, image, error)
+
+    def _done(self, key, on_done, image, error):
+        try:
+            on_done(image, error)
+        except Exception as e:
+            logger.error(f"Completion callback for {key} failed: {e}")
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.processed += 1
+
+    def _refill(self, force=False):
+        if self.high <= 0:
+            return
+        with self._lock:
+            depth = len(self._images)
+            if force or depth <= self.low:
+                self._refilling = True
+            if depth >= self.high:
+                self._refilling = False
+            n = 0
+            if self._refilling:
+                n = max(0, self.high - depth - self._pending)
+                self._pending += n
+        for _ in range(n):
+            self.fetcher.fetch("image-pool", self._on_refill)
+
+    def _on_refill(self, content, error):
+        image = None
+        if error is None:
+            try:
+                image = self.prepare(content)
+            except Exception as e:
+                error = e
+        with self._lock:
+            self._pending -= 1
+            if image is not None:
+                self._images.append(image)
+                self.refilled += 1
+        if error is not None:
+            logger.warning(f"Image pool refill failed: {error}")
+        self._refill()
+
+    def close(self):
+        self._completions.shutdown(wait=False, cancel_futures=True)
+
+def register_image_pool_metrics(meter, pool):
+    def depth_callback(options):
+        return [metrics.Observation(pool.depth())]
+
+    def refilled_callback(options):
+        return [metrics.Observation(pool.refilled)]
+
+    def hits_callback(options):
+        return [metrics.Observation(pool.hits, attributes={"result": "hit"}), metrics.Observation(pool.misses, attributes={"result": "miss"})]
+
+    meter.create_observable_gauge(
+        "application.facial.pool.depth",
+        unit="{image}",
+        description="Encoded facial images ready in the warm pool",
+        callbacks=[depth_callback]
+    )
+    meter.create_observable_counter(
+        "application.facial.pool.refilled",
+        unit="{image}",
+        description="Images added to the warm pool by the background refill, its rate is the refill rate",
+        callbacks=[refilled_callback]
+    )
+    meter.create_observable_counter(
+        "application.facial.pool.takes",
+        unit="{image}",
+        description="Images requested from the warm pool, by hit or miss",
+        callbacks=[hits_callback]
+    )
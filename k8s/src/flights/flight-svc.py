@@ -1,12 +1,22 @@
 import json
 import ssl
 import pika
+import aio_pika
+import asyncio
 import os
+import socket
 import time
+import threading
 import hmac
 import hashlib
 import base64
 import mysql.connector
+from mysql_pool import MySQLPool, register_pool_metrics
+from queue_topology import QueueTopology, register_topology_metrics
+from threaded_consumer import ThreadedConsumer, register_consumer_metrics
+from async_consumer import AsyncConsumer
+from worker_supervisor import WorkerSupervisor, register_supervisor_metrics
+import facial_codec
 import uuid
 import logging
 import sys
@@ -18,9 +28,9 @@ from opentelemetry.sdk.resources import Resource
 from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
 from opentelemetry.semconv.resource import ResourceAttributes
 
-def bootstrap():
+def bootstrap(worker=None):
     #Environment variables
-    global rmq_url, rmq_port, rmq_username, rmq_password, ca_cert, mysql_url, mysql_port, mysql_user, mysql_password, mysql_db, CONSUME_QUEUE_NAME_PRE_FACIAL, CONSUME_QUEUE_NAME_POST_FACIAL, PRODUCE_QUEUE_NAME_PRE_FACIAL,PRODUCE_QUEUE_NAME_POST_FACIAL, facial_api_latency, logdir, loglvl, logger, publish_exec_time, last_exec_pre_time_ms, last_exec_post_time_ms
+    global rmq_url, rmq_port, rmq_username, rmq_password, ca_cert, mysql_url, mysql_port, mysql_user, mysql_password, mysql_db, CONSUME_QUEUE_NAME_PRE_FACIAL, CONSUME_QUEUE_NAME_POST_FACIAL, PRODUCE_QUEUE_NAME_PRE_FACIAL,PRODUCE_QUEUE_NAME_POST_FACIAL, facial_api_latency, logdir, loglvl, logger, publish_exec_time, last_exec_pre_time_ms, last_exec_post_time_ms, mysql_pool, topology, consumer_workers, meter, consumer_runtime, async_max_in_flight, worker_processes, worker_restart_backoff, worker_restart_backoff_max, prefetch_max, prefetch_max_bytes, prefetch_tune_interval, pre_facial_workers, post_facial_workers, pre_facial_prefetch_max, post_facial_prefetch_max, stage_latency
     rmq_url = os.environ.get("RMQ_HOST")
     rmq_port = int(os.environ.get("RMQ_PORT"))
     rmq_username = os.environ.get("RMQ_USER")
@@ -31,6 +41,25 @@ def bootstrap():
     mysql_user = os.environ.get("MYSQL_USER")
     mysql_password = os.environ.get("MYSQL_PW")
     mysql_db = os.environ.get("MYSQL_DB")
+    consumer_runtime = os.environ.get("consumer_runtime", "blocking").lower()
+    consumer_workers = int(os.environ.get("consumer_workers", "1"))
+    prefetch_max = int(os.environ.get("prefetch_max", str(consumer_workers * 4)))
+    prefetch_max_bytes = int(os.environ.get("prefetch_max_bytes", str(64 * 1024 * 1024)))
+    prefetch_tune_interval = float(os.environ.get("prefetch_tune_interval_s", "5"))
+    async_max_in_flight = int(os.environ.get("async_max_in_flight", "200"))
+    worker_processes = int(os.environ.get("worker_processes", "1"))
+    worker_restart_backoff = float(os.environ.get("worker_restart_backoff_s", "1"))
+    worker_restart_backoff_max = float(os.environ.get("worker_restart_backoff_max_s", "60"))
+    #Each stage scales on its own, consumer_workers/prefetch_max are only the defaults
+    pre_facial_workers = int(os.environ.get("pre_facial_workers", str(consumer_workers)))
+    post_facial_workers = int(os.environ.get("post_facial_workers", str(consumer_workers)))
+    pre_facial_prefetch_max = int(os.environ.get("pre_facial_prefetch_max", str(max(prefetch_max, pre_facial_workers))))
+    post_facial_prefetch_max = int(os.environ.get("post_facial_prefetch_max", str(max(prefetch_max, post_facial_workers))))
+    #Enough connections for both stages at once, so a busy post-facial stage cannot starve pre-facial of connections
+    mysql_pool_size = int(os.environ.get("mysql_pool_size", str(max(4, pre_facial_workers + post_facial_workers))))
+    mysql_pool_warm = int(os.environ.get("mysql_pool_warm", "2"))
+    mysql_pool_max_lifetime = int(os.environ.get("mysql_pool_max_lifetime_s", "1800"))
+    mysql_pool_ping_after = int(os.environ.get("mysql_pool_ping_after_s", "30"))
     CONSUME_QUEUE_NAME_PRE_FACIAL = "source_data_passenger"
     CONSUME_QUEUE_NAME_POST_FACIAL = "source_data_facial"
     PRODUCE_QUEUE_NAME_PRE_FACIAL = "source_data_flight"
@@ -65,10 +94,14 @@ def bootstrap():
     logger.addHandler(file_handler)
 
     #OTEL setup
-    resource = Resource.create({
+    resource_attributes = {
         "service.name": otel_service_name,
         "service.version": release_version,
-    })
+    }
+    if worker_processes > 1:
+        #The supervisor and every worker process export on their own, tell them apart by instance
+        resource_attributes["service.instance.id"] = f"{socket.gethostname()}-{'supervisor' if worker is None else f'w{worker}'}"
+    resource = Resource.create(resource_attributes)
 
     metric_reader = PeriodicExportingMetricReader(
     OTLPMetricExporter(endpoint=otel_exporter_endpoint, insecure=True),
@@ -104,14 +137,29 @@ def bootstrap():
         callbacks=[exec_time_callback],
     )
 
+    stage_latency = meter.create_histogram(
+        name="application.stage.latency",
+        unit="ms",
+        description="Time to handle one message, per stage",
+    )
 
-def get_mysql_connection():
+    #MySQL connection pool
+    mysql_pool = MySQLPool("hq", lambda: connect_mysql(mysql_db), size=mysql_pool_size, warm=mysql_pool_warm, max_lifetime=mysql_pool_max_lifetime, ping_after=mysql_pool_ping_after)
+    register_pool_metrics(meter, [mysql_pool])
+
+    #Queues this service consumes from and publishes to, declared once per channel
+    topology = QueueTopology([CONSUME_QUEUE_NAME_PRE_FACIAL, CONSUME_QUEUE_NAME_POST_FACIAL, PRODUCE_QUEUE_NAME_PRE_FACIAL, PRODUCE_QUEUE_NAME_POST_FACIAL])
+    register_topology_metrics(meter, topology)
+
+
+def connect_mysql(database):
+    #Opens a new connection, everything else goes through the pool
     return mysql.connector.connect(
         host=mysql_url,
         port=mysql_port,
         user=mysql_user,
         password=mysql_password,
-        database=mysql_db,
+        database=database,
 
         ssl_ca=ca_cert,
         ssl_verify_cert=True,
@@ -120,6 +168,9 @@ def get_mysql_connection():
         autocommit=False
     )
 
+def get_mysql_connection():
+    return mysql_pool.get()
+
 def get_rmq_connection():
     credentials = pika.PlainCredentials(
         rmq_username,
@@ -146,31 +197,34 @@ def get_rmq_connection():
 
     return pika.BlockingConnection(params)
 
+async def get_rmq_connection_async():
+    ssl_context = ssl.create_default_context(cafile=ca_cert)
+    ssl_context.check_hostname = True
+    ssl_context.verify_mode = ssl.CERT_REQUIRED
+
+    return await aio_pika.connect_robust(
+        host=rmq_url,
+        port=rmq_port,
+        login=rmq_username,
+        password=rmq_password,
+        ssl=True,
+        ssl_context=ssl_context,
+        heartbeat=60
+    )
+
 def process_message_pre_facial(channel, method, properties, body):
     global last_exec_pre_time_ms
-    conn = get_mysql_connection()
     try:
         start = time.perf_counter()
         message = json.loads(body)
         logger.info(f"Received message: {message}")
 
-        p_key = message["passenger_key"]
-
-        if passenger_exists(conn, p_key):
-            logger.warning(f"Passenger exists : {p_key} - Skipping flight insertion.")
-        else:
-            trace_id = message["trace_id"]
-            logger.info(f"[{trace_id}]  Inserting flight for passenger: {p_key}")
-            insert_flights(conn, message["passenger_key"], trace_id, datetime.strptime(message["departure_date"],"%Y-%m-%d %H:%M"), message["arrival_airport"])
-            conn.commit()
-
+        message_push = pre_facial_stage(message)
+        if message_push:
+            trace_id = message_push["trace_id"]
             logger.info(f"[{trace_id}]  Publishing flight details to {PRODUCE_QUEUE_NAME_PRE_FACIAL}")
-            channel.queue_declare(queue=PRODUCE_QUEUE_NAME_PRE_FACIAL, durable=True)
-            message_push = {
-                "passenger_key": message["passenger_key"],
-                "trace_id": trace_id
-            }
-            body = json.dumps(message)
+            topology.ensure(channel, PRODUCE_QUEUE_NAME_PRE_FACIAL)
+            body = json.dumps(message_push)
             channel.basic_publish(
                 exchange="",
                 routing_key=PRODUCE_QUEUE_NAME_PRE_FACIAL,
@@ -180,42 +234,29 @@ def process_message_pre_facial(channel, method, properties, body):
                 )
             )
             logger.info(f"[{trace_id}]  Flight details written and message published.")
-            conn.commit()
         channel.basic_ack(delivery_tag=method.delivery_tag)  
         duration_ms = (time.perf_counter() - start) * 1000
         last_exec_pre_time_ms = duration_ms
+        stage_latency.record(duration_ms, attributes={"stage": "pre"})
     except Exception as e:
         logger.error(f"Error processing message: {e}")
         channel.basic_nack(
             delivery_tag=method.delivery_tag,
             requeue=True
         )
-    conn.close()
 
 def process_message_post_facial(channel, method, properties, body):
     global last_exec_post_time_ms
-    conn = get_mysql_connection()
     try:
         start = time.perf_counter()
-        message = json.loads(body)
-        p_key = message["passenger_key"]
-        trace_id = message["trace_id"]
-        logger.info(f"Received post facial message for passenger: {p_key}")
-
-        if passenger_exists(conn, p_key):
-            logger.info(f"Passenger exists : {p_key} - fetching flight details.")
-            flight_details = get_flight_details(conn, p_key)
-            logger.info(f"Flight details for passenger {p_key}: {flight_details}")
+        message = facial_codec.unpack(body)
+
+        message_push = post_facial_stage(message)
+        if message_push:
+            trace_id = message_push["trace_id"]
             logger.info(f"Publishing flight details to {PRODUCE_QUEUE_NAME_POST_FACIAL}")
-            channel.queue_declare(queue=PRODUCE_QUEUE_NAME_POST_FACIAL, durable=True)
-            message_push = {
-                "passenger_key": p_key,
-                "trace_id": trace_id,
-                "facial_image": message["facial_image"],
-                "departure_date": flight_details["departure_date"].isoformat(sep=" ", timespec="minutes"),
-                "arrival_airport": flight_details["arrival_airport"]
-            }
-            body = json.dumps(message_push)
+            topology.ensure(channel, PRODUCE_QUEUE_NAME_POST_FACIAL)
+            body = facial_codec.pack(message_push)
             channel.basic_publish(
                 exchange="",
                 routing_key=PRODUCE_QUEUE_NAME_POST_FACIAL,
@@ -225,28 +266,75 @@ def process_message_post_facial(channel, method, properties, body):
                 )
             )
             logger.info(f"[{trace_id}] Flight details published post facial processing with facial data.")
-            conn.commit()
-        else:
-            logger.error(f"Passenger does not exist : {p_key} - cannot fetch flight details.")
         channel.basic_ack(delivery_tag=method.delivery_tag)
         duration_ms = (time.perf_counter() - start) * 1000
-        last_exec_post_time_ms = duration_ms    
+        last_exec_post_time_ms = duration_ms
+        stage_latency.record(duration_ms, attributes={"stage": "post"})
     except Exception as e:
         logger.error(f"Error processing message: {e}")
         channel.basic_nack(
             delivery_tag=method.delivery_tag,
             requeue=True
         )
-    conn.close()
 
-def passenger_exists(conn, passenger_key):
-    logger.debug(f"Checking if passenger exists: {passenger_key}")
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT 1 FROM flights WHERE passenger_key = %s LIMIT 1",
-        (passenger_key,)
-    )
-    return cursor.fetchone() is not None
+async def process_message_pre_facial_async(consumer, message):
+    #consumer_runtime=asyncio counterparts of the two handlers above, AsyncConsumer publishes and acks
+    global last_exec_pre_time_ms
+    start = time.perf_counter()
+    logger.info(f"Received message: {message}")
+    message_push = await consumer.run(pre_facial_stage, message)
+    last_exec_pre_time_ms = (time.perf_counter() - start) * 1000
+    stage_latency.record(last_exec_pre_time_ms, attributes={"stage": "pre"})
+    return [(PRODUCE_QUEUE_NAME_PRE_FACIAL, message_push)] if message_push else []
+
+async def process_message_post_facial_async(consumer, message):
+    global last_exec_post_time_ms
+    start = time.perf_counter()
+    message_push = await consumer.run(post_facial_stage, message)
+    last_exec_post_time_ms = (time.perf_counter() - start) * 1000
+    stage_latency.record(last_exec_post_time_ms, attributes={"stage": "post"})
+    return [(PRODUCE_QUEUE_NAME_POST_FACIAL, message_push)] if message_push else []
+
+def pre_facial_stage(message):
+    #Stage logic shared by the blocking and asyncio runtimes, returns the message to publish or None
+    p_key = message["passenger_key"]
+    trace_id = message["trace_id"]
+    logger.info(f"[{trace_id}]  Inserting flight for passenger: {p_key}")
+
+    conn = get_mysql_connection()
+    try:
+        if not insert_flights(conn, p_key, trace_id, datetime.strptime(message["departure_date"],"%Y-%m-%d %H:%M"), message["arrival_airport"]):
+            conn.rollback()
+            logger.warning(f"Passenger exists : {p_key} - Skipping flight insertion.")
+            return None
+        conn.commit()
+        return message
+    finally:
+        conn.close()
+
+def post_facial_stage(message):
+    #Stage logic shared by the blocking and asyncio runtimes, returns the message to publish or None
+    p_key = message["passenger_key"]
+    trace_id = message["trace_id"]
+    logger.info(f"Received post facial message for passenger: {p_key}")
+
+    conn = get_mysql_connection()
+    try:
+        flight_details = get_flight_details(conn, p_key)
+    finally:
+        conn.close()
+    if not flight_details:
+        logger.error(f"Passenger does not exist : {p_key} - cannot fetch flight details.")
+        return None
+    logger.info(f"Flight details for passenger {p_key}: {flight_details}")
+    return {
+        "passenger_key": p_key,
+        "trace_id": trace_id,
+        #Whatever codec version facial-svc used, passed on without decoding the image
+        **facial_codec.facial_fields(message),
+        "departure_date": flight_details["departure_date"].isoformat(sep=" ", timespec="minutes"),
+        "arrival_airport": flight_details["arrival_airport"]
+    }
 
 def get_flight_details(conn, passenger_key):
     logger.debug(f"Fetching flight details for passenger: {passenger_key}")
@@ -256,6 +344,7 @@ def get_flight_details(conn, passenger_key):
         SELECT departure_date, arrival_airport 
         FROM flights 
         WHERE passenger_key = %s
+        LIMIT 1
         """,
         (passenger_key,)
     )
@@ -265,7 +354,7 @@ def insert_flights(conn, passenger_key, trace_id, departure_date, arrival_airpor
     cursor = conn.cursor()
     cursor.execute(
         """
-        INSERT INTO flights (
+        INSERT IGNORE INTO flights (
             passenger_key,
             departure_date,
             arrival_airport,
@@ -281,48 +370,115 @@ def insert_flights(conn, passenger_key, trace_id, departure_date, arrival_airpor
             trace_id
         )
     )
-    logger.info(f"[{trace_id}] Inserted flight for passenger: {passenger_key}")
+    #0 rows means the passenger already has a flight, another replica may have inserted it
+    if cursor.rowcount == 1:
+        logger.info(f"[{trace_id}] Inserted flight for passenger: {passenger_key}")
+    return cursor.rowcount == 1
 
 def main():
     bootstrap()
+    if worker_processes > 1:
+        logger.info(f"**********Starting flight-svc supervisor with {worker_processes} worker processes**********")
+        supervisor = WorkerSupervisor(run_worker, worker_processes, name="flight-svc", backoff=worker_restart_backoff, backoff_max=worker_restart_backoff_max)
+        register_supervisor_metrics(meter, supervisor)
+        supervisor.run()
+    else:
+        run_service()
+
+def run_worker(worker, stats):
+    #Entry point of a spawned worker process, sets everything up again with its own connections
+    bootstrap(worker)
+    run_service(stats)
+
+def run_service(stats=None):
+    mysql_pool.warm_up()
     logger.info("**********Starting passenger service**********")
 
-    logger.info("Starting SSL RabbitMQ consumer...")
-    global connection, channel 
+    if consumer_runtime == "asyncio":
+        try:
+            asyncio.run(main_async(stats))
+        except KeyboardInterrupt:
+            logger.info("Stopping consumer...")
+        return
+
+    logger.info("Starting SSL RabbitMQ consumers...")
+    consumers = []
+    stages = []
+    register_consumer_metrics(meter, consumers)
+    if stats:
+        stats.track_consumers(consumers)
+
+    stage_threads = [
+        threading.Thread(
+            target=run_stage,
+            args=(CONSUME_QUEUE_NAME_PRE_FACIAL, process_message_pre_facial, pre_facial_workers, pre_facial_prefetch_max, consumers, stages),
+            name="stage-pre-facial",
+            daemon=True
+        ),
+        threading.Thread(
+            target=run_stage,
+            args=(CONSUME_QUEUE_NAME_POST_FACIAL, process_message_post_facial, post_facial_workers, post_facial_prefetch_max, consumers, stages),
+            name="stage-post-facial",
+            daemon=True
+        ),
+    ]
+    for t in stage_threads:
+        t.start()
+
+    failed = False
+    try:
+        logger.info("Waiting for messages. Ctrl+C to exit.")
+        while all(t.is_alive() for t in stage_threads):
+            time.sleep(1)
+        logger.error("A consumer stage stopped unexpectedly - shutting down")
+        failed = True
+    except KeyboardInterrupt:
+        logger.info("Stopping consumer...")
+    finally:
+        for connection, channel in stages:
+            try:
+                connection.add_callback_threadsafe(channel.stop_consuming)
+            except Exception as e:
+                logger.warning(f"Could not stop consumer: {e}")
+        for t in stage_threads:
+            t.join(timeout=60)
+        logger.info(f"Skipped {topology.saved} queue declares, sent {topology.declares}")
+    if failed:
+        sys.exit(1)
+
+def run_stage(queue, handler, workers, stage_prefetch_max, consumers, stages):
+    #One stage = its own connection, IO thread, channel, worker pool and prefetch. Large post-facial
+    #deliveries then never queue in front of pre-facial ones, not even on the socket.
     connection = get_rmq_connection()
     channel = connection.channel()
+    consumer = ThreadedConsumer(connection, channel, workers, name=queue, prefetch_min=workers, prefetch_max=stage_prefetch_max, prefetch_max_bytes=prefetch_max_bytes, tune_interval=prefetch_tune_interval)
+    consumers.append(consumer)
+    stages.append((connection, channel))
+    #Declared through the wrapped channel the workers publish on, so ensure() finds them
+    topology.declare_all(consumer.channel)
 
-    logger.info(f"Declaring queue {CONSUME_QUEUE_NAME_PRE_FACIAL}")
-    channel.queue_declare(queue=CONSUME_QUEUE_NAME_PRE_FACIAL, durable=True)
-    channel.queue_declare(queue=CONSUME_QUEUE_NAME_POST_FACIAL, durable=True)
-    channel.basic_qos(prefetch_count=1)
-
-    logger.info(f"Consuming messages from {CONSUME_QUEUE_NAME_PRE_FACIAL}")
-
-    channel.basic_consume(
-        queue=CONSUME_QUEUE_NAME_PRE_FACIAL,
-        on_message_callback=process_message_pre_facial,
-        auto_ack=False
-    )
-
-    logger.info(f"Consuming messages from {CONSUME_QUEUE_NAME_POST_FACIAL}")
-
+    logger.info(f"Consuming messages from {queue} on {workers} worker thread(s)")
     channel.basic_consume(
-        queue=CONSUME_QUEUE_NAME_POST_FACIAL,
-        on_message_callback=process_message_post_facial,
+        queue=queue,
+        on_message_callback=consumer.wrap(handler),
         auto_ack=False
     )
-
     try:
-        logger.info("Waiting for messages. Ctrl+C to exit.")
         channel.start_consuming()
-
-    except KeyboardInterrupt:
-        logger.info("Stopping consumer...")
     finally:
-        channel.stop_consuming()
+        consumer.drain()
         connection.close()
 
+async def main_async(stats=None):
+    logger.info(f"Starting asyncio RabbitMQ consumer - up to {async_max_in_flight} messages in flight")
+    consumer = AsyncConsumer(get_rmq_connection_async, topology.queues, max_in_flight=async_max_in_flight, db_threads=mysql_pool.size, unpack=facial_codec.unpack, pack=facial_codec.pack)
+    register_consumer_metrics(meter, [consumer])
+    if stats:
+        stats.track_consumers([consumer])
+    consumer.consume(CONSUME_QUEUE_NAME_PRE_FACIAL, process_message_pre_facial_async)
+    consumer.consume(CONSUME_QUEUE_NAME_POST_FACIAL, process_message_post_facial_async)
+    await consumer.serve()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
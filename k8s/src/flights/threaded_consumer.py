@@ -0,0 +1,205 @@
+import math
+import time
+import logging
+import threading
+import functools
+import concurrent.futures
+from opentelemetry import metrics
+
+#Runs a service's process_message(channel, method, properties, body) on a pool of worker threads
+#instead of pika's connection thread, so a pod waits on several MySQL/HTTP calls at once and the
+#connection thread is free to answer heartbeats. pika's BlockingConnection is not thread safe -
+#handlers get a ThreadSafeChannel that hands publishes, declares, acks and nacks back to the
+#connection thread with add_callback_threadsafe.
+#Prefetch starts at the number of workers and is then tuned by PrefetchTuner between
+#prefetch_min and prefetch_max, one consumer per channel since basic_qos applies to the channel.
+
+logger = logging.getLogger(__name__)
+
+CALL_TIMEOUT_S = 30
+
+class ThreadSafeChannel:
+    def __init__(self, connection, channel):
+        #Must be created on the connection thread
+        self._connection = connection
+        self._channel = channel
+        self._io_thread = threading.get_ident()
+
+    def _call(self, fn, *args, wait=True, **kwargs):
+        if threading.get_ident() == self._io_thread:
+            return fn(*args, **kwargs)
+        if not wait:
+            self._connection.add_callback_threadsafe(functools.partial(fn, *args, **kwargs))
+            return None
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+        self._connection.add_callback_threadsafe(run)
+        return future.result(timeout=CALL_TIMEOUT_S)
+
+    def basic_publish(self, *args, **kwargs):
+        #Waits so a failed publish still raises in the handler and the message gets nacked
+        return self._call(self._channel.basic_publish, *args, **kwargs)
+
+    def queue_declare(self, *args, **kwargs):
+        return self._call(self._channel.queue_declare, *args, **kwargs)
+
+    def basic_ack(self, *args, **kwargs):
+        self._call(self._channel.basic_ack, *args, wait=False, **kwargs)
+
+    def basic_nack(self, *args, **kwargs):
+        self._call(self._channel.basic_nack, *args, wait=False, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+class PrefetchTuner:
+    #Little's law for one channel: while a worker handles a message for proc_ms, the ack of the
+    #previous one and the delivery of the next take a broker round trip. Keeping
+    #workers * (1 + rtt/proc) messages prefetched means no worker waits on the network, anything
+    #above that only sits in memory. max_bytes caps it for large bodies such as facial images.
+    def __init__(self, workers, minimum, maximum, max_bytes, alpha=0.2):
+        self.workers = workers
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.max_bytes = max_bytes
+        self.alpha = alpha
+        self.proc_ms = None
+        self.rtt_ms = None
+        self.body_bytes = None
+
+    def _ewma(self, current, sample):
+        return sample if current is None else current + self.alpha * (sample - current)
+
+    def observe_message(self, proc_ms, size):
+        self.proc_ms = self._ewma(self.proc_ms, proc_ms)
+        self.body_bytes = self._ewma(self.body_bytes, size)
+
+    def observe_rtt(self, rtt_ms):
+        self.rtt_ms = self._ewma(self.rtt_ms, rtt_ms)
+
+    def initial(self):
+        return max(self.minimum, min(self.maximum, self.workers))
+
+    def target(self):
+        if self.proc_ms is None or self.rtt_ms is None:
+            return self.initial()
+        want = math.ceil(self.workers * (1 + self.rtt_ms / max(self.proc_ms, 0.1)))
+        if self.body_bytes:
+            want = min(want, int(self.max_bytes // max(self.body_bytes, 1)))
+        return max(self.minimum, min(self.maximum, want))
+
+class ThreadedConsumer:
+    def __init__(self, connection, channel, workers, name="consumer", prefetch_min=None, prefetch_max=None, prefetch_max_bytes=64 * 1024 * 1024, tune_interval=5):
+        self.connection = connection
+        self.channel = ThreadSafeChannel(connection, channel)
+        self.workers = workers
+        self.name = name
+        self._raw_channel = channel
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"consumer-{name}")
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.processed = 0
+        self.last_queue_wait_ms = 0.0
+        self.tuner = PrefetchTuner(workers, prefetch_min or workers, prefetch_max or workers, prefetch_max_bytes)
+        self.tune_interval = tune_interval
+        self.prefetch = None
+        self._set_prefetch(self.tuner.initial())
+        if self.tuner.maximum > self.tuner.minimum:
+            connection.call_later(tune_interval, self._tune)
+
+    def _set_prefetch(self, prefetch):
+        #basic_qos waits for Qos-Ok, so timing it gives the broker round trip for free
+        start = time.perf_counter()
+        self._raw_channel.basic_qos(prefetch_count=prefetch)
+        self.tuner.observe_rtt((time.perf_counter() - start) * 1000)
+        self.prefetch = prefetch
+
+    def _tune(self):
+        #Runs on the connection thread through call_later, re-sent even when unchanged to keep sampling the RTT
+        if not self._raw_channel.is_open:
+            return
+        target = self.tuner.target()
+        if target != self.prefetch:
+            logger.info(f"Prefetch for {self.name} {self.prefetch} -> {target} (processing {self.tuner.proc_ms:.1f}ms, broker RTT {self.tuner.rtt_ms:.1f}ms)")
+        self._set_prefetch(target)
+        self.connection.call_later(self.tune_interval, self._tune)
+
+    def wrap(self, handler):
+        #Returns an on_message_callback for basic_consume that runs handler on the pool
+        def on_message(channel, method, properties, body):
+            with self._lock:
+                self.in_flight += 1
+            self._executor.submit(self._run, handler, method, properties, body, time.perf_counter())
+        return on_message
+
+    def _run(self, handler, method, properties, body, received):
+        start = time.perf_counter()
+        self.last_queue_wait_ms = (start - received) * 1000
+        try:
+            handler(self.channel, method, properties, body)
+            self.tuner.observe_message((time.perf_counter() - start) * 1000, len(body))
+        except Exception as e:
+            #Handlers ack/nack themselves, this only catches what escaped them
+            logger.error(f"Unhandled error in consumer worker: {e}")
+            self.channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.processed += 1
+
+    def drain(self, timeout=30):
+        #Call on the connection thread after stop_consuming, keeps the connection serving the
+        #workers' publishes and acks until they are done
+        deadline = time.perf_counter() + timeout
+        while self.in_flight and time.perf_counter() < deadline:
+            self.connection.process_data_events(time_limit=0.1)
+        if self.in_flight:
+            logger.warning(f"Stopping with {self.in_flight} message(s) still in flight, they will be redelivered")
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+def register_consumer_metrics(meter, consumers):
+    def in_flight_callback(options):
+        return [metrics.Observation(c.in_flight, attributes={"consumer": c.name}) for c in consumers]
+
+    def queue_wait_callback(options):
+        return [metrics.Observation(c.last_queue_wait_ms, attributes={"consumer": c.name}) for c in consumers]
+
+    def prefetch_callback(options):
+        return [metrics.Observation(c.prefetch, attributes={"consumer": c.name}) for c in consumers]
+
+    def rtt_callback(options):
+        return [
+            metrics.Observation(c.tuner.rtt_ms, attributes={"consumer": c.name})
+            for c in consumers if getattr(c, "tuner", None) and c.tuner.rtt_ms is not None
+        ]
+
+    meter.create_observable_gauge(
+        "application.consumer.in_flight",
+        unit="{message}",
+        description="Messages being processed by consumer worker threads",
+        callbacks=[in_flight_callback]
+    )
+    meter.create_observable_gauge(
+        "application.consumer.queue_wait",
+        unit="ms",
+        description="Time the last message waited between delivery and a worker picking it up",
+        callbacks=[queue_wait_callback]
+    )
+    meter.create_observable_gauge(
+        "application.consumer.prefetch",
+        unit="{message}",
+        description="Prefetch count currently set on the consumer's channel",
+        callbacks=[prefetch_callback]
+    )
+    meter.create_observable_gauge(
+        "application.consumer.broker_rtt",
+        unit="ms",
+        description="Smoothed broker round trip measured on basic_qos, used to size prefetch",
+        callbacks=[rtt_callback]
+    )
@@ -7,6 +7,9 @@ import hmac
 import hashlib
 import base64
 import mysql.connector
+from mysql_pool import MySQLPool, register_pool_metrics
+from blob_store import BlobStore, register_blob_store_metrics
+from claim_check import open_store, register_claim_check_metrics
 import uuid
 import logging
 import requests
@@ -25,7 +28,7 @@ from opentelemetry.semconv.resource import ResourceAttributes
 
 def bootstrap():
     #Environment variables
-    global ca_cert, secret_key, mysql_url, mysql_port, mysql_user, mysql_password, mysql_db, logdir, loglvl, mysql_db_s1, mysql_db_s2, mysql_db_s3, check_in_interval, delete_orchestrator_interval, logger, publish_exec_time, last_exec_time_ms
+    global ca_cert, secret_key, mysql_url, mysql_port, mysql_user, mysql_password, mysql_db, logdir, loglvl, mysql_db_s1, mysql_db_s2, mysql_db_s3, check_in_interval, delete_orchestrator_interval, logger, publish_exec_time, last_exec_time_ms, mysql_pools, blob_store, blob_grace, claim_store, claim_check_retention
     ca_cert = os.environ.get("CA_PATH")
     mysql_url = os.environ.get("MYSQL_HOST")
     mysql_port = int(os.environ.get("MYSQL_PORT"))
@@ -35,10 +38,20 @@ def bootstrap():
     mysql_db_s1 = os.environ.get("MYSQL_DB_SATELLITE1")
     mysql_db_s2 = os.environ.get("MYSQL_DB_SATELLITE2")
     mysql_db_s3 = os.environ.get("MYSQL_DB_SATELLITE3")
+    mysql_pool_size = int(os.environ.get("mysql_pool_size", "4"))
+    mysql_pool_warm = int(os.environ.get("mysql_pool_warm", "2"))
+    mysql_pool_max_lifetime = int(os.environ.get("mysql_pool_max_lifetime_s", "1800"))
+    mysql_pool_ping_after = int(os.environ.get("mysql_pool_ping_after_s", "30"))
     logdir = os.environ.get("log_directory", ".")
     loglvl = os.environ.get("log_level", "INFO").upper()
     check_in_interval = int(os.environ.get("check_in_interval", "60"))
     delete_orchestrator_interval = int(os.environ.get("delete_orchestrator_interval", "300"))
+    facial_dir = os.environ.get("FACIAL_DIR")
+    #Unlinked images younger than this may still be waiting in facial-svc's warm pool
+    blob_grace = int(os.environ.get("facial_store_grace_s", "3600"))
+    claim_check_url = os.environ.get("claim_check_url")
+    #Claim checked images not put again for this long have long been read by their satellite
+    claim_check_retention = int(os.environ.get("claim_check_retention_s", "86400"))
     otel_service_name = "housekeep"
     otel_exporter_endpoint = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
     otel_exporter_interval = int(os.environ.get("OTEL_EXPORT_INTERVAL"))
@@ -95,13 +108,35 @@ def bootstrap():
         callbacks=[exec_time_callback]
     )
 
-def get_mysql_connection():
+    #MySQL connection pools, one per database
+    mysql_pools = {
+        "hq": MySQLPool("hq", lambda db=mysql_db: connect_mysql(db), size=mysql_pool_size, warm=mysql_pool_warm, max_lifetime=mysql_pool_max_lifetime, ping_after=mysql_pool_ping_after),
+        "s1": MySQLPool("s1", lambda db=mysql_db_s1: connect_mysql(db), size=mysql_pool_size, warm=mysql_pool_warm, max_lifetime=mysql_pool_max_lifetime, ping_after=mysql_pool_ping_after),
+        "s2": MySQLPool("s2", lambda db=mysql_db_s2: connect_mysql(db), size=mysql_pool_size, warm=mysql_pool_warm, max_lifetime=mysql_pool_max_lifetime, ping_after=mysql_pool_ping_after),
+        "s3": MySQLPool("s3", lambda db=mysql_db_s3: connect_mysql(db), size=mysql_pool_size, warm=mysql_pool_warm, max_lifetime=mysql_pool_max_lifetime, ping_after=mysql_pool_ping_after),
+    }
+    register_pool_metrics(meter, list(mysql_pools.values()))
+
+    #facial-svc's on-disk image store, shared through FACIAL_DIR
+    blob_store = None
+    if facial_dir:
+        blob_store = BlobStore(facial_dir)
+        register_blob_store_metrics(meter, blob_store)
+
+    #Claim check store shared by facial-svc and the satellites
+    claim_store = None
+    if claim_check_url:
+        claim_store = open_store(claim_check_url)
+        register_claim_check_metrics(meter, claim_store)
+
+def connect_mysql(database):
+    #Opens a new connection, everything else goes through the pool
     return mysql.connector.connect(
         host=mysql_url,
         port=mysql_port,
         user=mysql_user,
         password=mysql_password,
-        database=mysql_db,
+        database=database,
 
         ssl_ca=ca_cert,
         ssl_verify_cert=True,
@@ -110,50 +145,17 @@ def get_mysql_connection():
         autocommit=False
     )
 
-def get_mysql_connection_s1():
-    return mysql.connector.connect(
-        host=mysql_url,
-        port=mysql_port,
-        user=mysql_user,
-        password=mysql_password,
-        database=mysql_db_s1,
-
-        ssl_ca=ca_cert,
-        ssl_verify_cert=True,
-        ssl_verify_identity=True,  
+def get_mysql_connection():
+    return mysql_pools["hq"].get()
 
-        autocommit=False
-    )
+def get_mysql_connection_s1():
+    return mysql_pools["s1"].get()
 
 def get_mysql_connection_s2():
-    return mysql.connector.connect(
-        host=mysql_url,
-        port=mysql_port,
-        user=mysql_user,
-        password=mysql_password,
-        database=mysql_db_s2,
-
-        ssl_ca=ca_cert,
-        ssl_verify_cert=True,
-        ssl_verify_identity=True,  
-
-        autocommit=False
-    )
+    return mysql_pools["s2"].get()
 
 def get_mysql_connection_s3():
-    return mysql.connector.connect(
-        host=mysql_url,
-        port=mysql_port,
-        user=mysql_user,
-        password=mysql_password,
-        database=mysql_db_s3,
-
-        ssl_ca=ca_cert,
-        ssl_verify_cert=True,
-        ssl_verify_identity=True,  
-
-        autocommit=False
-    )
+    return mysql_pools["s3"].get()
 
 def soft_delete_by_departure_dates():
     conn = get_mysql_connection()
@@ -229,6 +231,34 @@ def satellite_delete():
     conn.close()
     logger.info("Deleted orphaned records from satellite databases.")
 
+def facial_files_delete():
+    #hard delete stored facial images of passengers no longer in the facial table
+    logger.info("[facial_files_delete] Starting clean up of orphaned facial images in the blob store.")
+    keys = blob_store.keys()
+    conn = get_mysql_connection()
+    cursor = conn.cursor()
+    #Load the passenger keys of the index into a temp table and left join it against facial
+    cursor.execute("CREATE TEMPORARY TABLE facial_files (passenger_key VARCHAR(255) PRIMARY KEY)")
+    for i in range(0, len(keys), 1000):
+        cursor.executemany("INSERT INTO facial_files (passenger_key) VALUES (%s)", [(key,) for key in keys[i:i + 1000]])
+    cursor.execute("SELECT ff.passenger_key FROM facial_files AS ff LEFT JOIN facial ON ff.passenger_key = facial.passenger_key WHERE facial.passenger_key IS NULL")
+    orphaned = [row[0] for row in cursor.fetchall()]
+    cursor.execute("DROP TEMPORARY TABLE facial_files")
+    cursor.close()
+    conn.close()
+
+    for key in orphaned:
+        blob_store.unlink(key)
+    logger.info(f"[facial_files_delete] Removed {len(orphaned)} of {len(keys)} index entries from the blob store.")
+    removed = blob_store.prune(blob_grace)
+    logger.info(f"[facial_files_delete] Removed {removed} unreferenced image(s) from the blob store.")
+
+def claim_check_delete():
+    #hard delete claim checked images past their retention
+    logger.info("[claim_check_delete] Starting clean up of the claim check store.")
+    removed = claim_store.prune(claim_check_retention)
+    logger.info(f"[claim_check_delete] Removed {removed} image(s) older than {claim_check_retention}s from the claim check store.")
+
 def houskeep_orchestrator():
     global last_exec_time_ms
     while True:
@@ -236,16 +266,18 @@ def houskeep_orchestrator():
         flights_delete()
         satellite_delete()
         facial_n_passenger_delete()
-        #orphaned biom detail in file system clean up can be added here
-        #create temp table and load the list of file names (which is p_keys) and remove the .b64 string from the names. 
-        #perform left join and see which is missing
-        #do an os remove on those files
+        if blob_store:
+            facial_files_delete()
+        if claim_store:
+            claim_check_delete()
         duration_ms = (time.perf_counter() - start) * 1000
         last_exec_time_ms = duration_ms
         time.sleep(delete_orchestrator_interval)
 
 def main():
     bootstrap()
+    #The cleanup queries reach the satellite schemas through hq, s1-s3 only open connections on demand
+    mysql_pools["hq"].warm_up()
     logger.info("**********Starting housekeep service**********")
 
     logger.info("Starting background threads for housekeeping tasks.")
@@ -0,0 +1,220 @@
+import time
+import logging
+import threading
+import collections
+import mysql.connector
+from opentelemetry import metrics
+
+#Pool of MySQL connections behind the get_mysql_connection* functions of a service. Opening a
+#connection costs a TLS handshake plus auth, far more than the queries a message runs, so
+#connections are opened once and reused. Callers keep the old pattern - conn = get_mysql_connection()
+#... conn.close() - close() hands the connection back instead of closing it.
+#  warm         connections opened at startup by warm_up()
+#  max_lifetime seconds before a connection is closed and replaced, spreads reconnects over time
+#  ping_after   connections idle for longer are pinged before being handed out, dead ones replaced
+#  timeout      seconds get() waits for a free connection before raising PoolError
+
+logger = logging.getLogger(__name__)
+
+class MySQLPool:
+    def __init__(self, name, connect, size=4, warm=2, max_lifetime=1800, ping_after=30, timeout=10):
+        self.name = name
+        self.connect = connect
+        self.size = size
+        self.warm = min(warm, size)
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+        self.timeout = timeout
+        self._idle = collections.deque()
+        self._open = 0
+        self._cond = threading.Condition()
+        self.in_use = 0
+        self.created = 0
+        self.recycled = 0
+        self.broken = 0
+        self.last_wait_ms = 0.0
+
+    def warm_up(self):
+        start = time.perf_counter()
+        entries = []
+        for _ in range(self.warm):
+            with self._cond:
+                if self._open >= self.size:
+                    break
+                self._open += 1
+            try:
+                entries.append(self._new())
+            except mysql.connector.Error as e:
+                with self._cond:
+                    self._open -= 1
+                logger.warning(f"MySQL pool {self.name} warm-up failed, connections will be opened on demand: {e}")
+                break
+        with self._cond:
+            self._idle.extend(entries)
+            self._cond.notify_all()
+        logger.info(f"MySQL pool {self.name} warmed up {len(entries)} connection(s) in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    def get(self):
+        start = time.perf_counter()
+        deadline = start + self.timeout
+        entry = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    #Most recently used first, idle connections at the other end age out
+                    entry = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    break
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise mysql.connector.errors.PoolError(
+                        f"MySQL pool {self.name} exhausted, {self.size} connections in use for {self.timeout}s"
+                    )
+                self._cond.wait(remaining)
+            self.in_use += 1
+        try:
+            entry = self._new() if entry is None else self._check(entry)
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self.in_use -= 1
+                self._cond.notify()
+            raise
+        self.last_wait_ms = (time.perf_counter() - start) * 1000
+        return PooledConnection(self, entry)
+
+    def _new(self):
+        raw = self.connect()
+        with self._cond:
+            self.created += 1
+        now = time.monotonic()
+        return raw, now, now
+
+    def _check(self, entry):
+        raw, created_at, last_used = entry
+        now = time.monotonic()
+        if now - created_at >= self.max_lifetime:
+            with self._cond:
+                self.recycled += 1
+            self._discard(raw)
+            return self._new()
+        if now - last_used >= self.ping_after:
+            try:
+                raw.ping(reconnect=False)
+            except mysql.connector.Error as e:
+                logger.warning(f"MySQL pool {self.name} dropping dead connection: {e}")
+                with self._cond:
+                    self.broken += 1
+                self._discard(raw)
+                return self._new()
+        return entry
+
+    def _release(self, entry):
+        raw, created_at, _ = entry
+        keep = time.monotonic() - created_at < self.max_lifetime
+        recycled, broken = not keep, False
+        if keep:
+            try:
+                #Never hand out a connection with a pending result, in the middle of a transaction or an old read snapshot
+                if raw.unread_result:
+                    raw.consume_results()
+                if raw.in_transaction:
+                    raw.rollback()
+            except mysql.connector.Error:
+                broken = True
+                keep = False
+        if not keep:
+            self._discard(raw)
+        with self._cond:
+            self.recycled += recycled
+            self.broken += broken
+            self.in_use -= 1
+            if keep:
+                self._idle.append((raw, created_at, time.monotonic()))
+            else:
+                self._open -= 1
+            self._cond.notify()
+
+    def _discard(self, raw):
+        try:
+            raw.close()
+        except mysql.connector.Error:
+            pass
+
+    def close(self):
+        with self._cond:
+            idle, self._idle = self._idle, collections.deque()
+            self._open -= len(idle)
+        for raw, _, _ in idle:
+            self._discard(raw)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "open": self._open,
+                "idle": len(self._idle),
+                "in_use": self.in_use,
+                "created": self.created,
+                "recycled": self.recycled,
+                "broken": self.broken,
+                "last_wait_ms": self.last_wait_ms,
+            }
+
+class PooledConnection:
+    #Stands in for a mysql.connector connection, close() returns it to the pool
+    __slots__ = ("_pool", "_entry")
+
+    def __init__(self, pool, entry):
+        self._pool = pool
+        self._entry = entry
+
+    def __getattr__(self, name):
+        if self._entry is None:
+            raise mysql.connector.errors.OperationalError("Connection was returned to the pool")
+        return getattr(self._entry[0], name)
+
+    def close(self):
+        if self._entry is not None:
+            entry, self._entry = self._entry, None
+            self._pool._release(entry)
+
+def register_pool_metrics(meter, pools):
+    def in_use_callback(options):
+        return [metrics.Observation(p.in_use, attributes={"pool": p.name}) for p in pools]
+
+    def idle_callback(options):
+        return [metrics.Observation(len(p._idle), attributes={"pool": p.name}) for p in pools]
+
+    def wait_callback(options):
+        return [metrics.Observation(p.last_wait_ms, attributes={"pool": p.name}) for p in pools]
+
+    def created_callback(options):
+        return [metrics.Observation(p.created, attributes={"pool": p.name}) for p in pools]
+
+    meter.create_observable_gauge(
+        "application.db.pool.in_use",
+        unit="{connection}",
+        description="MySQL connections handed out by the pool",
+        callbacks=[in_use_callback]
+    )
+    meter.create_observable_gauge(
+        "application.db.pool.idle",
+        unit="{connection}",
+        description="Open MySQL connections waiting in the pool",
+        callbacks=[idle_callback]
+    )
+    meter.create_observable_gauge(
+        "application.db.pool.wait_time",
+        unit="ms",
+        description="Time the last checkout waited for a connection, including any ping or reconnect",
+        callbacks=[wait_callback]
+    )
+    meter.create_observable_counter(
+        "application.db.pool.connections_created",
+        unit="{connection}",
+        description="MySQL connections opened by the pool, rises with recycling and broken connections",
+        callbacks=[created_callback]
+    )
@@ -0,0 +1,121 @@
+import json
+import time
+import asyncio
+import logging
+import functools
+import contextlib
+import concurrent.futures
+import aio_pika
+
+#asyncio alternative to the blocking pika main loop, picked with consumer_runtime=asyncio. One
+#process keeps up to max_in_flight messages open on an aio-pika channel instead of one per thread.
+#Handlers are coroutines - handler(consumer, message) -> [(queue, message), ...] - and reuse the
+#same stage functions as the blocking process_message. Blocking MySQL calls go through
+#consumer.run() on a small executor, db_threads should match the MySQL pool size. Publishes use
+#publisher confirms and the delivery is only acked once every publish for it is confirmed.
+#Bodies are JSON unless the service passes its own unpack(body) -> message and pack(message) -> bytes.
+
+logger = logging.getLogger(__name__)
+
+DRAIN_TIMEOUT_S = 30
+
+class AsyncConsumer:
+    def __init__(self, connect, queues, max_in_flight=200, db_threads=4, unpack=json.loads, pack=None):
+        self.connect = connect
+        self.queues = list(queues)
+        self.max_in_flight = max_in_flight
+        self.name = "asyncio"
+        self.prefetch = max_in_flight
+        self.db_threads = db_threads
+        self.unpack = unpack
+        self.pack = pack or (lambda message: json.dumps(message).encode("utf-8"))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=db_threads, thread_name_prefix="db")
+        self._handlers = []
+        self._db_slots = None
+        self._consumers = []
+        self.connection = None
+        self.channel = None
+        self.in_flight = 0
+        self.processed = 0
+        self.last_queue_wait_ms = 0.0
+
+    def consume(self, queue, handler):
+        self._handlers.append((queue, handler))
+
+    async def run(self, fn, *args):
+        #Runs blocking work on the executor, last_queue_wait_ms is how long it waited for a thread
+        submitted = time.perf_counter()
+
+        def timed():
+            self.last_queue_wait_ms = (time.perf_counter() - submitted) * 1000
+            return fn(*args)
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, timed)
+
+    @contextlib.asynccontextmanager
+    async def mysql_connection(self, get_connection):
+        #Waits for a free slot on the event loop rather than in pool.get(), which would time out
+        #with hundreds of messages queued behind a handful of connections
+        async with self._db_slots:
+            conn = await self.run(get_connection)
+            try:
+                yield conn
+            finally:
+                await self.run(conn.close)
+
+    async def publish(self, queue, message):
+        await self.channel.default_exchange.publish(
+            aio_pika.Message(
+                body=self.pack(message),
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT
+            ),
+            routing_key=queue
+        )
+
+    async def _on_message(self, handler, delivery):
+        self.in_flight += 1
+        try:
+            message = self.unpack(delivery.body)
+            for queue, out in await handler(self, message):
+                await self.publish(queue, out)
+            await delivery.ack()
+        except Exception as e:
+            logger.error(f"Error processing message: {e}")
+            await delivery.nack(requeue=True)
+        finally:
+            self.in_flight -= 1
+            self.processed += 1
+
+    async def serve(self):
+        self._db_slots = asyncio.Semaphore(self.db_threads)
+        self.connection = await self.connect()
+        self.channel = await self.connection.channel(publisher_confirms=True)
+        await self.channel.set_qos(prefetch_count=self.max_in_flight)
+
+        declared = {}
+        for queue in self.queues:
+            logger.info(f"Declaring queue {queue}")
+            declared[queue] = await self.channel.declare_queue(queue, durable=True)
+        for queue, handler in self._handlers:
+            logger.info(f"Consuming messages from {queue}")
+            tag = await declared[queue].consume(functools.partial(self._on_message, handler))
+            self._consumers.append((declared[queue], tag))
+
+        try:
+            await asyncio.Future()
+        finally:
+            await self.close()
+
+    async def close(self):
+        #Stop taking deliveries, give in-flight messages time to finish, unfinished ones are redelivered
+        if self.channel is not None and not self.channel.is_closed:
+            for queue, tag in self._consumers:
+                await queue.cancel(tag)
+        deadline = time.perf_counter() + DRAIN_TIMEOUT_S
+        while self.in_flight and time.perf_counter() < deadline:
+            await asyncio.sleep(0.1)
+        if self.in_flight:
+            logger.warning(f"Stopping with {self.in_flight} message(s) still in flight, they will be redelivered")
+        if self.connection is not None:
+            await self.connection.close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -2,12 +2,20 @@ import json
 import sys
 import ssl
 import pika
+import aio_pika
+import asyncio
 import os
+import socket
 import hmac
 import hashlib
 import time
 import base64
 import mysql.connector
+from mysql_pool import MySQLPool, register_pool_metrics
+from queue_topology import QueueTopology, register_topology_metrics
+from threaded_consumer import ThreadedConsumer, register_consumer_metrics
+from async_consumer import AsyncConsumer
+from worker_supervisor import WorkerSupervisor, register_supervisor_metrics
 import uuid
 import logging
 from opentelemetry import metrics
@@ -17,9 +25,9 @@ from opentelemetry.sdk.resources import Resource
 from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
 from opentelemetry.semconv.resource import ResourceAttributes
 
-def bootstrap():
+def bootstrap(worker=None):
     #Environment variables
-    global rmq_url, rmq_port, rmq_username, rmq_password, ca_cert, secret_key, mysql_url, mysql_port, mysql_user, mysql_password, mysql_db, CONSUME_QUEUE_NAME, PRODUCE_QUEUE_NAME, logdir, loglvl, logger, publish_exec_time, last_exec_time_ms
+    global rmq_url, rmq_port, rmq_username, rmq_password, ca_cert, secret_key, mysql_url, mysql_port, mysql_user, mysql_password, mysql_db, CONSUME_QUEUE_NAME, PRODUCE_QUEUE_NAME, logdir, loglvl, logger, publish_exec_time, last_exec_time_ms, mysql_pool, batch_size, batch_wait, consume_batch_size, last_batch_size, topology, consumer_workers, meter, consumer_runtime, async_max_in_flight, worker_processes, worker_restart_backoff, worker_restart_backoff_max, prefetch_min, prefetch_max, prefetch_max_bytes, prefetch_tune_interval
     rmq_url = os.environ.get("RMQ_HOST")
     rmq_port = int(os.environ.get("RMQ_PORT"))
     rmq_username = os.environ.get("RMQ_USER")
@@ -31,8 +39,26 @@ def bootstrap():
     mysql_user = os.environ.get("MYSQL_USER")
     mysql_password = os.environ.get("MYSQL_PW")
     mysql_db = os.environ.get("MYSQL_DB")
+    consumer_runtime = os.environ.get("consumer_runtime", "blocking").lower()
+    consumer_workers = int(os.environ.get("consumer_workers", "1"))
+    prefetch_min = int(os.environ.get("prefetch_min", str(consumer_workers)))
+    prefetch_max = int(os.environ.get("prefetch_max", str(consumer_workers * 4)))
+    prefetch_max_bytes = int(os.environ.get("prefetch_max_bytes", str(64 * 1024 * 1024)))
+    prefetch_tune_interval = float(os.environ.get("prefetch_tune_interval_s", "5"))
+    async_max_in_flight = int(os.environ.get("async_max_in_flight", "200"))
+    worker_processes = int(os.environ.get("worker_processes", "1"))
+    worker_restart_backoff = float(os.environ.get("worker_restart_backoff_s", "1"))
+    worker_restart_backoff_max = float(os.environ.get("worker_restart_backoff_max_s", "60"))
+    mysql_pool_size = int(os.environ.get("mysql_pool_size", str(max(4, consumer_workers))))
+    mysql_pool_warm = int(os.environ.get("mysql_pool_warm", "2"))
+    mysql_pool_max_lifetime = int(os.environ.get("mysql_pool_max_lifetime_s", "1800"))
+    mysql_pool_ping_after = int(os.environ.get("mysql_pool_ping_after_s", "30"))
     CONSUME_QUEUE_NAME = "source_data_intake"
     PRODUCE_QUEUE_NAME = "source_data_passenger"
+    #batch_size > 1 prefetches that many messages and inserts them with one multi-row INSERT IGNORE and one commit,
+    #plus a SELECT of the batch's trace IDs only when some passengers already existed
+    batch_size = int(os.environ.get("batch_size", "1"))
+    batch_wait = int(os.environ.get("batch_wait_ms", "50")) / 1000
     logdir = os.environ.get("log_directory", ".")
     loglvl = os.environ.get("log_level", "INFO").upper()
     otel_service_name = "passenger-svc"
@@ -40,6 +66,7 @@ def bootstrap():
     otel_exporter_interval = int(os.environ.get("OTEL_EXPORT_INTERVAL"))
     release_version = os.environ.get("release_version")
     last_exec_time_ms = 0.0
+    last_batch_size = 0
 
     #logging 
     log_level = getattr(logging, loglvl, logging.INFO)
@@ -61,10 +88,14 @@ def bootstrap():
     logger.addHandler(file_handler)
 
     #OTEL setup
-    resource = Resource.create({
+    resource_attributes = {
         "service.name": otel_service_name,
         "service.version": release_version,
-    })
+    }
+    if worker_processes > 1:
+        #The supervisor and every worker process export on their own, tell them apart by instance
+        resource_attributes["service.instance.id"] = f"{socket.gethostname()}-{'supervisor' if worker is None else f'w{worker}'}"
+    resource = Resource.create(resource_attributes)
 
     metric_reader = PeriodicExportingMetricReader(
     OTLPMetricExporter(endpoint=otel_exporter_endpoint, insecure=True),
@@ -91,6 +122,24 @@ def bootstrap():
         callbacks=[exec_time_callback]
     )
 
+    def batch_size_callback(options):
+        return [metrics.Observation(last_batch_size)]
+
+    consume_batch_size = meter.create_observable_gauge(
+        "application.batch.size",
+        unit="{message}",
+        description="Messages handled together in the last batch when batch_size > 1",
+        callbacks=[batch_size_callback]
+    )
+
+    #MySQL connection pool
+    mysql_pool = MySQLPool("hq", lambda: connect_mysql(mysql_db), size=mysql_pool_size, warm=mysql_pool_warm, max_lifetime=mysql_pool_max_lifetime, ping_after=mysql_pool_ping_after)
+    register_pool_metrics(meter, [mysql_pool])
+
+    #Queues this service consumes from and publishes to, declared once per channel
+    topology = QueueTopology([CONSUME_QUEUE_NAME, PRODUCE_QUEUE_NAME])
+    register_topology_metrics(meter, topology)
+
 def get_rmq_connection():
     credentials = pika.PlainCredentials(
         rmq_username,
@@ -117,13 +166,29 @@ def get_rmq_connection():
 
     return pika.BlockingConnection(params)
 
-def get_mysql_connection():
+async def get_rmq_connection_async():
+    ssl_context = ssl.create_default_context(cafile=ca_cert)
+    ssl_context.check_hostname = True
+    ssl_context.verify_mode = ssl.CERT_REQUIRED
+
+    return await aio_pika.connect_robust(
+        host=rmq_url,
+        port=rmq_port,
+        login=rmq_username,
+        password=rmq_password,
+        ssl=True,
+        ssl_context=ssl_context,
+        heartbeat=60
+    )
+
+def connect_mysql(database):
+    #Opens a new connection, everything else goes through the pool
     return mysql.connector.connect(
         host=mysql_url,
         port=mysql_port,
         user=mysql_user,
         password=mysql_password,
-        database=mysql_db,
+        database=database,
 
         ssl_ca=ca_cert,
         ssl_verify_cert=True,
@@ -132,6 +197,9 @@ def get_mysql_connection():
         autocommit=False
     )
 
+def get_mysql_connection():
+    return mysql_pool.get()
+
 def process_message(channel, method, properties, body):
     global last_exec_time_ms
     try:
@@ -139,14 +207,12 @@ def process_message(channel, method, properties, body):
         message = json.loads(body)
         logger.info(f"Received message: {message}")
 
-        p_key, trace_id = process_person(message)
-        if(p_key):
-            logger.info(f"[{trace_id}] Processed passenger: {p_key}")
-            message["passenger_key"] = p_key
-            message["trace_id"] = trace_id
+        message_push = passenger_stage(message)
+        if message_push:
+            trace_id = message_push["trace_id"]
             logger.info(f"[{trace_id}] Publishing passenger details to {PRODUCE_QUEUE_NAME}")
-            channel.queue_declare(queue=PRODUCE_QUEUE_NAME, durable=True)
-            body = json.dumps(message)
+            topology.ensure(channel, PRODUCE_QUEUE_NAME)
+            body = json.dumps(message_push)
 
             channel.basic_publish(
                 exchange="",
@@ -160,7 +226,7 @@ def process_message(channel, method, properties, body):
             duration_ms = (time.perf_counter() - start) * 1000
             last_exec_time_ms = duration_ms
         else:
-            logger.info(f"[{trace_id}] Passenger details not written - On to next message!")    
+            logger.info("Passenger details not written - On to next message!")
         channel.basic_ack(delivery_tag=method.delivery_tag)
     except Exception as e:
         logger.error(f"Error processing message: {e}")
@@ -169,6 +235,28 @@ def process_message(channel, method, properties, body):
             requeue=True
         )
 
+async def process_message_async(consumer, message):
+    #consumer_runtime=asyncio counterpart of process_message, AsyncConsumer publishes and acks
+    global last_exec_time_ms
+    start = time.perf_counter()
+    logger.info(f"Received message: {message}")
+    message_push = await consumer.run(passenger_stage, message)
+    if not message_push:
+        logger.info("Passenger details not written - On to next message!")
+        return []
+    last_exec_time_ms = (time.perf_counter() - start) * 1000
+    return [(PRODUCE_QUEUE_NAME, message_push)]
+
+def passenger_stage(message):
+    #Stage logic shared by the blocking and asyncio runtimes, returns the message to publish or None
+    p_key, trace_id = process_person(message)
+    if not p_key:
+        return None
+    logger.info(f"[{trace_id}] Processed passenger: {p_key}")
+    message["passenger_key"] = p_key
+    message["trace_id"] = trace_id
+    return message
+
 def process_person(message):
     logger.debug(f"Processing passenger: {message}")
     p_id = message["passenger_id"]
@@ -183,36 +271,27 @@ def process_person(message):
 
     conn = get_mysql_connection()
     try:
-        if passenger_exists(conn, p_key):
+        trace_id = str(uuid.uuid4())
+        logger.debug(f"Generated trace ID: {trace_id}")
+        if not insert_passenger(conn, p_key, p_fn, p_nat, p_age, trace_id):
+            conn.rollback()
             return None, None
-        else: 
-            logger.info(f"Inserting new passenger: {p_key} - {p_fn} - {p_nat} - {p_age}")
-            trace_id = str(uuid.uuid4())
-            logger.debug(f"Generated trace ID: {trace_id}")
-            insert_passenger(conn, p_key, p_fn, p_nat, p_age, trace_id)
-            logger.info(f"[{trace_id}] Inserted passenger {p_key} into database.")
-            conn.commit()
-            return p_key, trace_id
+        logger.info(f"[{trace_id}] Inserted new passenger {p_key} - {p_fn} - {p_nat} - {p_age} into database.")
+        conn.commit()
+        return p_key, trace_id
     except mysql.connector.errors.IntegrityError:
         conn.rollback()
-        return None
+        return None, None
     finally:
         conn.close()
 
-def passenger_exists(conn, passenger_key):
-    logger.debug(f"Checking if passenger exists: {passenger_key}")
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT 1 FROM passengers WHERE passenger_key = %s LIMIT 1",
-        (passenger_key,)
-    )
-    return cursor.fetchone() is not None
-
 def insert_passenger(conn, passenger_key, passenger_name, passenger_nationality, passenger_age, trace_id):
+    #One round trip instead of SELECT + INSERT, True if the passenger was new. Safe with several
+    #replicas - the primary key decides which one inserts, the others see 0 rows affected.
     cursor = conn.cursor()
     cursor.execute(
         """
-        INSERT INTO passengers (
+        INSERT IGNORE INTO passengers (
             passenger_key,
             passenger_name,
             passenger_age,
@@ -230,6 +309,134 @@ def insert_passenger(conn, passenger_key, passenger_name, passenger_nationality,
             trace_id
         )
     )
+    return cursor.rowcount == 1
+
+class BatchConsumer:
+    #Collects deliveries until batch_size are buffered or batch_wait has passed since the first one
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+        self.deliveries = []
+        self.timer = None
+        self.processed = 0
+
+    @property
+    def in_flight(self):
+        return len(self.deliveries)
+
+    def on_message(self, channel, method, properties, body):
+        self.deliveries.append((method, body))
+        if len(self.deliveries) >= batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.connection.call_later(batch_wait, self.on_timer)
+
+    def on_timer(self):
+        self.timer = None
+        self.flush()
+
+    def flush(self):
+        if self.timer is not None:
+            self.connection.remove_timeout(self.timer)
+            self.timer = None
+        deliveries, self.deliveries = self.deliveries, []
+        if deliveries:
+            process_batch(self.channel, deliveries)
+            self.processed += len(deliveries)
+
+def process_batch(channel, deliveries):
+    global last_exec_time_ms, last_batch_size
+    last_tag = deliveries[-1][0].delivery_tag
+    try:
+        start = time.perf_counter()
+        messages = [json.loads(body) for _, body in deliveries]
+        logger.info(f"Received batch of {len(messages)} messages")
+
+        people = [person_fields(m) for m in messages]
+        p_keys = generate_p_keys(people)
+        new_people = insert_new_people(p_keys, people)
+
+        if new_people:
+            topology.ensure(channel, PRODUCE_QUEUE_NAME)
+        for i, trace_id in new_people:
+            message = messages[i]
+            message["passenger_key"] = p_keys[i]
+            message["trace_id"] = trace_id
+            channel.basic_publish(
+                exchange="",
+                routing_key=PRODUCE_QUEUE_NAME,
+                body=json.dumps(message),
+                properties=pika.BasicProperties(
+                    delivery_mode=2
+                )
+            )
+            logger.info(f"[{trace_id}] Processed passenger: {p_keys[i]}")
+        channel.basic_ack(delivery_tag=last_tag, multiple=True)
+        logger.info(f"Batch of {len(messages)} done - {len(new_people)} new passengers published, {len(messages) - len(new_people)} skipped")
+        duration_ms = (time.perf_counter() - start) * 1000
+        last_exec_time_ms = duration_ms
+        last_batch_size = len(messages)
+    except Exception as e:
+        logger.error(f"Error processing batch of {len(deliveries)} messages: {e}")
+        channel.basic_nack(
+            delivery_tag=last_tag,
+            multiple=True,
+            requeue=True
+        )
+
+def person_fields(message):
+    p_fn = f"{message['first_name']} {message['last_name']}"
+    return message["passenger_id"], p_fn, message["nationality"], int(message["age"])
+
+def insert_new_people(p_keys, people):
+    #Returns (index, trace_id) for every passenger that was inserted, duplicates within the batch count once.
+    #INSERT IGNORE skips rows that already exist, when everything was new that is the only round trip.
+    conn = get_mysql_connection()
+    try:
+        candidates = {}
+        for i, (p_key, (p_id, p_fn, p_nat, p_age)) in enumerate(zip(p_keys, people)):
+            if p_key not in candidates:
+                trace_id = str(uuid.uuid4())
+                candidates[p_key] = (i, trace_id, (p_key, p_fn, p_age, p_nat, trace_id))
+        inserted = insert_passengers(conn, [row for _, _, row in candidates.values()])
+        conn.commit()
+        if inserted == len(candidates):
+            new_keys = candidates.keys()
+        else:
+            #Some already existed - ours are the rows that carry our trace ID
+            new_keys = passengers_with_trace_ids(conn, {p_key: trace_id for p_key, (_, trace_id, _) in candidates.items()})
+        logger.info(f"Inserted {inserted} passengers into database.")
+        return [candidates[p_key][:2] for p_key in new_keys]
+    finally:
+        conn.close()
+
+def passengers_with_trace_ids(conn, trace_ids):
+    cursor = conn.cursor()
+    placeholders = ", ".join(["%s"] * len(trace_ids))
+    cursor.execute(
+        f"SELECT passenger_key, trace_id FROM passengers WHERE passenger_key IN ({placeholders})",
+        tuple(trace_ids)
+    )
+    return [p_key for p_key, trace_id in cursor.fetchall() if trace_ids.get(p_key) == trace_id]
+
+def insert_passengers(conn, rows):
+    cursor = conn.cursor()
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s, FALSE)"] * len(rows))
+    cursor.execute(
+        f"""
+        INSERT IGNORE INTO passengers (
+            passenger_key,
+            passenger_name,
+            passenger_age,
+            passenger_nationality,
+            trace_id,
+            to_delete
+        )
+        VALUES {placeholders}
+        """,
+        tuple(value for row in rows for value in row)
+    )
+    return cursor.rowcount
 
 def generate_p_key(id,fn,nat):
     canonical = f"{id}|{fn}|{nat}".lower().strip()
@@ -240,24 +447,71 @@ def generate_p_key(id,fn,nat):
     ).digest()
     return base64.urlsafe_b64encode(digest).decode("utf-8")[:32]
 
+def generate_p_keys(people):
+    #Same keys as generate_p_key, the HMAC key schedule is done once for the whole batch
+    base = hmac.new(secret_key, digestmod=hashlib.sha256)
+    p_keys = []
+    for p_id, p_fn, p_nat, _ in people:
+        h = base.copy()
+        h.update(f"{p_id}|{p_fn}|{p_nat}".lower().strip().encode("utf-8"))
+        p_keys.append(base64.urlsafe_b64encode(h.digest()).decode("utf-8")[:32])
+    return p_keys
+
 
 def main():
     bootstrap()
+    if worker_processes > 1:
+        logger.info(f"**********Starting passenger-svc supervisor with {worker_processes} worker processes**********")
+        supervisor = WorkerSupervisor(run_worker, worker_processes, name="passenger-svc", backoff=worker_restart_backoff, backoff_max=worker_restart_backoff_max)
+        register_supervisor_metrics(meter, supervisor)
+        supervisor.run()
+    else:
+        run_service()
+
+def run_worker(worker, stats):
+    #Entry point of a spawned worker process, sets everything up again with its own connections
+    bootstrap(worker)
+    run_service(stats)
+
+def run_service(stats=None):
+    mysql_pool.warm_up()
     logger.info("**********Starting passenger service**********")
 
+    if consumer_runtime == "asyncio":
+        try:
+            asyncio.run(main_async(stats))
+        except KeyboardInterrupt:
+            logger.info("Stopping consumer...")
+        return
+
     logger.info("Starting SSL RabbitMQ consumer...")
     global connection, channel 
     connection = get_rmq_connection()
     channel = connection.channel()
 
-    logger.info(f"Declaring queue {CONSUME_QUEUE_NAME}")
-    channel.queue_declare(queue=CONSUME_QUEUE_NAME, durable=True)
-    channel.basic_qos(prefetch_count=1)
+    consumer = None
+    if batch_size > 1:
+        topology.declare_all(channel)
+        logger.info(f"Batch mode - up to {batch_size} messages or {batch_wait * 1000:.0f}ms per batch")
+        channel.basic_qos(prefetch_count=batch_size)
+        batch_consumer = BatchConsumer(connection, channel)
+        if stats:
+            stats.track_consumers([batch_consumer])
+        on_message = batch_consumer.on_message
+    else:
+        logger.info(f"Processing messages on {consumer_workers} worker thread(s)")
+        consumer = ThreadedConsumer(connection, channel, consumer_workers, name=CONSUME_QUEUE_NAME, prefetch_min=prefetch_min, prefetch_max=prefetch_max, prefetch_max_bytes=prefetch_max_bytes, tune_interval=prefetch_tune_interval)
+        register_consumer_metrics(meter, [consumer])
+        if stats:
+            stats.track_consumers([consumer])
+        #Declared through the wrapped channel the workers publish on, so ensure() finds them
+        topology.declare_all(consumer.channel)
+        on_message = consumer.wrap(process_message)
 
     logger.info(f"Consuming messages from {CONSUME_QUEUE_NAME}")
     channel.basic_consume(
         queue=CONSUME_QUEUE_NAME,
-        on_message_callback=process_message,
+        on_message_callback=on_message,
         auto_ack=False
     )
 
@@ -267,10 +521,24 @@ def main():
 
     except KeyboardInterrupt:
         logger.info("Stopping consumer...")
+        logger.info(f"Skipped {topology.saved} queue declares, sent {topology.declares}")
     finally:
         channel.stop_consuming()
+        if consumer is not None:
+            consumer.drain()
         connection.close()
 
+async def main_async(stats=None):
+    logger.info(f"Starting asyncio RabbitMQ consumer - up to {async_max_in_flight} messages in flight")
+    if batch_size > 1:
+        logger.warning("batch_size is ignored with consumer_runtime=asyncio")
+    consumer = AsyncConsumer(get_rmq_connection_async, topology.queues, max_in_flight=async_max_in_flight, db_threads=mysql_pool.size)
+    register_consumer_metrics(meter, [consumer])
+    if stats:
+        stats.track_consumers([consumer])
+    consumer.consume(CONSUME_QUEUE_NAME, process_message_async)
+    await consumer.serve()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,59 @@
+import weakref
+import logging
+from opentelemetry import metrics
+
+#Remembers which queues were declared on which channel so producers stop sending a synchronous
+#queue_declare before every publish. declare_all() declares everything the service consumes and
+#produces once when a channel is opened, ensure() is what publishers call - it only goes to the
+#broker for a channel it has not seen, e.g. the new channel after a reconnect.
+
+logger = logging.getLogger(__name__)
+
+class QueueTopology:
+    def __init__(self, queues, durable=True):
+        self.queues = list(queues)
+        self.durable = durable
+        #Keyed on the channel object itself, a recovered channel is a new object and gets declared again
+        self._declared = weakref.WeakKeyDictionary()
+        self.declares = 0
+        self.saved = 0
+
+    def declare_all(self, channel):
+        for queue in self.queues:
+            logger.info(f"Declaring queue {queue}")
+            self._declare(channel, queue)
+
+    def ensure(self, channel, queue):
+        declared = self._declared.get(channel)
+        if declared is not None and queue in declared and channel.is_open:
+            self.saved += 1
+            return
+        self._declare(channel, queue)
+
+    def _declare(self, channel, queue):
+        channel.queue_declare(queue=queue, durable=self.durable)
+        self.declares += 1
+        self._declared.setdefault(channel, set()).add(queue)
+
+    def forget(self, channel):
+        self._declared.pop(channel, None)
+
+def register_topology_metrics(meter, topology):
+    def saved_callback(options):
+        return [metrics.Observation(topology.saved)]
+
+    def declares_callback(options):
+        return [metrics.Observation(topology.declares)]
+
+    meter.create_observable_counter(
+        "application.rmq.declares_saved",
+        unit="{declare}",
+        description="queue_declare round trips skipped because the queue was already declared on the channel",
+        callbacks=[saved_callback]
+    )
+    meter.create_observable_counter(
+        "application.rmq.declares",
+        unit="{declare}",
+        description="queue_declare round trips sent to RabbitMQ",
+        callbacks=[declares_callback]
+    )
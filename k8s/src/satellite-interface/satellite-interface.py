@@ -1,13 +1,21 @@
 import json
 import ssl
 import pika
+import aio_pika
+import asyncio
 import os
+import socket
 import time
 import sys
 import hmac
 import hashlib
 import base64
 import mysql.connector
+from mysql_pool import MySQLPool, register_pool_metrics
+from threaded_consumer import ThreadedConsumer, register_consumer_metrics
+from async_consumer import AsyncConsumer
+from worker_supervisor import WorkerSupervisor, register_supervisor_metrics
+import facial_codec
 import uuid
 import logging
 import gzip
@@ -21,9 +29,9 @@ from opentelemetry.sdk.resources import Resource
 from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
 from opentelemetry.semconv.resource import ResourceAttributes
 
-def bootstrap():
+def bootstrap(worker=None):
     #Environment variables
-    global facial_dir, facial_api, rmq_url, rmq_port, rmq_username, rmq_password, ca_cert, secret_key, mysql_url, mysql_port, mysql_user, mysql_password, mysql_db, CONSUME_QUEUE_NAME, PRODUCE_TOPIC_NAME, logdir, loglvl, mysql_db_s1, mysql_db_s2, mysql_db_s3, logger, publish_exec_time, last_exec_time_ms, kafka_url, cert_file, key_file
+    global facial_dir, facial_api, rmq_url, rmq_port, rmq_username, rmq_password, ca_cert, secret_key, mysql_url, mysql_port, mysql_user, mysql_password, mysql_db, CONSUME_QUEUE_NAME, PRODUCE_TOPIC_NAME, logdir, loglvl, mysql_db_s1, mysql_db_s2, mysql_db_s3, logger, publish_exec_time, last_exec_time_ms, kafka_url, cert_file, key_file, mysql_pools, consumer_workers, meter, consumer_runtime, async_max_in_flight, worker_processes, worker_restart_backoff, worker_restart_backoff_max, prefetch_min, prefetch_max, prefetch_max_bytes, prefetch_tune_interval
     facial_dir = os.environ.get("FACIAL_DIR")
     facial_api = os.environ.get("image_gen_api")
     rmq_url = os.environ.get("RMQ_HOST")
@@ -43,6 +51,20 @@ def bootstrap():
     mysql_db_s1 = os.environ.get("MYSQL_DB_SATELLITE1")
     mysql_db_s2 = os.environ.get("MYSQL_DB_SATELLITE2")
     mysql_db_s3 = os.environ.get("MYSQL_DB_SATELLITE3")
+    consumer_runtime = os.environ.get("consumer_runtime", "blocking").lower()
+    consumer_workers = int(os.environ.get("consumer_workers", "1"))
+    prefetch_min = int(os.environ.get("prefetch_min", str(consumer_workers)))
+    prefetch_max = int(os.environ.get("prefetch_max", str(consumer_workers * 4)))
+    prefetch_max_bytes = int(os.environ.get("prefetch_max_bytes", str(64 * 1024 * 1024)))
+    prefetch_tune_interval = float(os.environ.get("prefetch_tune_interval_s", "5"))
+    async_max_in_flight = int(os.environ.get("async_max_in_flight", "200"))
+    worker_processes = int(os.environ.get("worker_processes", "1"))
+    worker_restart_backoff = float(os.environ.get("worker_restart_backoff_s", "1"))
+    worker_restart_backoff_max = float(os.environ.get("worker_restart_backoff_max_s", "60"))
+    mysql_pool_size = int(os.environ.get("mysql_pool_size", str(max(4, consumer_workers))))
+    mysql_pool_warm = int(os.environ.get("mysql_pool_warm", "2"))
+    mysql_pool_max_lifetime = int(os.environ.get("mysql_pool_max_lifetime_s", "1800"))
+    mysql_pool_ping_after = int(os.environ.get("mysql_pool_ping_after_s", "30"))
     CONSUME_QUEUE_NAME = "upd_facial_data_flight"
     PRODUCE_TOPIC_NAME = "ingest_facial_data_"
     logdir = os.environ.get("log_directory", ".")
@@ -73,10 +95,14 @@ def bootstrap():
     logger.addHandler(file_handler)
 
     #OTEL setup
-    resource = Resource.create({
+    resource_attributes = {
         "service.name": otel_service_name,
         "service.version": release_version,
-    })
+    }
+    if worker_processes > 1:
+        #The supervisor and every worker process export on their own, tell them apart by instance
+        resource_attributes["service.instance.id"] = f"{socket.gethostname()}-{'supervisor' if worker is None else f'w{worker}'}"
+    resource = Resource.create(resource_attributes)
 
     metric_reader = PeriodicExportingMetricReader(
     OTLPMetricExporter(endpoint=otel_exporter_endpoint, insecure=True),
@@ -103,6 +129,15 @@ def bootstrap():
         callbacks=[exec_time_callback]
     )
 
+    #MySQL connection pools, one per database
+    mysql_pools = {
+        "hq": MySQLPool("hq", lambda db=mysql_db: connect_mysql(db), size=mysql_pool_size, warm=mysql_pool_warm, max_lifetime=mysql_pool_max_lifetime, ping_after=mysql_pool_ping_after),
+        "s1": MySQLPool("s1", lambda db=mysql_db_s1: connect_mysql(db), size=mysql_pool_size, warm=mysql_pool_warm, max_lifetime=mysql_pool_max_lifetime, ping_after=mysql_pool_ping_after),
+        "s2": MySQLPool("s2", lambda db=mysql_db_s2: connect_mysql(db), size=mysql_pool_size, warm=mysql_pool_warm, max_lifetime=mysql_pool_max_lifetime, ping_after=mysql_pool_ping_after),
+        "s3": MySQLPool("s3", lambda db=mysql_db_s3: connect_mysql(db), size=mysql_pool_size, warm=mysql_pool_warm, max_lifetime=mysql_pool_max_lifetime, ping_after=mysql_pool_ping_after),
+    }
+    register_pool_metrics(meter, list(mysql_pools.values()))
+
 def get_rmq_connection():
     credentials = pika.PlainCredentials(
         rmq_username,
@@ -129,6 +164,21 @@ def get_rmq_connection():
 
     return pika.BlockingConnection(params)
 
+async def get_rmq_connection_async():
+    ssl_context = ssl.create_default_context(cafile=ca_cert)
+    ssl_context.check_hostname = True
+    ssl_context.verify_mode = ssl.CERT_REQUIRED
+
+    return await aio_pika.connect_robust(
+        host=rmq_url,
+        port=rmq_port,
+        login=rmq_username,
+        password=rmq_password,
+        ssl=True,
+        ssl_context=ssl_context,
+        heartbeat=60
+    )
+
 def get_kafka_producer():
     conf = {
         'bootstrap.servers': kafka_url,
@@ -139,13 +189,14 @@ def get_kafka_producer():
     }
     return Producer(conf)
 
-def get_mysql_connection():
+def connect_mysql(database):
+    #Opens a new connection, everything else goes through the pool
     return mysql.connector.connect(
         host=mysql_url,
         port=mysql_port,
         user=mysql_user,
         password=mysql_password,
-        database=mysql_db,
+        database=database,
 
         ssl_ca=ca_cert,
         ssl_verify_cert=True,
@@ -154,62 +205,50 @@ def get_mysql_connection():
         autocommit=False
     )
 
-def get_mysql_connection_s1():
-    return mysql.connector.connect(
-        host=mysql_url,
-        port=mysql_port,
-        user=mysql_user,
-        password=mysql_password,
-        database=mysql_db_s1,
-
-        ssl_ca=ca_cert,
-        ssl_verify_cert=True,
-        ssl_verify_identity=True,  
+def get_mysql_connection():
+    return mysql_pools["hq"].get()
 
-        autocommit=False
-    )
+def get_mysql_connection_s1():
+    return mysql_pools["s1"].get()
 
 def get_mysql_connection_s2():
-    return mysql.connector.connect(
-        host=mysql_url,
-        port=mysql_port,
-        user=mysql_user,
-        password=mysql_password,
-        database=mysql_db_s2,
-
-        ssl_ca=ca_cert,
-        ssl_verify_cert=True,
-        ssl_verify_identity=True,  
-
-        autocommit=False
-    )
+    return mysql_pools["s2"].get()
 
 def get_mysql_connection_s3():
-    return mysql.connector.connect(
-        host=mysql_url,
-        port=mysql_port,
-        user=mysql_user,
-        password=mysql_password,
-        database=mysql_db_s3,
-
-        ssl_ca=ca_cert,
-        ssl_verify_cert=True,
-        ssl_verify_identity=True,  
-
-        autocommit=False
-    )
+    return mysql_pools["s3"].get()
 
 def process_message(channel, method, properties, body):
-    global conn, conn_s1, conn_s2, conn_s3, last_exec_time_ms, kafka_producer_conn
-    conn = get_mysql_connection()
-    conn_s1 = get_mysql_connection_s1()
-    conn_s2 = get_mysql_connection_s2()
-    conn_s3 = get_mysql_connection_s3()
-    kafka_producer_conn = get_kafka_producer()
     try:
-        start = time.perf_counter()
-        message = json.loads(body)
+        message = facial_codec.unpack(body)
         logger.info("Received message")
+        satellite_stage(message)
+        channel.basic_ack(delivery_tag=method.delivery_tag)   
+    except Exception as e:
+        logger.error(f"Error processing message: {e}")
+        channel.basic_nack(
+            delivery_tag=method.delivery_tag,
+            requeue=True
+        )
+
+async def process_message_async(consumer, message):
+    #consumer_runtime=asyncio counterpart of process_message, the stage only talks to MySQL and
+    #Kafka so it runs whole on the executor and nothing is published to RabbitMQ
+    logger.info("Received message")
+    await consumer.run(satellite_stage, message)
+    return []
+
+def satellite_stage(message):
+    #Stage logic shared by the blocking and asyncio runtimes, routes the passenger to a satellite topic
+    global last_exec_time_ms
+    #Checked out inside the try, a failing checkout must not strand the ones already taken
+    conn = conn_s1 = conn_s2 = conn_s3 = None
+    try:
+        conn = get_mysql_connection()
+        conn_s1 = get_mysql_connection_s1()
+        conn_s2 = get_mysql_connection_s2()
+        conn_s3 = get_mysql_connection_s3()
+        kafka_producer_conn = get_kafka_producer()
+        start = time.perf_counter()
 
         p_key = message["passenger_key"]
         trace_id = message["trace_id"]
@@ -235,11 +274,11 @@ def process_message(channel, method, properties, body):
             message_push = {
                 "passenger_key": message["passenger_key"],
                 "trace_id": trace_id,
-                "facial_image": message["facial_image"],
+                **facial_codec.facial_fields(message),
                 "departure_date": departure_date,
                 "arrival_airport": arrival_airport
             }
-            body = json.dumps(message_push)
+            body = facial_codec.pack(message_push)
             kafka_producer_conn.produce(
                 topic=PRODUCE_TOPIC_NAME + selected_satellite,
                 value=body
@@ -248,14 +287,11 @@ def process_message(channel, method, properties, body):
             logger.info("Facial details written and message published.")
             duration_ms = (time.perf_counter() - start) * 1000
             last_exec_time_ms = duration_ms
-        channel.basic_ack(delivery_tag=method.delivery_tag)   
-    except Exception as e:
-        logger.error(f"Error processing message: {e}")
-        channel.basic_nack(
-            delivery_tag=method.delivery_tag,
-            requeue=True
-        )
-    conn.close()
+    finally:
+        #All four go back to their pools, not just hq
+        for c in (conn, conn_s1, conn_s2, conn_s3):
+            if c is not None:
+                c.close()
 
 def passenger_exists_satellite_db(conn, passenger_key):
     logger.debug(f"Checking if passenger exists: {passenger_key}")
@@ -294,8 +330,31 @@ def flight_exists_satellite(conn_s1, conn_s2, conn_s3, departure_date, arrival_a
 
 def main():
     bootstrap()
+    if worker_processes > 1:
+        logger.info(f"**********Starting satellite-interface supervisor with {worker_processes} worker processes**********")
+        supervisor = WorkerSupervisor(run_worker, worker_processes, name="satellite-interface", backoff=worker_restart_backoff, backoff_max=worker_restart_backoff_max)
+        register_supervisor_metrics(meter, supervisor)
+        supervisor.run()
+    else:
+        run_service()
+
+def run_worker(worker, stats):
+    #Entry point of a spawned worker process, sets everything up again with its own connections
+    bootstrap(worker)
+    run_service(stats)
+
+def run_service(stats=None):
+    for pool in mysql_pools.values():
+        pool.warm_up()
     logger.info("**********Starting satellite-interface service**********")
 
+    if consumer_runtime == "asyncio":
+        try:
+            asyncio.run(main_async(stats))
+        except KeyboardInterrupt:
+            logger.info("Stopping consumer...")
+        return
+
     logger.info("Starting SSL RabbitMQ consumer...")
     global connection, channel 
     connection = get_rmq_connection()
@@ -303,12 +362,16 @@ def main():
 
     logger.info(f"Declaring queue {CONSUME_QUEUE_NAME}")
     channel.queue_declare(queue=CONSUME_QUEUE_NAME, durable=True)
-    channel.basic_qos(prefetch_count=1)
+    logger.info(f"Processing messages on {consumer_workers} worker thread(s)")
+    consumer = ThreadedConsumer(connection, channel, consumer_workers, name=CONSUME_QUEUE_NAME, prefetch_min=prefetch_min, prefetch_max=prefetch_max, prefetch_max_bytes=prefetch_max_bytes, tune_interval=prefetch_tune_interval)
+    register_consumer_metrics(meter, [consumer])
+    if stats:
+        stats.track_consumers([consumer])
 
     logger.info(f"Consuming messages from {CONSUME_QUEUE_NAME}")
     channel.basic_consume(
         queue=CONSUME_QUEUE_NAME,
-        on_message_callback=process_message,
+        on_message_callback=consumer.wrap(process_message),
         auto_ack=False
     )
 
@@ -320,8 +383,19 @@ def main():
         logger.info("Stopping consumer...")
     finally:
         channel.stop_consuming()
+        consumer.drain()
         connection.close()
 
+async def main_async(stats=None):
+    logger.info(f"Starting asyncio RabbitMQ consumer - up to {async_max_in_flight} messages in flight")
+    #Every message checks out one connection from each of the four pools
+    consumer = AsyncConsumer(get_rmq_connection_async, [CONSUME_QUEUE_NAME], max_in_flight=async_max_in_flight, db_threads=min(p.size for p in mysql_pools.values()), unpack=facial_codec.unpack)
+    register_consumer_metrics(meter, [consumer])
+    if stats:
+        stats.track_consumers([consumer])
+    consumer.consume(CONSUME_QUEUE_NAME, process_message_async)
+    await consumer.serve()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
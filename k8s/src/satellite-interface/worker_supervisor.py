@@ -0,0 +1,194 @@
+import os
+import sys
+import time
+import queue
+import signal
+import logging
+import threading
+import multiprocessing
+from opentelemetry import metrics
+
+#Runs a consumer service as N worker processes so the CPU-bound parts (HMAC, JSON, gzip/base64)
+#are not all behind one GIL. Workers are spawned, not forked - each one starts clean and opens
+#its own RabbitMQ/MySQL connections and OTEL exporter, nothing half-initialised is inherited.
+#A worker that exits is restarted after a backoff that doubles while it keeps crashing and goes
+#back to the start once a worker has stayed up for stable_after seconds. Workers ship a small
+#WorkerStats snapshot every report interval, the supervisor exports the combined figures.
+
+logger = logging.getLogger(__name__)
+
+#Snapshot keys that only ever grow, kept across restarts so the combined counter stays monotonic
+COUNTERS = ("processed",)
+STOP_TIMEOUT_S = 40
+
+class WorkerStats:
+    #Lives in the worker, the service adds what it wants shipped to the supervisor
+    def __init__(self):
+        self._sources = {}
+
+    def add(self, name, fn):
+        self._sources[name] = fn
+
+    def track_consumers(self, consumers):
+        #ThreadedConsumer, AsyncConsumer and BatchConsumer all keep these two
+        self.add("processed", lambda: sum(c.processed for c in consumers))
+        self.add("in_flight", lambda: sum(c.in_flight for c in consumers))
+
+    def snapshot(self):
+        return {name: fn() for name, fn in self._sources.items()}
+
+def _report_loop(worker, stats, out, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            out.put((worker, os.getpid(), stats.snapshot()))
+        except Exception as e:
+            logger.warning(f"Worker {worker} could not report to the supervisor: {e}")
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def _worker_entry(target, worker, out, interval):
+    #Ctrl+C reaches the whole process group, only the supervisor acts on it and then stops the
+    #workers with SIGTERM, which runs the service's own KeyboardInterrupt shutdown path
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _interrupt)
+    stats = WorkerStats()
+    threading.Thread(target=_report_loop, args=(worker, stats, out, interval), daemon=True).start()
+    target(worker, stats)
+
+class WorkerSupervisor:
+    def __init__(self, target, n_workers, name="worker", report_interval=10, backoff=1, backoff_max=60, stable_after=60):
+        #target(worker, stats) runs one worker, it is pickled by reference so it must be a module-level function
+        self.target = target
+        self.n_workers = n_workers
+        self.name = name
+        self.report_interval = report_interval
+        self.backoff_initial = backoff
+        self.backoff_max = backoff_max
+        self.stable_after = stable_after
+        self._ctx = multiprocessing.get_context("spawn")
+        self._out = self._ctx.Queue()
+        self.workers = {}
+        self._started_at = {}
+        self._backoff = {worker: backoff for worker in range(n_workers)}
+        self._restart_at = {}
+        self._latest = {}
+        self._retired = {key: 0 for key in COUNTERS}
+        self.restarts = 0
+
+    def _start(self, worker):
+        p = self._ctx.Process(
+            target=_worker_entry,
+            args=(self.target, worker, self._out, self.report_interval),
+            name=f"{self.name}-{worker}"
+        )
+        p.start()
+        self.workers[worker] = p
+        self._started_at[worker] = time.monotonic()
+        logger.info(f"Started {self.name} worker {worker} (pid {p.pid})")
+
+    def _on_exit(self, worker, p):
+        #Counters of the dead process are folded into the retired totals before it is replaced
+        last = self._latest.pop(worker, {})
+        for key in COUNTERS:
+            self._retired[key] += last.get(key, 0)
+        uptime = time.monotonic() - self._started_at[worker]
+        if uptime >= self.stable_after:
+            self._backoff[worker] = self.backoff_initial
+        delay = self._backoff[worker]
+        self._backoff[worker] = min(delay * 2, self.backoff_max)
+        self._restart_at[worker] = time.monotonic() + delay
+        logger.error(f"{self.name} worker {worker} (pid {p.pid}) exited with code {p.exitcode} after {uptime:.0f}s - restarting in {delay}s")
+
+    def _collect(self, timeout):
+        try:
+            worker, pid, snapshot = self._out.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        p = self.workers.get(worker)
+        #A report can arrive after its process was replaced, only the current one counts
+        if p is not None and p.pid == pid:
+            self._latest[worker] = snapshot
+        return True
+
+    def _check(self):
+        now = time.monotonic()
+        for worker, p in list(self.workers.items()):
+            if worker in self._restart_at:
+                if now >= self._restart_at[worker]:
+                    del self._restart_at[worker]
+                    self.restarts += 1
+                    self._start(worker)
+            elif not p.is_alive():
+                p.join()
+                self._on_exit(worker, p)
+
+    def run(self):
+        for worker in range(self.n_workers):
+            self._start(worker)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            while True:
+                self._collect(1)
+                self._check()
+        except (KeyboardInterrupt, SystemExit):
+            logger.info(f"Stopping {self.name} workers")
+        finally:
+            self.stop()
+
+    def stop(self):
+        for p in self.workers.values():
+            if p.is_alive():
+                p.terminate()
+        deadline = time.monotonic() + STOP_TIMEOUT_S
+        for p in self.workers.values():
+            p.join(timeout=max(0, deadline - time.monotonic()))
+            if p.is_alive():
+                logger.warning(f"{p.name} (pid {p.pid}) did not stop in time, killing it")
+                p.kill()
+                p.join()
+
+    def alive(self):
+        return sum(p.is_alive() for p in self.workers.values())
+
+    def total(self, key):
+        return self._retired.get(key, 0) + sum(s.get(key, 0) for s in list(self._latest.values()))
+
+def register_supervisor_metrics(meter, supervisor):
+    def alive_callback(options):
+        return [metrics.Observation(supervisor.alive())]
+
+    def restarts_callback(options):
+        return [metrics.Observation(supervisor.restarts)]
+
+    def processed_callback(options):
+        return [metrics.Observation(supervisor.total("processed"))]
+
+    def in_flight_callback(options):
+        return [metrics.Observation(supervisor.total("in_flight"))]
+
+    meter.create_observable_gauge(
+        "application.workers.alive",
+        unit="{process}",
+        description="Worker processes currently running under the supervisor",
+        callbacks=[alive_callback]
+    )
+    meter.create_observable_counter(
+        "application.workers.restarts",
+        unit="{process}",
+        description="Worker processes restarted after exiting",
+        callbacks=[restarts_callback]
+    )
+    meter.create_observable_counter(
+        "application.workers.processed",
+        unit="{message}",
+        description="Messages handled by all worker processes together, including restarted ones",
+        callbacks=[processed_callback]
+    )
+    meter.create_observable_gauge(
+        "application.workers.in_flight",
+        unit="{message}",
+        description="Messages being processed across all worker processes",
+        callbacks=[in_flight_callback]
+    )
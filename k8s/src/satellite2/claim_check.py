@@ -0,0 +1,136 @@
+import os
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+import contextlib
+import urllib.parse
+from opentelemetry import metrics
+
+#Claim check for facial images. facial-svc puts the image in a store every satellite can reach and
+#the messages only carry its reference and sha256 - flight-svc and satellite-interface never see
+#the image bytes, the satellite that stores the passenger reads it back and checks the digest.
+#The store is picked by claim_check_url:
+#  file:///path  a directory, local for testing or a shared volume mounted in facial-svc and the
+#                satellites. Blobs are <sha[:2]>/<sha>, written under a temp name and renamed.
+#References are sha256/<hex>, so services may mount the volume at different paths. The same image
+#is stored once, putting it again bumps its mtime - housekeep removes blobs older than the
+#retention with prune().
+
+logger = logging.getLogger(__name__)
+
+class DigestMismatch(Exception):
+    pass
+
+class FileClaimStore:
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self.puts = 0
+        self.bytes_written = 0
+        self.gets = 0
+        self.mismatches = 0
+
+    def _path(self, ref):
+        algorithm, _, digest = ref.partition("/")
+        if algorithm != "sha256" or len(digest) != 64 or not all(c in "0123456789abcdef" for c in digest):
+            raise ValueError(f"Invalid claim check reference: {ref!r}")
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, content, digest=None):
+        #Returns (ref, digest), digest can be passed in when the caller hashed the content already
+        digest = digest or hashlib.sha256(content).hexdigest()
+        ref = f"sha256/{digest}"
+        path = self._path(ref)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(content)
+                os.replace(tmp, path)
+            except BaseException:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(tmp)
+                raise
+            with self._lock:
+                self.bytes_written += len(content)
+        with self._lock:
+            self.puts += 1
+        return ref, digest
+
+    def get(self, ref, digest):
+        #The image bytes, DigestMismatch if they are not what the message says
+        with open(self._path(ref), "rb") as f:
+            content = f.read()
+        with self._lock:
+            self.gets += 1
+        if hashlib.sha256(content).hexdigest() != digest:
+            with self._lock:
+                self.mismatches += 1
+            raise DigestMismatch(f"Claim check {ref} does not match digest {digest}")
+        return content
+
+    def prune(self, older_than):
+        #Removes blobs not put for older_than seconds, returns how many
+        cutoff = time.time() - older_than
+        removed = 0
+        for prefix in os.listdir(self.root):
+            subdir = os.path.join(self.root, prefix)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                path = os.path.join(subdir, name)
+                with contextlib.suppress(FileNotFoundError):
+                    if os.stat(path).st_mtime < cutoff:
+                        os.remove(path)
+                        removed += 1
+        return removed
+
+def open_store(url):
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "file":
+        return FileClaimStore(urllib.parse.unquote(parsed.path))
+    raise ValueError(f"Unsupported claim_check_url scheme: {parsed.scheme!r}")
+
+def register_claim_check_metrics(meter, store):
+    def puts_callback(options):
+        return [metrics.Observation(store.puts)]
+
+    def bytes_callback(options):
+        return [metrics.Observation(store.bytes_written)]
+
+    def gets_callback(options):
+        return [metrics.Observation(store.gets)]
+
+    def mismatch_callback(options):
+        return [metrics.Observation(store.mismatches)]
+
+    meter.create_observable_counter(
+        "application.claim_check.puts",
+        unit="{image}",
+        description="Images put in the claim check store, including ones already there",
+        callbacks=[puts_callback]
+    )
+    meter.create_observable_counter(
+        "application.claim_check.written",
+        unit="By",
+        description="Bytes written to the claim check store",
+        callbacks=[bytes_callback]
+    )
+    meter.create_observable_counter(
+        "application.claim_check.gets",
+        unit="{image}",
+        description="Images read back from the claim check store",
+        callbacks=[gets_callback]
+    )
+    meter.create_observable_counter(
+        "application.claim_check.digest_mismatches",
+        unit="{image}",
+        description="Images read back whose sha256 did not match the message",
+        callbacks=[mismatch_callback]
+    )
@@ -0,0 +1,159 @@
+import json
+import gzip
+import base64
+import struct
+import logging
+
+#How facial images travel from facial-svc to the satellites. The message says which version it is
+#in facial_codec, a message without it is version 1.
+#  1  facial_image is base64(gzip(image)) inside the JSON body - what the satellites store
+#  2  the body is MAGIC, a 4 byte header length, the JSON header and the image bytes. The header
+#     has the usual fields plus facial_encoding (identity|gzip|zstd|lz4) and facial_size. Images
+#     that are already compressed (JPEG, PNG, ...) or barely shrink on a sample are sent as they are.
+#  3  claim check - the JSON body carries facial_ref and facial_digest (sha256) of the image in a
+#     claim_check store, see claim_check.py. Only the satellite storing the passenger reads it.
+#unpack() puts the version 2 image bytes in message["facial_payload"] and pack() writes them back
+#out, so a hop that only forwards the image never decodes it. zstd and lz4 are optional imports,
+#encode falls back to gzip when the one asked for is missing.
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"FCv2"
+VERSION = 2
+LEGACY_VERSION = 1
+CLAIM_CHECK_VERSION = 3
+FIELDS = ("facial_image", "facial_codec", "facial_encoding", "facial_size", "facial_payload", "facial_ref", "facial_digest")
+SAMPLE_BYTES = 16 * 1024
+#A sample that does not shrink below this ratio is not worth compressing
+MIN_SAVING_RATIO = 0.9
+DEFAULT_LEVELS = {"gzip": 6, "zstd": 3, "lz4": 0}
+#Signatures of formats that are compressed already
+COMPRESSED_SIGNATURES = (
+    b"\xff\xd8\xff",          #JPEG
+    b"\x89PNG\r\n\x1a\n",     #PNG
+    b"GIF8",                  #GIF
+    b"\x1f\x8b",              #gzip
+    b"\x28\xb5\x2f\xfd",      #zstd
+    b"\x04\x22\x4d\x18",      #lz4 frame
+    b"PK\x03\x04",            #zip
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+def available():
+    return ["identity", "gzip"] + (["zstd"] if zstandard else []) + (["lz4"] if lz4 else [])
+
+def _compress(encoding, data, level):
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if encoding == "lz4":
+        return lz4.frame.compress(data, compression_level=level)
+    raise ValueError(f"Unknown facial encoding: {encoding}")
+
+def _decompress(encoding, data, size):
+    if encoding == "identity":
+        return bytes(data)
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    if encoding == "zstd":
+        if zstandard is None:
+            raise RuntimeError("Message is zstd encoded and zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+    if encoding == "lz4":
+        if lz4 is None:
+            raise RuntimeError("Message is lz4 encoded and lz4 is not installed")
+        return lz4.frame.decompress(data)
+    raise ValueError(f"Unknown facial encoding: {encoding}")
+
+def is_compressible(content, encoding="gzip", level=None):
+    if content[:4] == b"RIFF" and content[8:12] == b"WEBP":
+        return False
+    if any(content[:len(sig)] == sig for sig in COMPRESSED_SIGNATURES):
+        return False
+    sample = bytes(content[:SAMPLE_BYTES])
+    return len(_compress(encoding, sample, DEFAULT_LEVELS[encoding] if level is None else level)) < len(sample) * MIN_SAVING_RATIO
+
+def resolve(encoding):
+    #The encoding that will actually be used on this host
+    if encoding in ("zstd", "lz4") and encoding not in available():
+        logger.warning(f"{encoding} is not installed, compressing facial images with gzip instead")
+        return "gzip"
+    if encoding not in ("identity", "gzip", "zstd", "lz4"):
+        raise ValueError(f"Unknown facial encoding: {encoding}")
+    return encoding
+
+def encode(content, version=VERSION, encoding="zstd", level=None, claims=None, digest=None):
+    #Returns the facial fields to merge into a message, content is any bytes-like object. Version 3
+    #needs the claim check store, digest saves hashing the content again if the caller has it.
+    if version == LEGACY_VERSION:
+        return {"facial_image": base64.b64encode(gzip.compress(content)).decode("utf-8")}
+    if version == CLAIM_CHECK_VERSION:
+        ref, digest = claims.put(content, digest)
+        return {
+            "facial_codec": CLAIM_CHECK_VERSION,
+            "facial_ref": ref,
+            "facial_digest": digest,
+            "facial_size": len(content)
+        }
+    if encoding != "identity" and is_compressible(content, encoding, level):
+        payload = _compress(encoding, content, DEFAULT_LEVELS[encoding] if level is None else level)
+    else:
+        encoding, payload = "identity", bytes(content)
+    return {
+        "facial_codec": VERSION,
+        "facial_encoding": encoding,
+        "facial_size": len(content),
+        "facial_payload": payload
+    }
+
+def decode(message, claims=None):
+    #The raw image bytes of a message of any version, version 3 needs the claim check store
+    version = message.get("facial_codec", LEGACY_VERSION)
+    if version == LEGACY_VERSION:
+        return gzip.decompress(base64.b64decode(message["facial_image"]))
+    if version == CLAIM_CHECK_VERSION:
+        if claims is None:
+            raise RuntimeError("Message is a claim check and no claim_check_url is configured")
+        return claims.get(message["facial_ref"], message["facial_digest"])
+    if version == VERSION:
+        return _decompress(message["facial_encoding"], message["facial_payload"], message["facial_size"])
+    raise ValueError(f"Unsupported facial codec version: {version}")
+
+def legacy_image(message, claims=None):
+    #facial_image as version 1 carries it, what the satellites' touchpoint tables hold
+    if message.get("facial_codec", LEGACY_VERSION) == LEGACY_VERSION:
+        return message["facial_image"]
+    return base64.b64encode(gzip.compress(decode(message, claims))).decode("utf-8")
+
+def facial_fields(message):
+    #The facial fields of a message, for a hop that forwards the image without touching it
+    return {key: message[key] for key in FIELDS if key in message}
+
+def pack(message):
+    #Message to body, binary framed when it carries a version 2 payload, plain JSON otherwise
+    payload = message.get("facial_payload")
+    if payload is None:
+        return json.dumps(message).encode("utf-8")
+    header = json.dumps({key: value for key, value in message.items() if key != "facial_payload"}).encode("utf-8")
+    return b"".join((MAGIC, struct.pack(">I", len(header)), header, payload))
+
+def unpack(body):
+    #Body to message, accepts both plain JSON and the version 2 frame
+    if body[:len(MAGIC)] != MAGIC:
+        return json.loads(body)
+    view = memoryview(body)
+    start = len(MAGIC) + 4
+    (header_len,) = struct.unpack(">I", view[len(MAGIC):start])
+    message = json.loads(bytes(view[start:start + header_len]))
+    message["facial_payload"] = view[start + header_len:]
+    return message
@@ -7,6 +7,9 @@ import hashlib
 import base64
 import time
 import mysql.connector
+from mysql_pool import MySQLPool, register_pool_metrics
+import facial_codec
+from claim_check import open_store, register_claim_check_metrics
 import uuid
 import logging
 import requests
@@ -23,7 +26,7 @@ from opentelemetry.semconv.resource import ResourceAttributes
 
 def bootstrap():
     #Environment variables
-    global facial_dir, facial_api, rmq_url, rmq_port, rmq_username, rmq_password, ca_cert, secret_key, mysql_url, mysql_port, mysql_user, mysql_password, CONSUME_TOPIC_NAME, logdir, loglvl, mysql_db_s2, logger, publish_exec_time, last_exec_time_ms, kafka_url, cert_file, key_file
+    global facial_dir, facial_api, rmq_url, rmq_port, rmq_username, rmq_password, ca_cert, secret_key, mysql_url, mysql_port, mysql_user, mysql_password, CONSUME_TOPIC_NAME, logdir, loglvl, mysql_db_s2, logger, publish_exec_time, last_exec_time_ms, kafka_url, cert_file, key_file, mysql_pool, claim_store
     facial_dir = os.environ.get("FACIAL_DIR")
     facial_api = os.environ.get("image_gen_api")
     rmq_url = os.environ.get("RMQ_HOST")
@@ -40,6 +43,11 @@ def bootstrap():
     mysql_user = os.environ.get("MYSQL_USER")
     mysql_password = os.environ.get("MYSQL_PW")
     mysql_db_s2 = os.environ.get("MYSQL_DB_SATELLITE2")
+    mysql_pool_size = int(os.environ.get("mysql_pool_size", "4"))
+    mysql_pool_warm = int(os.environ.get("mysql_pool_warm", "2"))
+    mysql_pool_max_lifetime = int(os.environ.get("mysql_pool_max_lifetime_s", "1800"))
+    mysql_pool_ping_after = int(os.environ.get("mysql_pool_ping_after_s", "30"))
+    claim_check_url = os.environ.get("claim_check_url")
     CONSUME_TOPIC_NAME = "ingest_facial_data_s2"
     logdir = os.environ.get("log_directory", ".")
     loglvl = os.environ.get("log_level", "INFO").upper()
@@ -99,6 +107,16 @@ def bootstrap():
         callbacks=[exec_time_callback]
     )
 
+    #MySQL connection pool
+    mysql_pool = MySQLPool("s2", lambda: connect_mysql(mysql_db_s2), size=mysql_pool_size, warm=mysql_pool_warm, max_lifetime=mysql_pool_max_lifetime, ping_after=mysql_pool_ping_after)
+    register_pool_metrics(meter, [mysql_pool])
+
+    #Claim check store facial-svc puts the images in, version 3 messages only carry a reference
+    claim_store = None
+    if claim_check_url:
+        claim_store = open_store(claim_check_url)
+        register_claim_check_metrics(meter, claim_store)
+
 def get_kafka_consumer():
     conf = {
         'bootstrap.servers': kafka_url,
@@ -113,13 +131,14 @@ def get_kafka_consumer():
     }
     return Consumer(conf)
 
-def get_mysql_connection_s2():
+def connect_mysql(database):
+    #Opens a new connection, everything else goes through the pool
     return mysql.connector.connect(
         host=mysql_url,
         port=mysql_port,
         user=mysql_user,
         password=mysql_password,
-        database=mysql_db_s2,
+        database=database,
 
         ssl_ca=ca_cert,
         ssl_verify_cert=True,
@@ -128,17 +147,21 @@ def get_mysql_connection_s2():
         autocommit=False
     )
 
+def get_mysql_connection_s2():
+    return mysql_pool.get()
+
 def process_message(msg):
     global conn_s2, last_exec_time_ms
     conn_s2 = get_mysql_connection_s2()
     try:
         start = time.perf_counter()
-        message = json.loads(msg.value().decode('utf-8'))
+        message = facial_codec.unpack(msg.value())
         logger.info("Received message for satellite 2")
 
         p_key = message["passenger_key"]
         trace_id = message["trace_id"]
-        facial_image = message["facial_image"]
+        #Stored as version 1 has it whatever version the message came in
+        facial_image = facial_codec.legacy_image(message, claim_store)
         departure_date = datetime.strptime(message["departure_date"], "%Y-%m-%d %H:%M")
         arrival_airport = message["arrival_airport"]
         logger.info(f"[{trace_id}] Inserting data for passenger: {p_key} with trace ID: {trace_id}")
@@ -164,14 +187,19 @@ def process_message(msg):
 def insert_full_data_satellite2(conn, passenger_key, trace_id, facial_image, departure_date, arrival_airport):
     cursor = conn.cursor()
     insert_query = """
-        INSERT INTO touchpoint (passenger_key, trace_id, facial_image, departure_date, arrival_airport)
+        INSERT IGNORE INTO touchpoint (passenger_key, trace_id, facial_image, departure_date, arrival_airport)
         VALUES (%s, %s, %s, %s, %s)
     """
     cursor.execute(insert_query, (passenger_key, trace_id, facial_image, departure_date, arrival_airport))
-    logger.info(f"[{trace_id}] Inserted data for passenger {passenger_key} into satellite 2 database.")
+    #A redelivered Kafka message finds the row already there instead of failing the consumer
+    if cursor.rowcount == 1:
+        logger.info(f"[{trace_id}] Inserted data for passenger {passenger_key} into satellite 2 database.")
+    else:
+        logger.warning(f"[{trace_id}] Passenger {passenger_key} already in satellite 2 database - skipped.")
 
 def main():
     bootstrap()
+    mysql_pool.warm_up()
     logger.info("**********Starting satellite2 service**********")
 
     logger.info("Starting SSL Kafka consumer...")
@@ -0,0 +1,88 @@
+import argparse
+import csv
+import gc
+import os
+import random
+import string
+import tempfile
+import time
+import tracemalloc
+from row_store import RowStore
+
+#Memory benchmark for the row store - list of DictReader dicts vs dictionary encoded columns.
+#Usage: python bench_row_store.py --csv $PAYLOAD_DIR/flights.csv
+#       python bench_row_store.py --rows 1000000   (synthetic flights.csv)
+
+HEADER = [
+    "Passenger ID", "First Name", "Last Name", "Gender", "Age",
+    "Nationality", "Airport Name", "Airport Country Code", "Country Name",
+    "Airport Continent", "Continents",
+    "Departure Date", "Arrival Airport",
+    "Pilot Name", "Flight Status"
+]
+
+def write_synthetic_csv(path, n_rows):
+    #Cardinalities roughly follow the public flights dataset the lab uses
+    rnd = random.Random(42)
+    first = [f"First{i}" for i in range(1000)]
+    last = [f"Last{i}" for i in range(1000)]
+    nat = [f"Nation{i}" for i in range(240)]
+    airports = [(f"Airport {i}", f"C{i % 235}", f"Country {i % 235}", f"Cont{i % 6}", f"Continent {i % 6}") for i in range(9000)]
+    pilots = [f"Pilot {i}" for i in range(5000)]
+    status = ["On Time", "Delayed", "Cancelled"]
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        for i in range(n_rows):
+            airport = rnd.choice(airports)
+            writer.writerow([
+                "".join(rnd.choices(string.ascii_letters, k=6)),
+                rnd.choice(first), rnd.choice(last), rnd.choice(["Male", "Female"]),
+                rnd.randint(1, 90), rnd.choice(nat), *airport,
+                f"{rnd.randint(1, 12)}/{rnd.randint(1, 28)}/2022", rnd.choice(airports)[0][-3:],
+                rnd.choice(pilots), rnd.choice(status),
+            ])
+
+def measure(loader, path):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows = loader(path)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rows, current, peak, elapsed
+
+def load_dicts(path):
+    with open(path, newline="", encoding="utf-8") as csvfile:
+        return list(csv.DictReader(csvfile))
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare memory of list-of-dicts vs RowStore")
+    parser.add_argument("--csv", help="flights.csv to load, a synthetic one is generated if omitted")
+    parser.add_argument("--rows", type=int, default=200_000, help="rows in the synthetic flights.csv")
+    args = parser.parse_args()
+
+    path = args.csv
+    tmp = None
+    if path is None:
+        tmp = tempfile.NamedTemporaryFile(suffix=".csv", delete=False)
+        tmp.close()
+        path = tmp.name
+        write_synthetic_csv(path, args.rows)
+    file_mb = os.path.getsize(path) / 1e6
+
+    try:
+        print(f"flights.csv: {file_mb:.1f} MB")
+        print(f"{'layout':>14} {'rows':>10} {'resident MB':>12} {'peak MB':>10} {'B/row':>8} {'load s':>8}")
+        for name, loader in (("list of dicts", load_dicts), ("RowStore", RowStore.from_csv)):
+            rows, current, peak, elapsed = measure(loader, path)
+            print(f"{name:>14} {len(rows):>10} {current / 1e6:>12.1f} {peak / 1e6:>10.1f} "
+                  f"{current / max(len(rows), 1):>8.0f} {elapsed:>8.2f}")
+            del rows
+    finally:
+        if tmp:
+            os.remove(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import random
+import time
+from data_lake import IndexPool
+
+#Benchmark for the data lake sampler - compares the old random.sample + rows.remove
+#cycle against the IndexPool draw as flights.csv grows.
+#Usage: python bench_sample_lake.py --sizes 10000 100000 1000000 10000000
+
+HEADER = [
+    "Passenger ID", "First Name", "Last Name", "Gender", "Age",
+    "Nationality", "Airport Name", "Airport Country Code", "Country Name",
+    "Airport Continent", "Continents",
+    "Departure Date", "Arrival Airport",
+    "Pilot Name", "Flight Status"
+]
+
+class SyntheticRows:
+    #Stands in for a flights.csv of any size without holding every row in memory,
+    #rows are only built when the sampler touches them
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        row = {h: f"{h}-{i}" for h in HEADER}
+        row["Passenger ID"] = str(i)
+        return row
+
+def legacy_cycle(rows, n_flights, n_passengers):
+    for i in range(n_flights):
+        sampled_rows = random.sample(rows, n_passengers)
+        ref_row = random.choice(sampled_rows)
+        for r in sampled_rows:
+            rows.remove(r)
+            r["Arrival Airport"] = ref_row["Arrival Airport"]
+
+def pool_cycle(rows, n_flights, n_passengers):
+    pool = IndexPool(len(rows))
+    for i in range(n_flights):
+        sampled_rows = [rows[j] for j in pool.draw(n_passengers)]
+        ref_row = random.choice(sampled_rows)
+        for r in sampled_rows:
+            r["Arrival Airport"] = ref_row["Arrival Airport"]
+
+def time_cycle(fn, make_rows, n_flights, n_passengers, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        rows = make_rows()
+        start = time.perf_counter()
+        fn(rows, n_flights, n_passengers)
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark data lake sampling cycle time")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000, 10_000_000])
+    parser.add_argument("--flights", type=int, default=10)
+    parser.add_argument("--passengers", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--legacy-max", type=int, default=100_000,
+                        help="largest size to run the old sampler on, it is quadratic and takes minutes beyond this")
+    args = parser.parse_args()
+
+    print(f"{'rows':>12} {'legacy ms':>12} {'index pool ms':>14}")
+    for size in args.sizes:
+        legacy_ms = "skipped"
+        if size <= args.legacy_max:
+            source = SyntheticRows(size)
+            legacy_ms = time_cycle(legacy_cycle, lambda: [source[i] for i in range(size)], args.flights, args.passengers, args.repeat)
+            legacy_ms = f"{legacy_ms:.2f}"
+        pool_ms = time_cycle(pool_cycle, lambda: SyntheticRows(size), args.flights, args.passengers, args.repeat)
+        print(f"{size:>12} {legacy_ms:>12} {pool_ms:>14.2f}")
+
+if __name__ == "__main__":
+    main()
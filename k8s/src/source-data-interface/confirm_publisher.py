@@ -0,0 +1,200 @@
+import time
+import logging
+import collections
+import pika
+
+#High throughput publisher for the load generator. Runs on an async pika SelectConnection with
+#publisher confirms and keeps up to `window` unconfirmed messages in flight - the broker acks
+#them in batches instead of one synchronous round trip per message. Nacked messages are
+#republished ahead of new ones. With a traffic.Pacer new messages are only sent when due.
+
+logger = logging.getLogger(__name__)
+
+class ConfirmPublisher:
+    def __init__(self, params, queue, messages, encode, window=500, report_interval=10, on_confirm=None, pacer=None):
+        #messages yields items, encode(item, scheduled_at) turns one into (body, context) at send time.
+        #on_confirm(context, latency_ms) is called once the broker acks the message
+        self.params = params
+        self.queue = queue
+        self.encode = encode
+        self.window = window
+        self.report_interval = report_interval
+        self.on_confirm = on_confirm
+        self.pacer = pacer
+        self._messages = iter(messages)
+        self._pump_timer = None
+        self._unconfirmed = {}
+        self._retry = collections.deque()
+        self._next_tag = 1
+        self._exhausted = False
+        self._stopping = False
+        self._error = None
+        self._connection = None
+        self._channel = None
+        self._start = None
+        self.published = 0
+        self.confirmed = 0
+        self.nacked = 0
+
+    def run(self):
+        self._connection = pika.SelectConnection(
+            self.params,
+            on_open_callback=self._on_connection_open,
+            on_open_error_callback=self._on_connection_open_error,
+            on_close_callback=self._on_connection_closed,
+        )
+        self._connection.ioloop.start()
+        if self._error:
+            raise self._error
+        return self.stats()
+
+    def stop(self):
+        #Call after run() was interrupted (e.g. KeyboardInterrupt), runs the ioloop until the close completes
+        self._close()
+        if self._connection and not self._connection.is_closed:
+            self._connection.ioloop.start()
+        if self._unconfirmed:
+            logger.warning(f"Stopped with {len(self._unconfirmed)} unconfirmed message(s)")
+
+    def _close(self):
+        self._stopping = True
+        if self._connection and not (self._connection.is_closing or self._connection.is_closed):
+            self._connection.close()
+
+    def stats(self):
+        elapsed = time.perf_counter() - self._start if self._start else 0.0
+        return {
+            "published": self.published,
+            "confirmed": self.confirmed,
+            "nacked": self.nacked,
+            "in_flight": len(self._unconfirmed),
+            "elapsed_s": elapsed,
+            "confirmed_per_s": self.confirmed / elapsed if elapsed else 0.0,
+        }
+
+    def _on_connection_open(self, connection):
+        logger.info("Publisher connection open, opening channel")
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, err):
+        logger.error(f"Publisher connection failed: {err}")
+        self._error = err if isinstance(err, Exception) else RuntimeError(str(err))
+        connection.ioloop.stop()
+
+    def _on_connection_closed(self, connection, reason):
+        if not self._stopping and not self._done():
+            logger.error(f"Publisher connection closed unexpectedly: {reason}")
+            self._error = reason if isinstance(reason, Exception) else RuntimeError(str(reason))
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        logger.info(f"Declaring queue {self.queue}")
+        channel.queue_declare(queue=self.queue, durable=True, callback=self._on_queue_declared)
+
+    def _on_channel_closed(self, channel, reason):
+        logger.warning(f"Publisher channel closed: {reason}")
+        if not (self._connection.is_closing or self._connection.is_closed):
+            self._connection.close()
+
+    def _on_queue_declared(self, frame):
+        logger.info(f"Enabling publisher confirms with a window of {self.window} messages")
+        self._channel.confirm_delivery(self._on_delivery_confirmation, callback=self._on_confirm_ready)
+
+    def _on_confirm_ready(self, frame):
+        self._start = time.perf_counter()
+        self._connection.ioloop.call_later(self.report_interval, self._report)
+        self._pump()
+
+    def _next_message(self):
+        if self._retry:
+            return self._retry.popleft()
+        if self._exhausted:
+            return None
+        if self.pacer:
+            delay = self.pacer.delay()
+            if delay > 0:
+                self._schedule_pump(delay)
+                return None
+        try:
+            message = next(self._messages)
+        except StopIteration:
+            self._exhausted = True
+            return None
+        scheduled_at = self.pacer.scheduled_at() if self.pacer else time.time()
+        item = self.encode(message, scheduled_at)
+        if self.pacer:
+            self.pacer.sent()
+        return item
+
+    def _schedule_pump(self, delay):
+        if self._pump_timer is None:
+            self._pump_timer = self._connection.ioloop.call_later(delay, self._on_pump_timer)
+
+    def _on_pump_timer(self):
+        self._pump_timer = None
+        self._pump()
+
+    def _pump(self):
+        while not self._stopping and len(self._unconfirmed) < self.window:
+            item = self._next_message()
+            if item is None:
+                break
+            body, context = item
+            self._channel.basic_publish(
+                exchange="",
+                routing_key=self.queue,
+                body=body,
+                properties=pika.BasicProperties(
+                    delivery_mode=2
+                )
+            )
+            self._unconfirmed[self._next_tag] = (item, time.perf_counter())
+            self._next_tag += 1
+            self.published += 1
+        if self._done():
+            logger.info("All messages confirmed, closing publisher connection")
+            self._close()
+
+    def _done(self):
+        return self._exhausted and not self._retry and not self._unconfirmed
+
+    def _on_delivery_confirmation(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            #Tags are handed out in increasing order so the dict is already sorted
+            tags = []
+            for tag in self._unconfirmed:
+                if tag > method.delivery_tag:
+                    break
+                tags.append(tag)
+        else:
+            tags = [method.delivery_tag]
+
+        now = time.perf_counter()
+        for tag in tags:
+            entry = self._unconfirmed.pop(tag, None)
+            if entry is None:
+                continue
+            item, published_at = entry
+            if acked:
+                self.confirmed += 1
+                if self.on_confirm:
+                    self.on_confirm(item[1], (now - published_at) * 1000)
+            else:
+                self.nacked += 1
+                self._retry.append(item)
+        if not acked:
+            logger.warning(f"Broker nacked {len(tags)} message(s), republishing")
+        self._pump()
+
+    def _report(self):
+        s = self.stats()
+        logger.info(
+            f"Publisher confirms: {s['confirmed']} confirmed, {s['nacked']} nacked, "
+            f"{s['in_flight']} in flight, {s['confirmed_per_s']:.1f} msg/s"
+        )
+        if not self._stopping:
+            self._connection.ioloop.call_later(self.report_interval, self._report)
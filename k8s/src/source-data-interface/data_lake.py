@@ -6,6 +6,8 @@ import time
 from datetime import datetime, timedelta
 import logging
 import sys
+import lake_snapshot
+from row_store import RowStore
 from opentelemetry import metrics
 from opentelemetry.sdk.metrics import MeterProvider
 from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
@@ -13,9 +15,11 @@ from opentelemetry.sdk.resources import Resource
 from opentelemetry.exporter.otlp.proto.grpc.metric_exporter import OTLPMetricExporter
 from opentelemetry.semconv.resource import ResourceAttributes
 
+bootstrapped = False
+
 def bootstrap():
     #Environment variables
-    global payload_dir, tmp_dir, ca_cert, interval, n_flights, n_passengers, logdir, loglvl, output_file, logger, log_level, formatter, stdout_handler, file_handler, meter, publish_exec_time, logger, last_exec_time_ms
+    global bootstrapped, payload_dir, tmp_dir, ca_cert, interval, n_flights, n_passengers, logdir, loglvl, output_file, write_batch_payload, logger, log_level, formatter, stdout_handler, file_handler, meter, publish_exec_time, logger, last_exec_time_ms
     payload_dir = os.getenv("PAYLOAD_DIR")
     tmp_dir = os.getenv("TMP_DIR")
     ca_cert= os.environ.get("CA_PATH")
@@ -25,6 +29,7 @@ def bootstrap():
     n_flights= int(os.environ.get("no_flights_per_cycle", "10"))
     n_passengers= int(os.environ.get("no_passengers_per_flight", "50"))
     output_file = f"{tmp_dir}/batch_payload.csv"
+    write_batch_payload = os.environ.get("write_batch_payload", "false").lower() == "true"
     otel_service_name = "data-lake"
     otel_exporter_endpoint = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
     otel_exporter_interval = int(os.environ.get("OTEL_EXPORT_INTERVAL"))
@@ -80,23 +85,54 @@ def bootstrap():
         description="Time spent unpackaging message, publishing to RMQ",
         callbacks=[exec_time_callback]
     )
+    bootstrapped = True
 
 def load_csv():
-    with open(f"{payload_dir}/flights.csv", newline="", encoding="utf-8") as csvfile:
-        return list(csv.DictReader(csvfile))
-
-
-def sample_lake():
-    bootstrap()
-    logger.info("**********Starting source data publisher**********")
-    logger.info("Deleting existing batch payload if any")
+    #Parsed once per change of flights.csv, see lake_snapshot. The store is shared
+    #across cycles, edits made by sample_lake only land on the row views.
+    return RowStore(*lake_snapshot.load(f"{payload_dir}/flights.csv"))
+
+class IndexPool:
+    """Row indices that have not been drawn yet in the current cycle.
+
+    Lazy Fisher-Yates shuffle: a draw swaps the picked slot with the last
+    live slot and pops it, and only slots that were swapped are stored.
+    Creating the pool is O(1) and each draw is O(1), so a whole cycle costs
+    O(rows drawn) no matter how large flights.csv is.
+    """
+
+    def __init__(self, size):
+        self.remaining = size
+        self._moved = {}
+
+    def __len__(self):
+        return self.remaining
+
+    def draw(self, k):
+        if k > self.remaining:
+            raise ValueError(f"Cannot draw {k} rows, only {self.remaining} left in pool")
+        picked = []
+        for _ in range(k):
+            j = random.randrange(self.remaining)
+            last = self.remaining - 1
+            picked.append(self._moved.get(j, j))
+            tail = self._moved.pop(last, last)
+            if j != last:
+                self._moved[j] = tail
+            self.remaining = last
+        return picked
+
+
+def sample_lake(shard=0, n_shards=1):
+    #Yields one list of RowViews per flight so the publisher can consume batches as they are drawn.
+    #With n_shards > 1 only rows shard, shard + n_shards, ... are drawn so workers never overlap.
+    #Set write_batch_payload=true to also dump the cycle to TMP_DIR/batch_payload.csv for debugging.
+    if not bootstrapped:
+        bootstrap()
+    logger.info("**********Sampling data lake**********")
     global last_exec_time_ms
     start = time.perf_counter()
-    if os.path.exists(output_file):
-        os.remove(output_file)
-        logger.info(f"Deleted existing file {output_file}")
-    else:
-        logger.info("No existing batch payload found")
+    sampling_ms = 0.0
     logger.info(f"Loading payloads from {payload_dir}/flights.csv")
     rows = load_csv()
     logger.info(f"Loaded {len(rows)} rows")
@@ -109,41 +145,45 @@ def sample_lake():
         "Pilot Name", "Flight Status"
     ]
 
-    for i in range(n_flights):
-        logger.info(f"Selecting {n_passengers} random rows")
-        sampled_rows = random.sample(rows, n_passengers)
-
-        ref_row = random.choice(sampled_rows)
-
-        dt = datetime.now()
-        dt += timedelta(
-            hours=random.randint(1, 2),
-            minutes=random.randint(0, 59)
-        )
-        uniform_departure_date = dt.strftime("%Y-%m-%d %H:%M")
-        uniform_arrival_airport = ref_row["Arrival Airport"]
-
-        logger.info(
-            f"Normalized batch to departure_date={uniform_departure_date}, "
-            f"arrival_airport={uniform_arrival_airport}"
-        )
-
-        for r in sampled_rows:
-            rows.remove(r)
-            r["Departure Date"] = uniform_departure_date
-            r["Arrival Airport"] = uniform_arrival_airport
-
-        file_exists = os.path.exists(output_file)
-
-        with open(f"{tmp_dir}/batch_payload.csv", "a", newline="", encoding="utf-8") as file:
-            writer = csv.DictWriter(file, fieldnames=header)
-
-            if not file_exists:
-                writer.writeheader() 
-                file_exists = True
-
-            writer.writerows(sampled_rows)
-
-        logger.info(f"Wrote batch payload to {tmp_dir}/batch_payload.csv")
-    duration_ms = (time.perf_counter() - start) * 1000
-    last_exec_time_ms = duration_ms
\ No newline at end of file
+    file = None
+    if write_batch_payload:
+        file = open(output_file, "w", newline="", encoding="utf-8")
+        writer = csv.DictWriter(file, fieldnames=header)
+        writer.writeheader()
+        logger.info(f"Writing batch payload to {output_file}")
+
+    try:
+        pool = IndexPool(len(range(shard, len(rows), n_shards)))
+        for i in range(n_flights):
+            logger.info(f"Selecting {n_passengers} random rows")
+            sampled_rows = [rows.view(shard + j * n_shards) for j in pool.draw(n_passengers)]
+
+            ref_row = random.choice(sampled_rows)
+
+            dt = datetime.now()
+            dt += timedelta(
+                hours=random.randint(1, 2),
+                minutes=random.randint(0, 59)
+            )
+            uniform_departure_date = dt.strftime("%Y-%m-%d %H:%M")
+            uniform_arrival_airport = ref_row["Arrival Airport"]
+
+            logger.info(
+                f"Normalized batch to departure_date={uniform_departure_date}, "
+                f"arrival_airport={uniform_arrival_airport}"
+            )
+
+            for r in sampled_rows:
+                r["Departure Date"] = uniform_departure_date
+                r["Arrival Airport"] = uniform_arrival_airport
+
+            if file:
+                writer.writerows(r.to_dict() for r in sampled_rows)
+
+            sampling_ms += (time.perf_counter() - start) * 1000
+            yield sampled_rows
+            start = time.perf_counter()
+    finally:
+        if file:
+            file.close()
+        last_exec_time_ms = sampling_ms
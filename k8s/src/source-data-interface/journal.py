@@ -0,0 +1,170 @@
+import os
+import re
+import gzip
+import json
+import time
+import logging
+import threading
+import collections
+
+#Ingestion journal for the load generator. append() only queues the record in memory, a writer
+#thread group-flushes the queue to <name>.jsonl when flush_bytes are buffered or flush_interval
+#has passed. Once the active file reaches segment_bytes it is rotated to <name>.<seq>.jsonl.gz
+#with an index file <name>.<seq>.idx next to it holding "<record number> <offset>" every
+#index_every records, offsets into the uncompressed segment.
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_RE = r"^{name}\.(\d{{6}})\.jsonl(\.gz)?$"
+
+class Journal:
+    def __init__(self, directory, name="ingested", flush_bytes=256 * 1024, flush_interval=1.0,
+                 segment_bytes=64 * 1024 * 1024, index_every=1000, max_buffered=1_000_000):
+        self.directory = directory
+        self.name = name
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.segment_bytes = segment_bytes
+        self.index_every = index_every
+        self.max_buffered = max_buffered
+        self.active_path = os.path.join(directory, f"{name}.jsonl")
+        self.dropped = 0
+        self.written = 0
+        self._buffer = collections.deque()
+        self._buffered_bytes = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._seq = max((seq for seq, _ in list_segments(directory, name)), default=0)
+        self._file = None
+        self._size = 0
+        self._thread = threading.Thread(target=self._run, name=f"journal-{name}", daemon=True)
+        self._thread.start()
+
+    def append(self, record):
+        #Hot path - never touches the file system
+        line = json.dumps(record).encode("utf-8") + b"\n"
+        with self._cond:
+            if len(self._buffer) >= self.max_buffered:
+                self.dropped += 1
+                if self.dropped % 10000 == 1:
+                    logger.warning(f"Journal {self.name} buffer full, dropped {self.dropped} records so far")
+                return
+            self._buffer.append(line)
+            self._buffered_bytes += len(line)
+            if self._buffered_bytes >= self.flush_bytes:
+                self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        #A segment left uncompressed means the previous process died mid rotation
+        for seq, path in list_segments(self.directory, self.name):
+            if not path.endswith(".gz"):
+                logger.info(f"Compressing leftover journal segment {path}")
+                compress_segment(path, self.index_every)
+        self._open_active()
+        while True:
+            with self._cond:
+                if not self._closed and self._buffered_bytes < self.flush_bytes:
+                    self._cond.wait(self.flush_interval)
+                lines, self._buffer = self._buffer, collections.deque()
+                self._buffered_bytes = 0
+                closed = self._closed
+            if lines:
+                self._write(lines)
+            if closed:
+                self._file.close()
+                return
+
+    def _open_active(self):
+        self._file = open(self.active_path, "ab")
+        self._size = self._file.tell()
+
+    def _write(self, lines):
+        #Records in a file that was closed or flushed are saved, the rest of the batch is lost on an error
+        saved = 0
+        try:
+            if self._file.closed:
+                #A rotation failed to reopen the active file
+                self._open_active()
+            for n, line in enumerate(lines, 1):
+                self._file.write(line)
+                self._size += len(line)
+                if self._size >= self.segment_bytes:
+                    self._file.close()
+                    saved = n
+                    self._rotate()
+            self._file.flush()
+            saved = len(lines)
+        except OSError as e:
+            logger.error(f"Journal {self.name} write failed, {len(lines) - saved} records lost: {e}")
+        self.written += saved
+
+    def _rotate(self):
+        #The active file is closed, it is renamed to the next segment and a new one opened
+        base = os.path.join(self.directory, f"{self.name}.{self._seq + 1:06d}")
+        try:
+            os.replace(self.active_path, f"{base}.jsonl")
+        except OSError as e:
+            logger.error(f"Journal {self.name} could not rotate {self.active_path}, appending to it still: {e}")
+            return
+        finally:
+            self._open_active()
+        self._seq += 1
+        start = time.perf_counter()
+        try:
+            compress_segment(f"{base}.jsonl", self.index_every)
+        except OSError as e:
+            #Its records are on disk, the next start compresses the leftover segment
+            logger.error(f"Journal {self.name} could not compress segment {base}.jsonl: {e}")
+            return
+        logger.info(f"Rotated journal segment {base}.jsonl.gz in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+def list_segments(directory, name):
+    #Rotated segments of journal `name` as (seq, path), oldest first
+    pattern = re.compile(SEGMENT_RE.format(name=re.escape(name)))
+    try:
+        entries = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    matches = (pattern.match(e) for e in entries)
+    return sorted((int(m.group(1)), os.path.join(directory, m.group(0))) for m in matches if m)
+
+def compress_segment(path, index_every):
+    #Gzips a rotated segment and writes its offset index in the same pass
+    base = path[:-len(".jsonl")]
+    offset = 0
+    with open(path, "rb") as src, gzip.open(f"{base}.jsonl.gz.tmp", "wb", compresslevel=6) as dst, \
+            open(f"{base}.idx", "w") as idx:
+        for n, line in enumerate(src):
+            if n % index_every == 0:
+                idx.write(f"{n} {offset}\n")
+            dst.write(line)
+            offset += len(line)
+    os.replace(f"{base}.jsonl.gz.tmp", f"{base}.jsonl.gz")
+    os.remove(path)
+
+def read_journal(directory, name="ingested"):
+    #Yields the records of journal `name` in the order they were written - rotated segments
+    #oldest first, then the active file. A torn last line from a crash is skipped.
+    segments = {}
+    for seq, path in list_segments(directory, name):
+        #If a crash left both forms of a segment the .gz is complete, it is only written before the .jsonl is removed
+        if seq not in segments or path.endswith(".gz"):
+            segments[seq] = path
+    paths = [segments[seq] for seq in sorted(segments)]
+    active = os.path.join(directory, f"{name}.jsonl")
+    if os.path.exists(active):
+        paths.append(active)
+    for path in paths:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Skipping unreadable journal line in {path}")
@@ -0,0 +1,141 @@
+import os
+import sys
+import csv
+import json
+import array
+import struct
+import logging
+
+#Binary snapshot of flights.csv so the data lake parses the CSV once instead of every cycle.
+#Layout: MAGIC | uint32 header length | JSON header | per column: values blob, codes blob
+#Columns are dictionary encoded - distinct strings joined by NUL plus one code per row, stored
+#in the narrowest unsigned array type that fits the number of distinct values.
+#The snapshot remembers the mtime/size of the CSV it came from and is rebuilt when either changes.
+
+SNAPSHOT_MAGIC = b"FLSNAP01"
+SNAPSHOT_SUFFIX = ".snap"
+VALUE_SEP = "\x00"
+
+logger = logging.getLogger(__name__)
+
+_cache = {}
+
+def source_key(csv_path):
+    st = os.stat(csv_path)
+    return st.st_mtime_ns, st.st_size
+
+def parse_csv(csv_path):
+    with open(csv_path, newline="", encoding="utf-8") as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader)
+        lookups = [{} for _ in header]
+        columns = [([], array.array("I")) for _ in header]
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < len(header):
+                row += [""] * (len(header) - len(row))
+            for lookup, (values, codes), value in zip(lookups, columns, row):
+                code = lookup.get(value)
+                if code is None:
+                    code = lookup[value] = len(values)
+                    values.append(value)
+                codes.append(code)
+    return header, [(values, narrow_codes(values, codes)) for values, codes in columns]
+
+def narrow_codes(values, codes):
+    for typecode in ("B", "H"):
+        if len(values) <= 1 << (8 * array.array(typecode).itemsize):
+            return array.array(typecode, codes)
+    return codes
+
+def write_snapshot(snap_path, key, header, columns):
+    blobs = []
+    meta = []
+    for name, (values, codes) in zip(header, columns):
+        values_blob = VALUE_SEP.join(values).encode("utf-8")
+        codes_blob = codes.tobytes()
+        blobs.extend((values_blob, codes_blob))
+        meta.append({
+            "name": name,
+            "n_values": len(values),
+            "typecode": codes.typecode,
+            "values_bytes": len(values_blob),
+            "codes_bytes": len(codes_blob),
+        })
+    head = json.dumps({
+        "source_mtime_ns": key[0],
+        "source_size": key[1],
+        "rows": len(columns[0][1]) if columns else 0,
+        "byteorder": sys.byteorder,
+        "columns": meta,
+    }).encode("utf-8")
+
+    tmp_path = f"{snap_path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack("<I", len(head)))
+        f.write(head)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_path, snap_path)
+
+def read_snapshot(snap_path, key):
+    with open(snap_path, "rb") as f:
+        data = f.read()
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        logger.warning(f"Ignoring snapshot {snap_path} - bad magic")
+        return None
+    offset = len(SNAPSHOT_MAGIC)
+    (head_len,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+    head = json.loads(data[offset:offset + head_len])
+    offset += head_len
+    if (head["source_mtime_ns"], head["source_size"]) != key:
+        logger.info(f"Snapshot {snap_path} is stale - source file changed")
+        return None
+
+    header = []
+    columns = []
+    for col in head["columns"]:
+        values_blob = data[offset:offset + col["values_bytes"]]
+        offset += col["values_bytes"]
+        values = values_blob.decode("utf-8").split(VALUE_SEP) if col["n_values"] else []
+        codes = array.array(col["typecode"])
+        codes.frombytes(data[offset:offset + col["codes_bytes"]])
+        offset += col["codes_bytes"]
+        if head["byteorder"] != sys.byteorder:
+            codes.byteswap()
+        header.append(col["name"])
+        columns.append((values, codes))
+    return header, columns
+
+def load(csv_path):
+    #Returns (header, columns) for csv_path, each column a (values, codes) pair.
+    #Order of preference: in-process cache, snapshot on disk, parsing the CSV.
+    key = source_key(csv_path)
+    cached = _cache.get(csv_path)
+    if cached and cached[0] == key:
+        logger.debug(f"Using in-memory table for {csv_path}")
+        return cached[1]
+
+    snap_path = csv_path + SNAPSHOT_SUFFIX
+    table = None
+    if os.path.exists(snap_path):
+        try:
+            table = read_snapshot(snap_path, key)
+        except (OSError, ValueError, KeyError, struct.error) as e:
+            logger.warning(f"Failed to read snapshot {snap_path}: {e}")
+        if table:
+            logger.info(f"Loaded snapshot {snap_path}")
+
+    if table is None:
+        logger.info(f"Parsing {csv_path} and writing snapshot {snap_path}")
+        table = parse_csv(csv_path)
+        try:
+            write_snapshot(snap_path, key, *table)
+        except OSError as e:
+            logger.warning(f"Could not write snapshot {snap_path}, continuing without it: {e}")
+
+    _cache[csv_path] = (key, table)
+    return table
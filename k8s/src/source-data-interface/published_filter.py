@@ -0,0 +1,167 @@
+import os
+import math
+import json
+import time
+import struct
+import hashlib
+import logging
+import threading
+
+#Bloom filter of passenger IDs the load generator already published, so flights.csv rows that come
+#back in later cycles are skipped here instead of being dropped by passenger-svc after a MySQL lookup.
+#False positives skip a passenger that was never published, at the configured rate. There are no
+#false negatives while the filter holds at most `capacity` IDs.
+#contains() is asked before a row is published, add() only once the broker has it - a row that is
+#never confirmed is not in the filter and comes round again.
+#The filter is saved under TMP_DIR and survives restarts. A saver thread writes it every
+#save_interval when it changed, off the publish path, and close() writes it a last time. It is
+#rebuilt empty once it is full or older than rebuild_interval, housekeep clears old passengers out
+#of the databases so they can be published again by then.
+#Layout: MAGIC | uint32 header length | JSON header | bit array
+
+FILTER_MAGIC = b"PBLOOM01"
+
+logger = logging.getLogger(__name__)
+
+class PublishedFilter:
+    def __init__(self, path, capacity=1_000_000, fp_rate=0.001, rebuild_interval=86400, save_interval=60):
+        self.path = path
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.rebuild_interval = rebuild_interval
+        self.save_interval = save_interval
+        self.n_bits = max(8, math.ceil(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._closed = False
+        if not self._load():
+            self._reset()
+        self._thread = threading.Thread(target=self._run, name="published-filter", daemon=True)
+        self._thread.start()
+
+    def _reset(self):
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.count = 0
+        self.created_at = time.time()
+        self._dirty = True
+
+    def _positions(self, key):
+        #Double hashing - k positions out of one 128 bit digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        return [(h1 + i * h2) % self.n_bits for i in range(self.n_hashes)]
+
+    def contains(self, key):
+        #True if key was (probably) published before, nothing is recorded
+        if self.count >= self.capacity or time.time() - self.created_at >= self.rebuild_interval:
+            self.rebuild()
+        bits = self.bits
+        if all(bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key)):
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, key):
+        #Records key as published, call once the broker has confirmed it
+        positions = self._positions(key)
+        with self._lock:
+            bits = self.bits
+            if all(bits[p >> 3] & (1 << (p & 7)) for p in positions):
+                return
+            for p in positions:
+                bits[p >> 3] |= 1 << (p & 7)
+            self.count += 1
+            self._dirty = True
+
+    def rebuild(self):
+        logger.info(
+            f"Rebuilding published passenger filter after {self.count} IDs "
+            f"and {(time.time() - self.created_at) / 3600:.1f}h"
+        )
+        self.rebuilds += 1
+        with self._lock:
+            self._reset()
+        with self._cond:
+            self._cond.notify()
+
+    def fill_ratio(self):
+        return self.count / self.capacity
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed:
+                    self._cond.wait(self.save_interval)
+                closed = self._closed
+            self.save()
+            if closed:
+                return
+
+    def save(self):
+        #Copies the bit array under the lock and writes the copy, add() only waits for the copy
+        with self._lock:
+            if not self._dirty:
+                return
+            bits = bytes(self.bits)
+            head = json.dumps({
+                "capacity": self.capacity,
+                "fp_rate": self.fp_rate,
+                "n_bits": self.n_bits,
+                "n_hashes": self.n_hashes,
+                "count": self.count,
+                "created_at": self.created_at,
+            }).encode("utf-8")
+            self._dirty = False
+        tmp_path = f"{self.path}.tmp.{os.getpid()}"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(FILTER_MAGIC)
+                f.write(struct.pack("<I", len(head)))
+                f.write(head)
+                f.write(bits)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            with self._lock:
+                self._dirty = True
+            logger.warning(f"Could not save published passenger filter {self.path}: {e}")
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+            if data[:len(FILTER_MAGIC)] != FILTER_MAGIC:
+                logger.warning(f"Ignoring published passenger filter {self.path} - bad magic")
+                return False
+            offset = len(FILTER_MAGIC)
+            (head_len,) = struct.unpack_from("<I", data, offset)
+            offset += 4
+            head = json.loads(data[offset:offset + head_len])
+            offset += head_len
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f"Failed to read published passenger filter {self.path}: {e}")
+            return False
+        if (head["n_bits"], head["n_hashes"]) != (self.n_bits, self.n_hashes):
+            logger.info(f"Published passenger filter {self.path} was sized differently, starting a new one")
+            return False
+        self.bits = bytearray(data[offset:])
+        if len(self.bits) != (self.n_bits + 7) // 8:
+            logger.warning(f"Ignoring truncated published passenger filter {self.path}")
+            return False
+        self.count = head["count"]
+        self.created_at = head["created_at"]
+        logger.info(f"Loaded published passenger filter {self.path} with {self.count} IDs")
+        return True
@@ -0,0 +1,81 @@
+import os
+import json
+import time
+import heapq
+import importlib
+import pika
+from journal import read_journal
+
+#Replays a recorded ingestion journal into source_data_intake for reproducible benchmark runs.
+#Run inside the source-data-interface image with: python -u replay.py
+#  replay_journal    journal name(s) under replay_directory, comma separated (default ingested)
+#                    several journals, e.g. ingested-w0,ingested-w1, are merged by original send time
+#  replay_directory  where the journals live (default TMP_DIR)
+#  replay_speed      1 = original timing, N = N times faster, max = as fast as possible
+#Passengers already in the hq database are dropped by passenger-svc, reset it between runs.
+
+sdi = importlib.import_module("source-data-interface")
+
+def bootstrap():
+    global replay_dir, replay_journals, replay_speed, logger
+    sdi.bootstrap()
+    logger = sdi.logger
+    replay_dir = os.environ.get("replay_directory", sdi.tmp_dir)
+    replay_journals = [n.strip() for n in os.environ.get("replay_journal", "ingested").split(",") if n.strip()]
+    speed = os.environ.get("replay_speed", "1").lower()
+    replay_speed = 0.0 if speed in ("max", "0") else float(speed)
+
+def recorded():
+    streams = [read_journal(replay_dir, name) for name in replay_journals]
+    if len(streams) == 1:
+        return streams[0]
+    return heapq.merge(*streams, key=lambda r: r.get("sent_at", 0.0))
+
+def main():
+    bootstrap()
+    logger.info("**********Starting journal replay**********")
+    speed = f"{replay_speed}x" if replay_speed else "max"
+    logger.info(f"Replaying {', '.join(replay_journals)} from {replay_dir} at {speed} speed")
+    connection = sdi.get_rmq_connection()
+    channel = connection.channel()
+    channel.queue_declare(queue=sdi.QUEUE_NAME, durable=True)
+
+    start = time.perf_counter()
+    start_wall = time.time()
+    first_sent = None
+    replayed = 0
+    try:
+        for record in recorded():
+            original = record.get("sent_at")
+            due = time.perf_counter()
+            if replay_speed and original is not None:
+                if first_sent is None:
+                    first_sent = original
+                due = start + (original - first_sent) / replay_speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            message = sdi.build_message(record)
+            message["scheduled_at"] = round(start_wall + (due - start), 6)
+            message["sent_at"] = round(time.time(), 6)
+            message["original_sent_at"] = original
+            channel.basic_publish(
+                exchange="",
+                routing_key=sdi.QUEUE_NAME,
+                body=json.dumps(message),
+                properties=pika.BasicProperties(
+                    delivery_mode=2
+                )
+            )
+            replayed += 1
+            logger.debug(f"Replayed passenger {message['passenger_id']}")
+    except KeyboardInterrupt:
+        logger.info("Stopping replay")
+    finally:
+        connection.close()
+    elapsed = time.perf_counter() - start
+    logger.info(f"Replayed {replayed} messages in {elapsed:.1f}s - {replayed / elapsed if elapsed else 0:.1f} msg/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import lake_snapshot
+
+#Column store for passenger rows. Each column keeps its distinct strings once plus a compact
+#array of codes, so repeated airports, countries and statuses cost a byte or two per row
+#instead of a dict entry each. Callers get RowView objects that read like the old row dicts.
+
+class RowStore:
+    def __init__(self, header, columns):
+        self.header = list(header)
+        self._index = {name: i for i, name in enumerate(self.header)}
+        self._values = [values for values, _ in columns]
+        self._codes = [codes for _, codes in columns]
+        self._len = len(self._codes[0]) if self._codes else 0
+
+    @classmethod
+    def from_csv(cls, csv_path):
+        return cls(*lake_snapshot.parse_csv(csv_path))
+
+    def __len__(self):
+        return self._len
+
+    def value(self, i, name):
+        col = self._index[name]
+        return self._values[col][self._codes[col][i]]
+
+    def view(self, i):
+        if not 0 <= i < self._len:
+            raise IndexError(f"row {i} out of range for store of {self._len} rows")
+        return RowView(self, i)
+
+    def __getitem__(self, i):
+        return self.view(i)
+
+class RowView:
+    #Lightweight handle on one row. Writes go to a per-view overrides dict so the
+    #shared store is never edited and can be reused across cycles.
+    __slots__ = ("store", "index", "overrides")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+        self.overrides = None
+
+    def __getitem__(self, name):
+        if self.overrides and name in self.overrides:
+            return self.overrides[name]
+        return self.store.value(self.index, name)
+
+    def __setitem__(self, name, value):
+        if self.overrides is None:
+            self.overrides = {}
+        self.overrides[name] = value
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.store.header)
+
+    def to_dict(self):
+        return {name: self[name] for name in self.store.header}
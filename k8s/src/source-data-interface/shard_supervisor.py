@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import queue
+import random
+import signal
+import logging
+import threading
+import multiprocessing
+
+#Runs N publisher workers as separate processes and merges what they report into one figure.
+#Each worker records one latency sample per message in a WorkerStats, a reporter thread ships
+#the counters and a bounded sample of latencies to the supervisor every report interval.
+
+logger = logging.getLogger(__name__)
+
+MAX_SAMPLES_PER_REPORT = 2000
+
+class WorkerStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.published = 0
+        self._samples = []
+        self._seen = 0
+
+    def record(self, latency_ms):
+        #Reservoir sampling keeps the shipped sample unbiased at any message rate
+        with self._lock:
+            self.published += 1
+            self._seen += 1
+            if len(self._samples) < MAX_SAMPLES_PER_REPORT:
+                self._samples.append(latency_ms)
+            else:
+                j = random.randrange(self._seen)
+                if j < MAX_SAMPLES_PER_REPORT:
+                    self._samples[j] = latency_ms
+
+    def drain(self):
+        with self._lock:
+            samples, self._samples, self._seen = self._samples, [], 0
+            return self.published, samples
+
+def _report_loop(shard, stats, out, interval):
+    while True:
+        time.sleep(interval)
+        published, samples = stats.drain()
+        out.put((shard, os.getpid(), published, samples))
+
+def _worker_entry(target, shard, n_shards, out, interval):
+    stats = WorkerStats()
+    threading.Thread(target=_report_loop, args=(shard, stats, out, interval), daemon=True).start()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        target(shard, n_shards, stats)
+    finally:
+        published, samples = stats.drain()
+        out.put((shard, os.getpid(), published, samples))
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def supervise(target, n_workers, report_interval=10, on_report=None):
+    #target(shard, n_shards, stats) runs one worker, it must call stats.record(latency_ms) per message
+    out = multiprocessing.Queue()
+    workers = {}
+    for shard in range(n_workers):
+        p = multiprocessing.Process(
+            target=_worker_entry,
+            args=(target, shard, n_workers, out, report_interval),
+            name=f"publisher-{shard}",
+            daemon=True
+        )
+        p.start()
+        workers[shard] = p
+        logger.info(f"Started publisher worker {shard} (pid {p.pid})")
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    published = {shard: 0 for shard in workers}
+    run_start = window_start = time.perf_counter()
+    window_published = 0
+    samples = []
+
+    def report():
+        nonlocal window_start, window_published, samples
+        elapsed = time.perf_counter() - window_start
+        r = build_report(workers, published, window_published, elapsed, samples)
+        log_report(r)
+        if on_report:
+            on_report(r)
+        window_start, window_published, samples = time.perf_counter(), 0, []
+
+    def collect(timeout):
+        nonlocal window_published
+        try:
+            shard, pid, total, batch = out.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        window_published += total - published[shard]
+        published[shard] = total
+        samples.extend(batch)
+        return True
+
+    try:
+        while any(p.is_alive() for p in workers.values()):
+            collect(1)
+            if time.perf_counter() - window_start >= report_interval:
+                report()
+        while collect(0.1):
+            pass
+        report()
+        run_s = time.perf_counter() - run_start
+        total = sum(published.values())
+        logger.info(f"[supervisor] Workers finished: {total} messages in {run_s:.1f}s - {total / run_s:.1f} msg/s overall")
+        for shard, p in workers.items():
+            if p.exitcode:
+                logger.error(f"Publisher worker {shard} exited with code {p.exitcode}")
+    except (KeyboardInterrupt, SystemExit):
+        logger.info("Stopping publisher workers")
+    finally:
+        for p in workers.values():
+            if p.is_alive():
+                p.terminate()
+        for p in workers.values():
+            p.join(timeout=10)
+
+def build_report(workers, published, window_published, elapsed, samples):
+    samples = sorted(samples)
+    return {
+        "workers": len(workers),
+        "alive": sum(p.is_alive() for p in workers.values()),
+        "published_total": sum(published.values()),
+        "published_per_worker": dict(published),
+        "rate": window_published / elapsed if elapsed else 0.0,
+        "latency_p50_ms": percentile(samples, 0.50),
+        "latency_p95_ms": percentile(samples, 0.95),
+        "latency_p99_ms": percentile(samples, 0.99),
+        "latency_max_ms": samples[-1] if samples else 0.0,
+    }
+
+def log_report(report):
+    logger.info(
+        f"[supervisor] {report['alive']}/{report['workers']} workers, {report['rate']:.1f} msg/s, "
+        f"{report['published_total']} total, latency p50={report['latency_p50_ms']:.2f}ms "
+        f"p95={report['latency_p95_ms']:.2f}ms p99={report['latency_p99_ms']:.2f}ms "
+        f"max={report['latency_max_ms']:.2f}ms, per worker {report['published_per_worker']}"
+    )
@@ -1,13 +1,17 @@
 import os
-import csv
 import json
 import time
 import ssl
-import random
 import pika
 import logging
 import sys
 from data_lake import sample_lake
+from synthetic_lake import sample_synthetic
+from confirm_publisher import ConfirmPublisher
+from traffic import Pacer
+from shard_supervisor import supervise
+from journal import Journal
+from published_filter import PublishedFilter
 from opentelemetry import metrics
 from opentelemetry.sdk.metrics import MeterProvider
 from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
@@ -17,7 +21,7 @@ from opentelemetry.semconv.resource import ResourceAttributes
 
 def bootstrap():
     #Environment variables
-    global tmp_dir, ca_cert, rmq_url, rmq_port, rmq_username, rmq_password, interval, QUEUE_NAME, PUBLISH_INTERVAL, n_flights, n_passengers, logdir, loglvl, logger, log_level, formatter, stdout_handler, file_handler, meter, publish_exec_time, last_exec_time_ms
+    global tmp_dir, ca_cert, rmq_url, rmq_port, rmq_username, rmq_password, interval, QUEUE_NAME, PUBLISH_INTERVAL, n_flights, n_passengers, lake_source, dedup_filter, dedup_capacity, dedup_fp_rate, dedup_rebuild_interval, publish_mode, confirm_window, confirm_report_interval, traffic_profile, traffic_mode, publisher_workers, journal_flush_bytes, journal_flush_interval, journal_segment_bytes, logdir, loglvl, logger, log_level, formatter, stdout_handler, file_handler, meter, publish_exec_time, publish_confirm_rate, publish_schedule_lag, publish_combined_rate, publish_combined_p99, dedup_hits, dedup_misses, dedup_fill, last_exec_time_ms, last_confirm_rate, last_schedule_lag_ms, last_combined_rate, last_combined_p99_ms
     tmp_dir = os.getenv("TMP_DIR")
     ca_cert= os.environ.get("CA_PATH")
     rmq_url = os.environ.get("RMQ_HOST")
@@ -26,15 +30,37 @@ def bootstrap():
     rmq_password = os.environ.get("RMQ_PW")
     QUEUE_NAME = "source_data_intake"
     PUBLISH_INTERVAL = int(os.environ.get("INT_PERIOD"))
+    #Without an explicit profile keep the old behaviour - one message every INT_PERIOD seconds
+    default_profile = f"constant:rate={1 / PUBLISH_INTERVAL}" if PUBLISH_INTERVAL > 0 else "unlimited"
+    traffic_profile = os.environ.get("traffic_profile", default_profile)
+    traffic_mode = os.environ.get("traffic_mode", "open" if "traffic_profile" in os.environ else "closed").lower()
     logdir = os.environ.get("log_directory", ".")
     loglvl = os.environ.get("log_level", "INFO").upper()
     n_flights= int(os.environ.get("no_flights_per_cycle", "10"))
     n_passengers= int(os.environ.get("no_passengers_per_flight", "50"))
+    #csv draws passengers from flights.csv, synthetic generates unlimited unique ones like them
+    lake_source = os.environ.get("lake_source", "csv").lower()
+    #Skip passengers this generator already published, synthetic IDs never repeat so it is off there by default
+    dedup_filter = os.environ.get("dedup_filter", "true" if lake_source == "csv" else "false").lower() == "true"
+    dedup_capacity = int(os.environ.get("dedup_capacity", "1000000"))
+    dedup_fp_rate = float(os.environ.get("dedup_fp_rate", "0.001"))
+    dedup_rebuild_interval = int(os.environ.get("dedup_rebuild_hours", "24")) * 3600
+    publish_mode = os.environ.get("publish_mode", "basic").lower()
+    confirm_window = int(os.environ.get("confirm_window", "500"))
+    confirm_report_interval = int(os.environ.get("confirm_report_interval", "10"))
+    publisher_workers = int(os.environ.get("publisher_workers", "1"))
+    journal_flush_bytes = int(os.environ.get("journal_flush_kb", "256")) * 1024
+    journal_flush_interval = int(os.environ.get("journal_flush_interval_ms", "1000")) / 1000
+    journal_segment_bytes = int(os.environ.get("journal_segment_mb", "64")) * 1024 * 1024
     otel_service_name = "source-data-interface"
     otel_exporter_endpoint = os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT")
     otel_exporter_interval = int(os.environ.get("OTEL_EXPORT_INTERVAL"))
     release_version = os.environ.get("release_version")
     last_exec_time_ms = 0.0
+    last_confirm_rate = 0.0
+    last_schedule_lag_ms = 0.0
+    last_combined_rate = 0.0
+    last_combined_p99_ms = 0.0
 
     #logging 
     log_level = getattr(logging, loglvl, logging.INFO)
@@ -86,7 +112,78 @@ def bootstrap():
         callbacks=[exec_time_callback]
     )
 
-def get_rmq_connection():
+    def confirm_rate_callback(options):
+        return [metrics.Observation(last_confirm_rate)]
+
+    publish_confirm_rate = meter.create_observable_gauge(
+        "application.publish.confirmed_rate",
+        unit="{message}/s",
+        description="Messages confirmed by RabbitMQ per second in confirm publish mode",
+        callbacks=[confirm_rate_callback]
+    )
+
+    def schedule_lag_callback(options):
+        return [metrics.Observation(last_schedule_lag_ms)]
+
+    publish_schedule_lag = meter.create_observable_gauge(
+        "application.publish.schedule_lag",
+        unit="ms",
+        description="Actual minus scheduled send time of the last message, grows under coordinated omission",
+        callbacks=[schedule_lag_callback]
+    )
+
+    #Only reported by the supervisor when publisher_workers > 1
+    def combined_rate_callback(options):
+        return [metrics.Observation(last_combined_rate)]
+
+    publish_combined_rate = meter.create_observable_gauge(
+        "application.publish.combined_rate",
+        unit="{message}/s",
+        description="Messages per second published by all publisher workers together",
+        callbacks=[combined_rate_callback]
+    )
+
+    def combined_p99_callback(options):
+        return [metrics.Observation(last_combined_p99_ms)]
+
+    publish_combined_p99 = meter.create_observable_gauge(
+        "application.publish.combined_latency_p99",
+        unit="ms",
+        description="p99 publish latency across all publisher workers",
+        callbacks=[combined_p99_callback]
+    )
+
+    def dedup_hits_callback(options):
+        return [metrics.Observation(published_filter.hits if published_filter else 0)]
+
+    dedup_hits = meter.create_observable_counter(
+        "application.dedup.hits",
+        unit="{passenger}",
+        description="Passengers skipped because the filter says they were already published",
+        callbacks=[dedup_hits_callback]
+    )
+
+    def dedup_misses_callback(options):
+        return [metrics.Observation(published_filter.misses if published_filter else 0)]
+
+    dedup_misses = meter.create_observable_counter(
+        "application.dedup.misses",
+        unit="{passenger}",
+        description="Passengers not in the filter and sent to be published, added to it once confirmed",
+        callbacks=[dedup_misses_callback]
+    )
+
+    def dedup_fill_callback(options):
+        return [metrics.Observation(published_filter.fill_ratio() if published_filter else 0.0)]
+
+    dedup_fill = meter.create_observable_gauge(
+        "application.dedup.fill_ratio",
+        unit="1",
+        description="IDs in the published passenger filter relative to its capacity, rebuilt at 1",
+        callbacks=[dedup_fill_callback]
+    )
+
+def get_rmq_parameters():
     credentials = pika.PlainCredentials(
         rmq_username,
         rmq_password
@@ -101,7 +198,7 @@ def get_rmq_connection():
         server_hostname=rmq_url
     )
 
-    params = pika.ConnectionParameters(
+    return pika.ConnectionParameters(
         host=rmq_url,
         port=rmq_port,
         credentials=credentials,
@@ -110,72 +207,179 @@ def get_rmq_connection():
         blocked_connection_timeout=30
     )
 
-    return pika.BlockingConnection(params)
+def get_rmq_connection():
+    return pika.BlockingConnection(get_rmq_parameters())
 
 
-def load_csv():
-    with open(f"{tmp_dir}/batch_payload.csv", newline="", encoding="utf-8") as csvfile:
-        return list(csv.DictReader(csvfile))
+def build_message(row):
+    return {
+        "passenger_id": row["Passenger ID"],
+        "first_name": row["First Name"],
+        "last_name": row["Last Name"],
+        "age": int(row["Age"]),
+        "nationality": row["Nationality"],
+        "departure_date": row["Departure Date"],
+        "arrival_airport": row["Arrival Airport"],
+        "flight_status": row["Flight Status"],
+        "ingested_at": int(time.time())
+    }
 
 
-def main():
-    bootstrap()
-    logger.info("**********Starting source data publisher**********")
+def stamp_message(row, scheduled_at):
+    #Records when the traffic profile wanted the message out and when it actually went
+    global last_schedule_lag_ms
+    message = build_message(row)
+    message["scheduled_at"] = round(scheduled_at, 6)
+    message["sent_at"] = round(time.time(), 6)
+    last_schedule_lag_ms = (message["sent_at"] - message["scheduled_at"]) * 1000
+    return message
+
+def journal_record(row, message):
+    return {**row.to_dict(), "scheduled_at": message["scheduled_at"], "sent_at": message["sent_at"]}
+
+def generate_rows(shard=0, n_shards=1):
+    #Endless stream of rows, one data lake cycle after another
+    sample = sample_synthetic if lake_source == "synthetic" else sample_lake
+    while True:
+        logger.info(f"Sampling new batch payloads from data lake ({lake_source})")
+        fresh = 0
+        for batch in sample(shard, n_shards):
+            for row in batch:
+                if published_filter and published_filter.contains(row["Passenger ID"]):
+                    logger.debug(f"Skipping already published passenger {row['Passenger ID']}")
+                    continue
+                fresh += 1
+                yield row
+        if published_filter and not fresh:
+            #Everything drawn was published before, nothing new until the filter is rebuilt
+            logger.warning("Whole cycle was already published, waiting before sampling again")
+            time.sleep(10)
+
+def encode_confirm_message(row, scheduled_at):
+    message = stamp_message(row, scheduled_at)
+    return json.dumps(message), journal_record(row, message)
+
+def on_confirmed(record, latency_ms):
+    global last_confirm_rate
+    journal.append(record)
+    if published_filter:
+        published_filter.add(record["Passenger ID"])
+    last_confirm_rate = publisher.stats()["confirmed_per_s"]
+    if worker_stats:
+        worker_stats.record(latency_ms)
+
+def main_confirm(shard=0, n_shards=1):
+    global publisher
+    logger.info(f"Publishing to {QUEUE_NAME} with publisher confirms, window={confirm_window}")
+    publisher = ConfirmPublisher(
+        get_rmq_parameters(),
+        QUEUE_NAME,
+        generate_rows(shard, n_shards),
+        encode_confirm_message,
+        window=confirm_window,
+        report_interval=confirm_report_interval,
+        on_confirm=on_confirmed,
+        pacer=Pacer(traffic_profile, traffic_mode, scale=1 / n_shards)
+    )
+    try:
+        publisher.run()
+    except KeyboardInterrupt:
+        logger.info("Shutting down publisher")
+        publisher.stop()
+    s = publisher.stats()
+    logger.info(f"Confirmed {s['confirmed']} messages in {s['elapsed_s']:.1f}s - {s['confirmed_per_s']:.1f} msg/s")
+
+def main_basic(shard=0, n_shards=1):
     logger.info(f"Connecting to RabbitMQ at {rmq_url}:{rmq_port}")
     connection = get_rmq_connection()
     channel = connection.channel()
     logger.info(f"Declaring queue {QUEUE_NAME}")
     channel.queue_declare(queue=QUEUE_NAME, durable=True)
     global last_exec_time_ms
+    pacer = Pacer(traffic_profile, traffic_mode, scale=1 / n_shards)
     try:
-        while True:
-            logger.info(f"Loading payloads from {tmp_dir}/batch_payload.csv")
-            sample_lake()
-            rows = load_csv()
-            logger.info(f"Loaded {len(rows)} rows")
-            for n in range(n_flights * n_passengers):
-                start = time.perf_counter()
-                logger.info("Publishing new message from source data")
-                row = random.choice(rows)
-                rows.remove(row)
-
-                message = {
-                    "passenger_id": row["Passenger ID"],
-                    "first_name": row["First Name"],
-                    "last_name": row["Last Name"],
-                    "age": int(row["Age"]),
-                    "nationality": row["Nationality"],
-                    "departure_date": row["Departure Date"],
-                    "arrival_airport": row["Arrival Airport"],
-                    "flight_status": row["Flight Status"],
-                    "ingested_at": int(time.time())
-                }
-
-                body = json.dumps(message)
-                logger.debug(f"Publishing message: {body}")
-
-                channel.basic_publish(
-                    exchange="",
-                    routing_key=QUEUE_NAME,
-                    body=body,
-                    properties=pika.BasicProperties(
-                        delivery_mode=2
-                    )
+        for row in generate_rows(shard, n_shards):
+            scheduled_at = pacer.wait()
+            start = time.perf_counter()
+            logger.info("Publishing new message from source data")
+            message = stamp_message(row, scheduled_at)
+
+            body = json.dumps(message)
+            logger.debug(f"Publishing message: {body}")
+
+            channel.basic_publish(
+                exchange="",
+                routing_key=QUEUE_NAME,
+                body=body,
+                properties=pika.BasicProperties(
+                    delivery_mode=2
                 )
+            )
+            pacer.sent()
+            if published_filter:
+                published_filter.add(row["Passenger ID"])
 
-                logger.info(f"Published random passenger {message['passenger_id']}")
+            logger.info(f"Published random passenger {message['passenger_id']}")
 
-                with open(f"{tmp_dir}/ingested.jsonl", "a") as f: 
-                    f.write(json.dumps(row) + "\n")
+            journal.append(journal_record(row, message))
 
-                duration_ms = (time.perf_counter() - start) * 1000
-                last_exec_time_ms = duration_ms
-                
-                time.sleep(PUBLISH_INTERVAL)
+            duration_ms = (time.perf_counter() - start) * 1000
+            last_exec_time_ms = duration_ms
+            if worker_stats:
+                worker_stats.record(duration_ms)
     except KeyboardInterrupt:
         logger.info("Shutting down publisher")
     finally:
         connection.close()
 
+published_filter = None
+
+def run_publisher(shard=0, n_shards=1, stats=None):
+    #One publisher - the whole service when publisher_workers=1, otherwise a forked worker
+    #with its own RabbitMQ connection and every n_shards-th row of flights.csv
+    global worker_stats, journal, published_filter
+    worker_stats = stats
+    if n_shards > 1:
+        logger.info(f"Publisher worker {shard}/{n_shards} starting")
+    #Each worker keeps its own journal so no two processes append to the same file
+    journal = Journal(
+        tmp_dir,
+        name="ingested" if n_shards == 1 else f"ingested-w{shard}",
+        flush_bytes=journal_flush_bytes,
+        flush_interval=journal_flush_interval,
+        segment_bytes=journal_segment_bytes
+    )
+    if dedup_filter:
+        published_filter = PublishedFilter(
+            os.path.join(tmp_dir, "published.bloom" if n_shards == 1 else f"published-w{shard}.bloom"),
+            capacity=dedup_capacity,
+            fp_rate=dedup_fp_rate,
+            rebuild_interval=dedup_rebuild_interval
+        )
+    try:
+        if publish_mode == "confirm":
+            main_confirm(shard, n_shards)
+        else:
+            main_basic(shard, n_shards)
+    finally:
+        journal.close()
+        if published_filter:
+            published_filter.close()
+
+def on_supervisor_report(report):
+    global last_combined_rate, last_combined_p99_ms
+    last_combined_rate = report["rate"]
+    last_combined_p99_ms = report["latency_p99_ms"]
+
+def main():
+    bootstrap()
+    logger.info("**********Starting source data publisher**********")
+    logger.info(f"Traffic profile {traffic_profile} ({traffic_mode} loop)")
+    if publisher_workers > 1:
+        logger.info(f"Forking {publisher_workers} publisher workers")
+        supervise(run_publisher, publisher_workers, confirm_report_interval, on_supervisor_report)
+    else:
+        run_publisher()
+
 if __name__ == "__main__":
     main()
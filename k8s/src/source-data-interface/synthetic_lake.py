@@ -0,0 +1,100 @@
+import time
+import logging
+from datetime import datetime
+import numpy as np
+import data_lake
+from row_store import RowStore
+
+#Synthetic passenger source for soak tests that need more unique passengers than flights.csv has.
+#Distributions are learned from flights.csv by drawing whole rows at random per column group, so
+#e.g. an airport keeps its own country and continent and first names keep their gender. Passenger
+#IDs are generated, never repeat within a run and never clash with the 6 character IDs of flights.csv.
+#A cycle is generated in one go with numpy and handed out as RowViews, same as sample_lake.
+
+logger = logging.getLogger(__name__)
+
+#Columns drawn together from the same source row
+COLUMN_GROUPS = [
+    ("First Name", "Gender"),
+    ("Last Name",),
+    ("Age",),
+    ("Nationality",),
+    ("Airport Name", "Airport Country Code", "Country Name", "Airport Continent", "Continents"),
+    ("Pilot Name",),
+    ("Flight Status",),
+]
+#Same value for every passenger of a flight
+PER_FLIGHT = ("Departure Date", "Arrival Airport")
+ID_COLUMN = "Passenger ID"
+
+ID_ALPHABET = np.frombuffer(b"0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz", dtype=np.uint8)
+ID_RUN_DIGITS = 4
+ID_SEQ_DIGITS = 6
+ID_POWERS = len(ID_ALPHABET) ** np.arange(ID_RUN_DIGITS + ID_SEQ_DIGITS - 1, -1, -1, dtype=np.int64)
+
+class SyntheticLake:
+    def __init__(self, store, shard=0, n_shards=1, seed=None):
+        self.store = store
+        self.header = store.header
+        self.rng = np.random.default_rng(seed)
+        self._codes = {name: np.asarray(store._codes[i]) for i, name in enumerate(self.header)}
+        self._values = {name: store._values[i] for i, name in enumerate(self.header)}
+        grouped = {name for group in COLUMN_GROUPS for name in group}
+        self.groups = [tuple(n for n in group if n in self._codes) for group in COLUMN_GROUPS]
+        self.groups += [(name,) for name in self.header if name not in grouped and name not in PER_FLIGHT and name != ID_COLUMN]
+        self.groups = [group for group in self.groups if group]
+        #IDs are <run><seq> in base 62. The run part comes from the start time so restarts get a fresh
+        #range, workers take every n_shards-th seq so they never overlap.
+        run = int(time.time()) % len(ID_ALPHABET) ** ID_RUN_DIGITS
+        self._next_id = run * len(ID_ALPHABET) ** ID_SEQ_DIGITS + shard
+        self._id_step = n_shards
+
+    def passenger_ids(self, n):
+        numbers = self._next_id + self._id_step * np.arange(n, dtype=np.int64)
+        self._next_id += self._id_step * n
+        digits = ID_ALPHABET[(numbers[:, None] // ID_POWERS) % len(ID_ALPHABET)]
+        return digits.view(f"S{len(ID_POWERS)}").ravel().astype("U").tolist()
+
+    def departure_dates(self, n_flights):
+        #Same window as sample_lake - 1 to 2 hours from now plus 0 to 59 minutes, for all flights at once
+        now = np.datetime64(datetime.now(), "m")
+        offsets = self.rng.integers(1, 3, n_flights) * 60 + self.rng.integers(0, 60, n_flights)
+        departures = now + offsets.astype("timedelta64[m]")
+        return np.datetime_as_string(departures, unit="m").astype("U").tolist()
+
+    def cycle(self, n_flights, n_passengers):
+        #One RowStore for the whole cycle, passengers of flight i are rows i*n_passengers onwards
+        n = n_flights * n_passengers
+        columns = {}
+        for group in self.groups:
+            src = self.rng.integers(0, len(self.store), n)
+            for name in group:
+                columns[name] = (self._values[name], self._codes[name][src].tolist())
+        flight = np.repeat(np.arange(n_flights), n_passengers)
+        columns[ID_COLUMN] = (self.passenger_ids(n), list(range(n)))
+        #"YYYY-MM-DDTHH:MM" -> "YYYY-MM-DD HH:MM" like sample_lake writes it
+        columns["Departure Date"] = ([d.replace("T", " ") for d in self.departure_dates(n_flights)], flight.tolist())
+        arrivals = self._codes["Arrival Airport"][self.rng.integers(0, len(self.store), n_flights)]
+        columns["Arrival Airport"] = (self._values["Arrival Airport"], arrivals[flight].tolist())
+        return RowStore(self.header, [columns[name] for name in self.header])
+
+lake = None
+lake_shard = None
+
+def sample_synthetic(shard=0, n_shards=1):
+    #Drop in for data_lake.sample_lake - yields one list of RowViews per flight
+    global lake, lake_shard
+    if not data_lake.bootstrapped:
+        data_lake.bootstrap()
+    start = time.perf_counter()
+    if lake is None or lake_shard != (shard, n_shards):
+        logger.info(f"Learning passenger distributions from {data_lake.payload_dir}/flights.csv")
+        lake = SyntheticLake(data_lake.load_csv(), shard, n_shards)
+        lake_shard = (shard, n_shards)
+    n_flights, n_passengers = data_lake.n_flights, data_lake.n_passengers
+    store = lake.cycle(n_flights, n_passengers)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    data_lake.last_exec_time_ms = elapsed_ms
+    logger.info(f"Generated {len(store)} synthetic passengers on {n_flights} flights in {elapsed_ms:.1f}ms")
+    for i in range(n_flights):
+        yield [store.view(j) for j in range(i * n_passengers, (i + 1) * n_passengers)]
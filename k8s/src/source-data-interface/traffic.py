@@ -0,0 +1,130 @@
+import math
+import time
+import logging
+
+#Traffic profiles and a drift-free pacer for the load generator.
+#A profile maps seconds since start to a target rate in messages/s and is configured with a spec
+#string "<name>:<key>=<value>,..." e.g. "ramp:start=10,end=500,duration=600".
+#
+#  constant:rate=50                                      fixed rate
+#  ramp:start=10,end=500,duration=600                    linear ramp, holds `end` afterwards
+#  diurnal:base=5,peak=200,period=86400,phase=0          cosine day curve, base at t=0, peak at period/2
+#  burst:base=5,burst=300,every=900,length=60            flight departure waves on top of a base rate
+#  step:rates=10|50|100|200,duration=300                 step load, holds the last rate afterwards
+#  unlimited                                             no pacing, as fast as the publisher goes
+#
+#Open loop keeps an absolute schedule - if a send is late the next ones are not pushed back, which
+#is what lets scheduled vs actual send times expose coordinated omission. Closed loop schedules the
+#next send relative to when the previous one actually went out, like the old sleep(INT_PERIOD).
+
+logger = logging.getLogger(__name__)
+
+IDLE_POLL_S = 0.1
+MAX_IDLE_STEPS = 10
+SPIN_S = 0.001
+
+def constant(rate):
+    rate = float(rate)
+    return lambda t: rate
+
+def ramp(start, end, duration):
+    start, end, duration = float(start), float(end), float(duration)
+    return lambda t: end if t >= duration else start + (end - start) * t / duration
+
+def diurnal(base, peak, period=86400, phase=0):
+    base, peak, period, phase = float(base), float(peak), float(period), float(phase)
+    return lambda t: base + (peak - base) * (1 - math.cos(2 * math.pi * (t + phase) / period)) / 2
+
+def burst(base, burst, every, length):
+    base, burst, every, length = float(base), float(burst), float(every), float(length)
+    return lambda t: burst if t % every < length else base
+
+def step(rates, duration):
+    rates = [float(r) for r in rates.split("|")]
+    duration = float(duration)
+    return lambda t: rates[min(int(t // duration), len(rates) - 1)]
+
+def unlimited():
+    return lambda t: math.inf
+
+PROFILES = {
+    "constant": constant,
+    "ramp": ramp,
+    "diurnal": diurnal,
+    "burst": burst,
+    "step": step,
+    "unlimited": unlimited,
+}
+
+def parse_profile(spec):
+    name, _, params = spec.strip().partition(":")
+    if name not in PROFILES:
+        raise ValueError(f"Unknown traffic profile '{name}', expected one of {', '.join(PROFILES)}")
+    kwargs = dict(p.split("=", 1) for p in params.split(",") if p)
+    try:
+        return PROFILES[name](**kwargs)
+    except TypeError as e:
+        raise ValueError(f"Bad parameters for traffic profile '{spec}': {e}") from e
+
+class Pacer:
+    def __init__(self, profile, mode="open", scale=1.0):
+        #scale splits the profile between several publishers, e.g. 1/N for N workers
+        if mode not in ("open", "closed"):
+            raise ValueError(f"Traffic mode must be 'open' or 'closed', got '{mode}'")
+        rate = parse_profile(profile) if isinstance(profile, str) else profile
+        self.rate = rate if scale == 1.0 else (lambda t: rate(t) * scale)
+        self.mode = mode
+        self.start = time.perf_counter()
+        self.start_wall = time.time()
+        self.due = self.start
+        self.idle = False
+        self.credit = 0.0
+        self.sent_count = 0
+
+    def _schedule_from(self, t):
+        #Integrates the profile from t in IDLE_POLL_S steps until one more message worth of rate has
+        #built up, so ramps starting at 0 msg/s or rates below 1 msg/s still land on the right time.
+        #Stops after MAX_IDLE_STEPS and leaves the pacer idle - _refresh carries on once that is reached.
+        for _ in range(MAX_IDLE_STEPS):
+            rate = self.rate(t - self.start)
+            if math.isinf(rate):
+                #Nothing to hold to without a rate, schedule the next message for right now
+                self.due, self.idle, self.credit = max(t, time.perf_counter()), False, 0.0
+                return
+            if rate > 0 and self.credit + rate * IDLE_POLL_S >= 1:
+                self.due, self.idle, self.credit = t + (1 - self.credit) / rate, False, 0.0
+                return
+            self.credit += max(rate, 0.0) * IDLE_POLL_S
+            t += IDLE_POLL_S
+        self.due, self.idle = t, True
+
+    def _refresh(self):
+        while self.idle and self.due <= time.perf_counter():
+            self._schedule_from(self.due)
+
+    def delay(self):
+        #Seconds until the next message is due, 0 if it is due or overdue
+        self._refresh()
+        return max(0.0, self.due - time.perf_counter())
+
+    def scheduled_at(self):
+        #Wall clock time the next message is scheduled for
+        return self.start_wall + (self.due - self.start)
+
+    def wait(self):
+        #Sleeps until the next message is due and returns its scheduled wall clock time
+        remaining = self.delay()
+        while self.idle:
+            time.sleep(remaining)
+            remaining = self.delay()
+        if remaining > 2 * SPIN_S:
+            time.sleep(remaining - SPIN_S)
+        while time.perf_counter() < self.due:
+            pass
+        return self.scheduled_at()
+
+    def sent(self):
+        #Call once the due message went out, moves the schedule on by one message
+        self.sent_count += 1
+        anchor = self.due if self.mode == "open" else max(self.due, time.perf_counter())
+        self._schedule_from(anchor)